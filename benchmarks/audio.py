@@ -0,0 +1,102 @@
+import random
+
+from rotarygpt import audio
+from rotarygpt.audio import PCMUSilenceDetector, linear_to_mu_law, mu_law_to_linear, wave_header
+
+FRAME_SIZE = 160
+# One second of audio
+FRAME_COUNT = 50
+
+
+def _random_pcm(sample_count, seed = 0):
+    generator = random.Random(seed)
+    return b''.join(generator.randint(-32768, 32767).to_bytes(2, 'little', signed=True) for _ in range(sample_count))
+
+
+def _random_mu_law(sample_count, seed = 0):
+    generator = random.Random(seed)
+    return bytes(generator.randint(0, 255) for _ in range(sample_count))
+
+
+# Running the codec with NumPy disabled too, the Pi may not have it installed
+def _with_backend(backend, function):
+    def run():
+        if backend == 'numpy':
+            return function()
+
+        numpy = audio.numpy
+        audio.numpy = None
+        try:
+            return function()
+        finally:
+            audio.numpy = numpy
+
+    return run
+
+
+def setup_encode(backend):
+    def setup():
+        pcm = _random_pcm(FRAME_SIZE * FRAME_COUNT)
+        return _with_backend(backend, lambda: linear_to_mu_law(pcm))
+    return setup
+
+
+def setup_decode(backend):
+    def setup():
+        mu_law = _random_mu_law(FRAME_SIZE * FRAME_COUNT)
+        return _with_backend(backend, lambda: mu_law_to_linear(mu_law))
+    return setup
+
+
+def setup_silence_detector():
+    frames = [_random_mu_law(FRAME_SIZE, seed) for seed in range(FRAME_COUNT)]
+    detector = PCMUSilenceDetector()
+    # Past the start-up skip and calibration, measuring the steady state
+    for frame in frames:
+        detector.add_sample_and_detect_silence(frame)
+
+    def run():
+        for frame in frames:
+            detector.add_sample_and_detect_silence(frame)
+
+    return run
+
+
+def setup_wave_header():
+    return wave_header
+
+
+def _backends():
+    return ['python', 'numpy'] if audio.numpy is not None else ['python']
+
+
+BENCHMARKS = [
+    *[
+        {
+            'name': f'mu_law_encode[{backend}]',
+            'setup': setup_encode(backend),
+            'frames': FRAME_COUNT,
+            'bytes': FRAME_SIZE * FRAME_COUNT * 2,
+        }
+        for backend in _backends()
+    ],
+    *[
+        {
+            'name': f'mu_law_decode[{backend}]',
+            'setup': setup_decode(backend),
+            'frames': FRAME_COUNT,
+            'bytes': FRAME_SIZE * FRAME_COUNT,
+        }
+        for backend in _backends()
+    ],
+    {
+        'name': 'silence_detector',
+        'setup': setup_silence_detector,
+        'frames': FRAME_COUNT,
+        'bytes': FRAME_SIZE * FRAME_COUNT,
+    },
+    {
+        'name': 'wave_header',
+        'setup': setup_wave_header,
+    },
+]
@@ -0,0 +1,96 @@
+import argparse
+import os
+import random
+import sys
+import traceback
+
+from rotarygpt.sip import SIPParseError, SIPRequest, SIPServer, SessionDescription
+
+CORPUS_DIRECTORY = os.path.join(os.path.dirname(__file__), 'sip_corpus')
+
+# Bytes that tend to hit the interesting branches of the parser
+interesting_bytes = [b'\r\n', b'\n', b' ', b'\t', b':', b',', b';', b'"', b'<', b'>', b'=', b'\r\n\r\n', b'\x00', b'\xff']
+
+
+def load_corpus(directory = CORPUS_DIRECTORY):
+    corpus = []
+    for file_name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, file_name), 'rb') as file:
+            corpus.append((file_name, file.read()))
+    return corpus
+
+
+def mutate(data, corpus, generator):
+    data = bytearray(data)
+    for _ in range(generator.randint(1, 4)):
+        position = generator.randint(0, len(data))
+        mutation = generator.randrange(6)
+        if mutation == 0 and data:
+            data[min(position, len(data) - 1)] ^= 1 << generator.randrange(8)
+        elif mutation == 1:
+            data[position:position] = generator.choice(interesting_bytes)
+        elif mutation == 2:
+            del data[position:position + generator.randint(1, 16)]
+        elif mutation == 3:
+            length = generator.randint(1, 32)
+            data[position:position] = data[position:position + length]
+        elif mutation == 4:
+            del data[position:]
+        else:
+            # Splicing in a piece of another message
+            _, other = generator.choice(corpus)
+            start = generator.randint(0, len(other))
+            data[position:position] = other[start:start + generator.randint(1, 64)]
+    return bytes(data)
+
+
+def parse(data):
+    # Anything but a clean parse or a SIPParseError is a bug
+    request = SIPRequest(('127.0.0.1', 5060)).parse(data)
+    SIPServer._transaction_key(request)
+    SIPServer._extract_sip_host(request.header(b'To'))
+    if request.body:
+        SessionDescription().parse(request.body)
+    return request
+
+
+def check_round_trip(name, data):
+    request = parse(data)
+    reparsed = parse(request.to_sip_message())
+    if (reparsed.method, reparsed.uri, reparsed.headers, reparsed.body) != \
+            (request.method, request.uri, request.headers, request.body):
+        raise AssertionError(f'{name} changed after serializing and parsing again')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fuzz the SIP parser with mutations of a corpus of real messages')
+    parser.add_argument('--iterations', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=None)
+    arguments = parser.parse_args()
+
+    seed = arguments.seed if arguments.seed is not None else random.randrange(2 ** 32)
+    generator = random.Random(seed)
+    corpus = load_corpus()
+
+    for name, data in corpus:
+        check_round_trip(name, data)
+
+    rejected = 0
+    for iteration in range(arguments.iterations):
+        name, data = generator.choice(corpus)
+        mutated = mutate(data, corpus, generator)
+        try:
+            parse(mutated)
+        except SIPParseError:
+            rejected += 1
+        except Exception:
+            print(f'Crash at iteration {iteration} (seed {seed}), mutated from {name}:')
+            print(repr(mutated))
+            traceback.print_exc()
+            sys.exit(1)
+
+    print(f'{arguments.iterations} messages, {rejected} rejected, no crashes (seed {seed})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,486 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import socket
+import tempfile
+import time
+
+from rotarygpt.audio import PCMUSilenceDetector, linear_to_mu_law, wave_header
+from rotarygpt.functions import FunctionManager
+from rotarygpt.media import MediaSession, PortPool
+from rotarygpt.prompts import PromptStore
+from rotarygpt.recording import RecordingManager
+from rotarygpt.rtcp import ReceptionStatistics
+from rotarygpt.rtp import PAYLOAD_TYPE_CN, PAYLOAD_TYPE_PCMU, header_struct
+from rotarygpt.server import serve
+from rotarygpt.sip import SessionDescription
+
+FRAME_SIZE = 160
+FRAME_DURATION = 0.02
+MU_LAW_SILENCE = b'\xff'
+# SIP retransmission timers, as the phone adapters use them
+T1 = 0.5
+T2 = 4.0
+
+PROMPT_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'audio')
+
+
+# Stands in for Whisper, GPT and Polly so the load test needs no API keys: greets the caller like the real
+# conversation and plays every turn straight back to it.
+class EchoConversation:
+    max_turn_duration = 10.0
+
+    def __init__(self, audio_in, audio_out, function_manager, prompt_store, loop, digit_collector = None):
+        self.audio_in = audio_in
+        self.audio_out = audio_out
+        self.prompt_store = prompt_store
+
+    @classmethod
+    def warm_up(cls):
+        pass
+
+    def start(self, shutdown_event):
+        for frame in self.prompt_store.frames('greeting'):
+            self.audio_out.write(frame)
+
+        silence_detector = PCMUSilenceDetector()
+        turn = bytearray()
+        max_turn_size = int(self.max_turn_duration / FRAME_DURATION) * FRAME_SIZE
+        while not shutdown_event.is_set():
+            frame = self.audio_in.read_frame(timeout=0.2)
+            if frame is None:
+                continue
+
+            turn += frame
+            del turn[:-max_turn_size]
+            if silence_detector.add_sample_and_detect_silence(frame):
+                self.audio_out.write(turn)
+                turn = bytearray()
+
+
+class HandsetProtocol(asyncio.DatagramProtocol):
+    def __init__(self, on_datagram):
+        self.on_datagram = on_datagram
+
+    def datagram_received(self, data, address):
+        self.on_datagram(data, address)
+
+
+def parse_response(data):
+    # Just enough of a SIP response for a user agent that only ever sends INVITE, ACK and BYE
+    header, _, body = data.partition(b'\r\n\r\n')
+    lines = header.split(b'\r\n')
+    parts = lines[0].split(b' ', 2)
+    if len(parts) < 2 or parts[0] != b'SIP/2.0' or not parts[1].isdigit():
+        return None
+
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(b':')
+        headers.setdefault(name.strip().lower(), value.strip())
+
+    return int(parts[1]), headers, body
+
+
+def local_address_for(server_address):
+    # The address the server sees us with, taken from the route to it
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        probe.connect(server_address)
+        return probe.getsockname()[0]
+    finally:
+        probe.close()
+
+
+class Handset:
+    def __init__(self, index, server_address, audio, duration, late_threshold):
+        self.index = index
+        self.server_address = server_address
+        self.audio = audio
+        self.duration = duration
+        self.late_threshold = late_threshold
+
+        self.local_address = local_address_for(server_address)
+        self.call_id = f'loadtest-{index}-{random.getrandbits(32):08x}@{self.local_address}'.encode('ascii')
+        self.local_tag = f'{random.getrandbits(32):08x}'.encode('ascii')
+        self.remote_to = None
+        self.remote_rtp_address = None
+
+        self.loop = None
+        self.sip_transport = None
+        self.rtp_transport = None
+        self.responses = asyncio.Queue()
+        self.ack = None
+
+        self.setup_time = None
+        self.dropped_reason = None
+        self.reception_statistics = ReceptionStatistics()
+        self.received_packets = 0
+        self.comfort_noise_packets = 0
+        self.late_packets = 0
+        self.transit_anchor = None
+        self.received_audio = bytearray()
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.sip_transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: HandsetProtocol(self._sip_received), local_addr=('0.0.0.0', 0))
+        self.rtp_transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: HandsetProtocol(self._rtp_received), local_addr=('0.0.0.0', 0))
+
+        try:
+            if not await self._invite():
+                return
+            await self._stream()
+            if not await self._bye():
+                self.dropped_reason = 'no answer to BYE'
+            elif self.received_packets == 0:
+                self.dropped_reason = 'no audio from the agent'
+        except OSError as error:
+            self.dropped_reason = str(error)
+        finally:
+            self.sip_transport.close()
+            self.rtp_transport.close()
+
+    def result(self):
+        return {
+            'setup_ms': None if self.setup_time is None else self.setup_time * 1000,
+            'jitter_ms': self.reception_statistics.jitter / 8,
+            'late_packets': self.late_packets,
+            'lost_packets': self.reception_statistics.lost(),
+            'received_packets': self.received_packets,
+            'comfort_noise_packets': self.comfort_noise_packets,
+            'dropped': self.dropped_reason,
+        }
+
+    async def _invite(self):
+        rtp_port = self.rtp_transport.get_extra_info('sockname')[1]
+        body = ('v=0\r\n'
+                f'o=loadtest {self.index} 1 IN IP4 {self.local_address}\r\n'
+                's=Load test\r\n'
+                f'c=IN IP4 {self.local_address}\r\n'
+                't=0 0\r\n'
+                f'm=audio {rtp_port} RTP/AVP 0 13\r\n'
+                'a=rtpmap:0 PCMU/8000\r\n'
+                'a=rtpmap:13 CN/8000\r\n'
+                'a=ptime:20\r\n').encode('ascii')
+        branch = self._new_branch()
+        invite = self._request(b'INVITE', 1, branch, body)
+
+        start = self.loop.time()
+        response = await self._transact(invite, b'INVITE', 64 * T1)
+        if response is None:
+            self.dropped_reason = 'no answer to INVITE'
+            return False
+
+        status, headers, response_body = response
+        if status >= 300:
+            # The ACK for a failure is part of the INVITE transaction and reuses its branch
+            self.remote_to = headers.get(b'to', b'')
+            self._send(self._request(b'ACK', 1, branch))
+            self.dropped_reason = f'INVITE answered with {status}'
+            return False
+
+        self.setup_time = self.loop.time() - start
+        self.remote_to = headers.get(b'to', b'')
+        self.ack = self._request(b'ACK', 1, self._new_branch())
+        self._send(self.ack)
+
+        answer = SessionDescription().parse(response_body)
+        audio = answer.audio()
+        if audio is None:
+            self.dropped_reason = 'no audio in the answer'
+            return False
+        self.remote_rtp_address = (answer.address(audio) or self.server_address[0], audio.port)
+        return True
+
+    async def _stream(self):
+        sequence_number = random.randint(0, 0xFFFF)
+        timestamp = random.randint(0, 0xFFFF)
+        source = random.getrandbits(32)
+        # Starting each handset somewhere else in the audio so they don't all talk at once
+        position = random.randrange(0, len(self.audio) // FRAME_SIZE) * FRAME_SIZE
+
+        deadline = self.loop.time()
+        end = deadline + self.duration
+        marker = 0x80
+        while deadline < end:
+            payload = self.audio[position:position + FRAME_SIZE]
+            position = (position + FRAME_SIZE) % len(self.audio)
+            header = header_struct.pack(0x80, marker | PAYLOAD_TYPE_PCMU, sequence_number, timestamp, source)
+            self.rtp_transport.sendto(header + payload, self.remote_rtp_address)
+
+            marker = 0
+            sequence_number = (sequence_number + 1) & 0xFFFF
+            timestamp = (timestamp + FRAME_SIZE) & 0xFFFFFFFF
+            # Paced against absolute deadlines like a real phone, sleeping late doesn't shift the rest
+            deadline += FRAME_DURATION
+            await asyncio.sleep(max(0.0, deadline - self.loop.time()))
+
+    async def _bye(self):
+        bye = self._request(b'BYE', 2, self._new_branch())
+        response = await self._transact(bye, b'BYE', 64 * T1)
+        return response is not None and response[0] < 300
+
+    async def _transact(self, request, method, timeout):
+        # Sends a request and retransmits it until a final response arrives, like timers A and E
+        start = self.loop.time()
+        interval = T1
+        self._send(request)
+        while True:
+            remaining = timeout - (self.loop.time() - start)
+            if remaining <= 0:
+                return None
+
+            try:
+                response = await asyncio.wait_for(self._next_response(method), min(interval, remaining))
+            except asyncio.TimeoutError:
+                self._send(request)
+                interval = min(2 * interval, T2)
+                continue
+
+            if response[0] >= 200:
+                return response
+            # A provisional response stops the retransmissions of an INVITE
+            interval = timeout
+
+    async def _next_response(self, method):
+        while True:
+            response = await self.responses.get()
+            if response[1].get(b'cseq', b'').endswith(method):
+                return response
+
+    def _sip_received(self, data, address):
+        response = parse_response(data)
+        if response is None:
+            return
+
+        status, headers, _ = response
+        if status == 200 and headers.get(b'cseq', b'').endswith(b'INVITE') and self.ack is not None:
+            # A retransmitted 200 OK means our ACK got lost
+            self._send(self.ack)
+            return
+        self.responses.put_nowait(response)
+
+    def _rtp_received(self, data, address):
+        if len(data) < header_struct.size:
+            return
+
+        first_byte, second_byte, sequence_number, timestamp, source = header_struct.unpack_from(data)
+        payload_type = second_byte & 0x7F
+        if first_byte >> 6 != 2 or payload_type not in (PAYLOAD_TYPE_PCMU, PAYLOAD_TYPE_CN):
+            return
+
+        arrival_time = self.loop.time()
+        self.reception_statistics.update(source, sequence_number, timestamp, arrival_time)
+        self.received_packets += 1
+
+        if payload_type == PAYLOAD_TYPE_CN:
+            self.comfort_noise_packets += 1
+        else:
+            self.received_audio += data[12 + 4 * (first_byte & 0x0F):]
+
+        # Late relative to the earliest packet of the talkspurt, a new talkspurt may start at any time
+        transit = arrival_time - timestamp / 8000
+        if second_byte & 0x80 or self.transit_anchor is None or transit < self.transit_anchor:
+            self.transit_anchor = transit
+        elif transit - self.transit_anchor > self.late_threshold:
+            self.late_packets += 1
+
+    def _request(self, method, sequence, branch, body = b''):
+        sip_port = self.sip_transport.get_extra_info('sockname')[1]
+        uri = f'sip:rotarygpt@{self.server_address[0]}:{self.server_address[1]}'.encode('ascii')
+        to = self.remote_to if self.remote_to is not None else b'<' + uri + b'>'
+        lines = [
+            method + b' ' + uri + b' SIP/2.0',
+            f'Via: SIP/2.0/UDP {self.local_address}:{sip_port};branch='.encode('ascii') + branch,
+            f'From: <sip:handset{self.index}@{self.local_address}>;tag='.encode('ascii') + self.local_tag,
+            b'To: ' + to,
+            b'Call-ID: ' + self.call_id,
+            b'CSeq: ' + str(sequence).encode('ascii') + b' ' + method,
+            f'Contact: <sip:handset{self.index}@{self.local_address}:{sip_port}>'.encode('ascii'),
+            b'Max-Forwards: 70',
+            b'User-Agent: RotaryGPT load test',
+        ]
+        if body:
+            lines.append(b'Content-Type: application/sdp')
+        lines.append(b'Content-Length: ' + str(len(body)).encode('ascii'))
+        return b'\r\n'.join(lines) + b'\r\n\r\n' + body
+
+    def _send(self, message):
+        self.sip_transport.sendto(message, self.server_address)
+
+    @staticmethod
+    def _new_branch():
+        return f'z9hG4bK{random.getrandbits(48):012x}'.encode('ascii')
+
+
+def load_audio(path):
+    if path is None:
+        # The prompts with a second of silence after each, so the agent hears turns end
+        audio = b''
+        for file_name in sorted(os.listdir(PROMPT_DIRECTORY)):
+            if file_name.endswith('.pcm'):
+                with open(os.path.join(PROMPT_DIRECTORY, file_name), 'rb') as file:
+                    pcm = file.read()
+                audio += linear_to_mu_law(pcm[:len(pcm) & ~1]) + MU_LAW_SILENCE * 8000
+    else:
+        with open(path, 'rb') as file:
+            data = file.read()
+        # Raw PCMU as is, anything else is taken to be 16 bit linear PCM like the prompts
+        audio = data if path.endswith('.ulaw') else linear_to_mu_law(data[:len(data) & ~1])
+
+    # Whole frames only
+    audio = audio[:len(audio) - len(audio) % FRAME_SIZE]
+    if not audio:
+        raise ValueError(f'No audio in {path}')
+    return audio
+
+
+def percentiles(values):
+    values = sorted(value for value in values if value is not None)
+    if not values:
+        return None
+
+    def percentile(fraction):
+        return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+    return {'p50': percentile(0.5), 'p90': percentile(0.9), 'p99': percentile(0.99), 'max': values[-1]}
+
+
+def process_cpu_time(pid):
+    # utime and stime of another process, from /proc
+    with open(f'/proc/{pid}/stat') as file:
+        fields = file.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+async def run_handsets(arguments, server_address, audio):
+    handsets = [Handset(index, server_address, audio, arguments.duration, arguments.late_threshold)
+                for index in range(arguments.calls)]
+
+    tasks = []
+    for handset in handsets:
+        tasks.append(asyncio.create_task(handset.run()))
+        await asyncio.sleep(arguments.ramp)
+    await asyncio.gather(*tasks)
+
+    return handsets
+
+
+async def run_load_test(arguments, audio):
+    if arguments.server is not None:
+        host, _, port = arguments.server.partition(':')
+        server_address = (socket.gethostbyname(host), int(port or 5060))
+        cpu_start = process_cpu_time(arguments.server_pid) if arguments.server_pid else None
+        wall_start = time.monotonic()
+        handsets = await run_handsets(arguments, server_address, audio)
+        cpu_time = process_cpu_time(arguments.server_pid) - cpu_start if arguments.server_pid else None
+        return handsets, cpu_time, time.monotonic() - wall_start
+
+    # Serving in this process, the CPU time then includes the handsets themselves
+    server_address = ('127.0.0.1', arguments.sip_port)
+    MediaSession.conversation_class = EchoConversation
+    prompt_store = PromptStore(PROMPT_DIRECTORY)
+    prompt_store.load()
+    shutdown_event = asyncio.Event()
+
+    with tempfile.TemporaryDirectory(prefix='rotarygpt-loadtest-') as recording_directory:
+        first_port, last_port = arguments.rtp_ports.split('-')
+        server = asyncio.create_task(serve(FunctionManager(), prompt_store, RecordingManager(recording_directory),
+                                           PortPool(int(first_port), int(last_port)), '127.0.0.1', arguments.sip_port,
+                                           shutdown_event))
+        # Letting the server bind its socket
+        await asyncio.sleep(0.2)
+
+        cpu_start = time.process_time()
+        wall_start = time.monotonic()
+        try:
+            handsets = await run_handsets(arguments, server_address, audio)
+        finally:
+            shutdown_event.set()
+            await server
+            prompt_store.close()
+
+    return handsets, time.process_time() - cpu_start, time.monotonic() - wall_start
+
+
+def report(handsets, cpu_time, wall_time, arguments):
+    results = [handset.result() for handset in handsets]
+    dropped = [result['dropped'] for result in results if result['dropped'] is not None]
+    summary = {
+        'calls': len(results),
+        'dropped_calls': len(dropped),
+        'dropped_reasons': sorted(set(dropped)),
+        'setup_ms': percentiles(result['setup_ms'] for result in results),
+        'jitter_ms': percentiles(result['jitter_ms'] for result in results if result['received_packets']),
+        'late_packets': percentiles(result['late_packets'] for result in results if result['received_packets']),
+        'lost_packets': percentiles(result['lost_packets'] for result in results if result['received_packets']),
+        # Seconds of CPU per second of call, 1.0 being a whole core
+        'cpu_per_call': None if cpu_time is None else cpu_time / wall_time / len(results),
+    }
+
+    if arguments.json:
+        print(json.dumps({'summary': summary, 'calls': results}, indent=2))
+        return summary
+
+    print(f"{summary['calls']} calls, {summary['dropped_calls']} dropped" +
+          (f" ({', '.join(summary['dropped_reasons'])})" if dropped else ''))
+    for name in ('setup_ms', 'jitter_ms', 'late_packets', 'lost_packets'):
+        values = summary[name]
+        if values is None:
+            print(f'{name:<14} no data')
+            continue
+        print(f'{name:<14}' + ''.join(f'{key:>5} {value:>9.2f}' for key, value in values.items()))
+    if summary['cpu_per_call'] is not None:
+        print(f"cpu per call   {summary['cpu_per_call'] * 100:.1f}% of a core" +
+              (' (including the handsets)' if arguments.server is None else ''))
+
+    return summary
+
+
+def save_recordings(handsets, directory):
+    os.makedirs(directory, exist_ok=True)
+    for handset in handsets:
+        path = os.path.join(directory, f'handset-{handset.index}.wav')
+        with open(path, 'wb') as file:
+            file.write(wave_header(data_size=len(handset.received_audio)))
+            file.write(handset.received_audio)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Call the SIP server from simulated handsets and measure the calls')
+    parser.add_argument('--calls', type=int, default=4, help='Number of simultaneous handsets')
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds each handset streams audio')
+    parser.add_argument('--ramp', type=float, default=0.1, help='Seconds between two handsets dialing')
+    parser.add_argument('--audio', help='Audio to send, 16 bit 8kHz PCM or .ulaw, the prompts by default')
+    parser.add_argument('--server', help='HOST[:PORT] of a running server, one is started in-process by default')
+    parser.add_argument('--server-pid', type=int, help='Process of the running server, to measure its CPU time')
+    parser.add_argument('--sip-port', type=int, default=15060, help='SIP port of the in-process server')
+    parser.add_argument('--rtp-ports', default='16000-16998', help='RTP port range of the in-process server')
+    parser.add_argument('--late-threshold', type=float, default=0.04,
+                        help='Seconds behind its talkspurt schedule that make a packet late')
+    parser.add_argument('--record', help='Directory to save the audio each handset received')
+    parser.add_argument('--json', action='store_true')
+    parser.add_argument('--verbose', action='store_true')
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if arguments.verbose else logging.WARNING,
+                        format="%(asctime)s %(threadName)s [%(levelname)s]: %(message)s", datefmt='%Y-%m-%d %H:%M:%S')
+
+    audio = load_audio(arguments.audio)
+    handsets, cpu_time, wall_time = asyncio.run(run_load_test(arguments, audio))
+
+    if arguments.record:
+        save_recordings(handsets, arguments.record)
+
+    summary = report(handsets, cpu_time, wall_time, arguments)
+    if summary['dropped_calls']:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+from rotarygpt.ringbuffer import AudioRingBuffer, OVERFLOW_BLOCK
+
+FRAME_SIZE = 160
+FRAME_COUNT = 50
+# The size of a Polly chunk after encoding to PCMU
+WRITE_SIZE = 512
+
+
+def setup_write_read():
+    buffer = AudioRingBuffer(500, OVERFLOW_BLOCK)
+    data = b'\xff' * (FRAME_SIZE * FRAME_COUNT)
+
+    def run():
+        for offset in range(0, len(data), WRITE_SIZE):
+            buffer.write(data[offset:offset + WRITE_SIZE])
+        for _ in range(FRAME_COUNT):
+            buffer.read_frame_nowait()
+
+    return run
+
+
+BENCHMARKS = [
+    {
+        'name': 'ring_buffer_write_read',
+        'setup': setup_write_read,
+        'frames': FRAME_COUNT,
+        'bytes': FRAME_SIZE * FRAME_COUNT,
+    },
+]
@@ -0,0 +1,30 @@
+from rotarygpt.rtp import RTPSender
+
+FRAME_SIZE = 160
+FRAME_COUNT = 50
+
+
+class NullSocket:
+    def sendto(self, data, address):
+        pass
+
+
+def setup_packetize():
+    sender = RTPSender(NullSocket(), '127.0.0.1', 5004, None)
+    payload = b'\xff' * FRAME_SIZE
+
+    def run():
+        for _ in range(FRAME_COUNT):
+            sender._send_packet(payload)
+
+    return run
+
+
+BENCHMARKS = [
+    {
+        'name': 'rtp_packetize',
+        'setup': setup_packetize,
+        'frames': FRAME_COUNT,
+        'bytes': FRAME_SIZE * FRAME_COUNT,
+    },
+]
@@ -0,0 +1,128 @@
+import argparse
+import json
+import platform
+import sys
+import time
+
+from benchmarks import audio, ringbuffer, rtp, sip
+from rotarygpt.audio import numpy
+
+MODULES = [audio, ringbuffer, rtp, sip]
+
+
+def measure(run, min_time, repeat):
+    # Calibrating the number of iterations so that a single measurement takes at least min_time
+    iterations = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(iterations):
+            run()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        iterations *= 2 if elapsed == 0 else max(2, int(min_time / elapsed * 1.2))
+
+    timings = [elapsed / iterations]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            run()
+        timings.append((time.perf_counter() - start) / iterations)
+
+    # The fastest run is the one least disturbed by the rest of the system
+    return min(timings), iterations
+
+
+def run_benchmarks(name_filter, min_time, repeat):
+    results = {}
+    for module in MODULES:
+        for benchmark in module.BENCHMARKS:
+            if name_filter and name_filter not in benchmark['name']:
+                continue
+
+            seconds_per_op, iterations = measure(benchmark['setup'](), min_time, repeat)
+            result = {
+                'ns_per_op': seconds_per_op * 1e9,
+                'ops_per_second': 1 / seconds_per_op,
+                'iterations': iterations,
+            }
+            if 'frames' in benchmark:
+                result['ns_per_frame'] = seconds_per_op * 1e9 / benchmark['frames']
+                result['frames_per_second'] = benchmark['frames'] / seconds_per_op
+            if 'bytes' in benchmark:
+                result['megabytes_per_second'] = benchmark['bytes'] / seconds_per_op / 1e6
+
+            results[benchmark['name']] = result
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        ratio = result['ns_per_op'] / baseline[name]['ns_per_op']
+        result['baseline_ratio'] = ratio
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+
+    return regressions
+
+
+def print_text(results, regressions):
+    for name, result in results.items():
+        line = f"{name:<28} {result['ns_per_op']:>14,.0f} ns/op"
+        if 'ns_per_frame' in result:
+            line += f"  {result['ns_per_frame']:>10,.0f} ns/frame"
+        if 'megabytes_per_second' in result:
+            line += f"  {result['megabytes_per_second']:>8.2f} MB/s"
+        if 'baseline_ratio' in result:
+            line += f"  x{result['baseline_ratio']:.2f} vs baseline"
+        if name in regressions:
+            line += '  REGRESSION'
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Microbenchmarks for the audio and RTP hot paths.')
+    parser.add_argument('--filter', help='Only run benchmarks whose name contains this string.')
+    parser.add_argument('--min-time', type=float, default=0.2, help='Minimum duration of one measurement in seconds.')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of measurements per benchmark.')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON.')
+    parser.add_argument('--save', metavar='PATH', help='Save the results as a baseline.')
+    parser.add_argument('--baseline', metavar='PATH', help='Compare the results against a saved baseline.')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Slowdown relative to the baseline that counts as a regression.')
+    arguments = parser.parse_args()
+
+    results = run_benchmarks(arguments.filter, arguments.min_time, arguments.repeat)
+
+    regressions = []
+    if arguments.baseline:
+        with open(arguments.baseline) as file:
+            regressions = compare(results, json.load(file)['results'], arguments.tolerance)
+
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'numpy': numpy is not None,
+        'results': results,
+        'regressions': regressions,
+    }
+
+    if arguments.save:
+        with open(arguments.save, 'w') as file:
+            json.dump(report, file, indent=2)
+
+    if arguments.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_text(results, regressions)
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,46 @@
+import os
+
+from rotarygpt.sip import SIPRequest, SIPServer, SessionDescription
+
+CORPUS_DIRECTORY = os.path.join(os.path.dirname(__file__), 'sip_corpus')
+
+
+def _load(file_name):
+    with open(os.path.join(CORPUS_DIRECTORY, file_name), 'rb') as file:
+        return file.read()
+
+
+def setup_parse_invite():
+    data = _load('invite-ata.sip')
+
+    def run():
+        request = SIPRequest(('192.168.1.20', 5060)).parse(data)
+        SessionDescription().parse(request.body).audio()
+
+    return run
+
+
+def setup_serialize_response():
+    server = SIPServer('0.0.0.0', 5060)
+    request = SIPRequest(('192.168.1.20', 5060)).parse(_load('invite-ata.sip'))
+    response = server._create_response(request, 200, b"OK", b'3f2a91c0')
+    response.headers[b'Content-Type'] = b'application/sdp'
+    response.body = request.body
+
+    def run():
+        response.to_sip_message()
+
+    return run
+
+
+BENCHMARKS = [
+    {
+        'name': 'sip_parse_invite',
+        'setup': setup_parse_invite,
+        'bytes': len(_load('invite-ata.sip')),
+    },
+    {
+        'name': 'sip_serialize_response',
+        'setup': setup_serialize_response,
+    },
+]
@@ -1,5 +1,3 @@
-from rotarygpt.aws import PollyRequest
-
 accents = {
     'Australian': 'Olivia',
     'British': 'Brian',
@@ -18,12 +16,13 @@ accents = {
     'Swedish': 'Elin',
 }
 
-def change_accent(parameters):
+def change_accent(parameters, conversation):
     if 'accent' not in parameters:
         return 'Accent parameter is required'
     if parameters['accent'] not in accents:
         return f"Accent needs to be one of {', '.join(accents.keys())}"
-    PollyRequest.voice = accents[parameters['accent']]
+    # Only for this call, others keep their own voice
+    conversation.voice = accents[parameters['accent']]
 
     return f"The phone agent's accent is now {parameters['accent']}. The phone agent's nationality is also {parameters['accent']}. Please keep using English language."
 
@@ -33,6 +32,7 @@ GPT_FUNCTIONS = [
         "name": "change_accent",
         "description": "Changes the agent's accent.",
         "callable": change_accent,
+        "needs_conversation": True,
         "parameters": {
             "type": "object",
             "properties": {
@@ -1,8 +1,9 @@
 import json
-import socket, ssl
 from datetime import date
 import urllib.parse
 
+from rotarygpt.http import connection_pool
+
 def get_weather(parameters, *_):
     if 'day' not in parameters:
         return 'The "day" parameter is mandatory.'
@@ -70,50 +71,19 @@ def get_weather(parameters, *_):
            f"Precipitation probability: {response['daily']['precipitation_probability_max'][0]}{response['daily_units']['precipitation_probability_max']}"
 
 def get_request(host, path):
-    port = 443
-
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    context = ssl.create_default_context()
-
-    ssl_socket = context.wrap_socket(client_socket, server_hostname=host)
-    ssl_socket.connect((host, port))
-
     http_header = b"""GET """ + path.encode('ascii') + b""" HTTP/1.1
-Host: """ + host.encode('ascii') + b"""
-Connection: close""".replace(b"\n", b"\r\n")
-
-    ssl_socket.sendall(http_header + b"\r\n\r\n")
-
-    response = b""
-    while True:
-        data = ssl_socket.recv(1024)
-        if not data:
-            break
-        response += data
+Host: """ + host.encode('ascii')
 
-    header, body = response.split(b'\r\n\r\n', 1)
-
-    if b'Transfer-Encoding: chunked' in header:
-        body = unchunk_body(body)
+    connection, response = connection_pool.request(host, http_header.replace(b"\n", b"\r\n") + b"\r\n\r\n")
+    try:
+        body = response.read()
+    finally:
+        connection_pool.release(connection)
 
     parsed_response = json.loads(body.decode())
 
     return parsed_response
 
-def unchunk_body(body):
-    unchunked_body = b''
-    while True:
-        chunk_size, rest = body.split(b"\r\n", 1)
-        chunk_size = int(chunk_size, 16)
-
-        if 0 == chunk_size:
-            break
-
-        chunk, body = rest[:chunk_size], rest[chunk_size + 2:]
-        unchunked_body += chunk
-
-    return unchunked_body
-
 GPT_FUNCTIONS = [{
     "name": "get_weather_today",
     "description": "Gets the current weather for today for Barcelona, where the user is located.",
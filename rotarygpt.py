@@ -1,55 +1,20 @@
+import asyncio
 import importlib
 import os
-import queue
-import threading, sys
-import time
-from functools import partial
+import sys
 import logging
+import threading
 
-from rotarygpt.conversation import Conversation
-from rotarygpt.rtp import RTPReceiver, RTPSender, SharedSocket
-from rotarygpt.sip import SIPServer
+from rotarygpt.dtmf import ShortcutStore
+from rotarygpt.media import PortPool
+from rotarygpt.server import serve
 from rotarygpt.functions import FunctionManager
-from rotarygpt.utils import clear_queue
+from rotarygpt.prompts import PromptStore
+from rotarygpt.recording import RecordingManager
 
 logging.basicConfig(level=logging.DEBUG,
                     format="%(asctime)s %(threadName)s [%(levelname)s]: %(message)s", datefmt='%Y-%m-%d %H:%M:%S')
 
-# Low context switching interval needed for timely voice packet relay
-sys.setswitchinterval(0.001)
-
-def reset_event(event, *_):
-    event.clear()
-
-def start_rpt(threads, shutdown_event, audio_queue_in, audio_queue_out, ip, port):
-    shared_socket = SharedSocket()
-    shared_socket.bind('0.0.0.0', 5004)
-
-    rtp_receiver = RTPReceiver(shared_socket, audio_queue_in)
-    threads['rtp_receiver'] = threading.Thread(target=rtp_receiver.start, args=(shutdown_event,), daemon=True,
-                                               name="RTP receiver")
-    threads['rtp_receiver'].start()
-
-    rtp_sender = RTPSender(shared_socket, ip, port, audio_queue_out)
-    threads['rtp_sender'] = threading.Thread(target=rtp_sender.start, args=(shutdown_event,), daemon=True,
-                                             name="RTP sender")
-    threads['rtp_sender'].start()
-
-def start_conversation(threads, shutdown_event, audio_queue_in, audio_queue_out, function_manager, *_):
-    conversation = Conversation(audio_queue_in, audio_queue_out, function_manager)
-    threads['conversation'] = threading.Thread(target=conversation.start, args=(shutdown_event,), daemon=True,
-                                               name="Conversation")
-    threads['conversation'].start()
-
-def finish_call(threads, shutdown_event, audio_queue_in, audio_queue_out):
-    shutdown_event.set()
-    threads['rtp_receiver'].join()
-    threads['rtp_sender'].join()
-    threads['conversation'].join()
-
-    clear_queue(audio_queue_in)
-    clear_queue(audio_queue_out)
-
 def register_functions(function_manager, path):
     full_path = os.path.abspath(path) if not os.path.isabs(path) else path
     sys.path.append(full_path)
@@ -64,46 +29,37 @@ def register_functions(function_manager, path):
                 function_manager.register(function_definition)
 
 def start():
-    audio_queue_in = queue.Queue()
-    audio_queue_out = queue.Queue()
-    call_ended_event = threading.Event()
     function_manager = FunctionManager()
 
     register_functions(function_manager, './gpt_functions')
 
-    threads = {
-        'rtp_receiver': None,
-        'rtp_sender': None,
-        'sip_server': None,
-        'conversation': None,
-    }
-
-    sip_server = SIPServer('0.0.0.0', 5060)
-
-    sip_server.register_incoming_call_callback(partial(reset_event, call_ended_event))
+    prompt_store = PromptStore('./audio')
+    prompt_store.load()
 
-    sip_server.register_incoming_call_callback(partial(start_rpt, threads, call_ended_event, audio_queue_in,
-                                                       audio_queue_out))
-    sip_server.register_incoming_call_callback(partial(start_conversation, threads,
-                                                       call_ended_event, audio_queue_in, audio_queue_out,
-                                                       function_manager))
+    recording_manager = RecordingManager('/tmp/rotarygpt-recordings')
 
-    sip_server.register_call_ended_callback(partial(finish_call, threads, call_ended_event,
-                                                    audio_queue_in, audio_queue_out))
+    shortcut_store = ShortcutStore('./audio/shortcuts')
+    shortcuts_path = os.environ.get('ROTARYGPT_DTMF_SHORTCUTS')
+    if shortcuts_path:
+        shortcut_store.load(shortcuts_path)
+        for shortcut in shortcut_store.shortcuts.values():
+            if shortcut.function not in function_manager.functions:
+                logging.warning(f'Shortcut {shortcut.digits} calls {shortcut.function}, which is not registered')
+        # Calls can come in while the confirmations are being synthesized, the first use waits for its own
+        threading.Thread(target=shortcut_store.prepare, args=(threading.Event(),), daemon=True,
+                         name='Shortcuts').start()
 
-    sip_thread_shutdown_event = threading.Event()
-    threads['sip_server'] = threading.Thread(target=sip_server.start, args=(sip_thread_shutdown_event,), daemon=True,
-                                             name="SIP server")
-    threads['sip_server'].start()
+    first_port, last_port = os.environ.get('ROTARYGPT_RTP_PORT_RANGE', '5004-5098').split('-')
+    port_pool = PortPool(int(first_port), int(last_port))
 
+    # SIP and RTP of every call run on this one event loop, the conversations run in its executor
     try:
-        while True:
-            time.sleep(1)
+        asyncio.run(serve(function_manager, prompt_store, recording_manager, port_pool,
+                          shortcut_store=shortcut_store))
     except KeyboardInterrupt:
         pass
 
-    sip_thread_shutdown_event.set()
-    threads['sip_server'].join()
+    prompt_store.close()
 
 if __name__ == "__main__":
     start()
@@ -1,72 +1,116 @@
+import array
 import math
+import sys
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Endpointing on 20ms PCMU frames. The noise floor is tracked continuously outside of speech,
+# speech starts after a few consecutive loud frames and the turn ends after a configurable stretch of quiet frames.
 class PCMUSilenceDetector:
-    def __init__(self):
+    frame_duration = 0.02
+
+    def __init__(self, end_of_turn_timeout = 0.5, skip_duration = 0.2, calibration_duration = 0.2,
+                 min_speech_duration = 0.1, speech_ratio = 6.0, silence_ratio = 2.0):
+        self.skip_frame_count = round(skip_duration / self.frame_duration)
+        self.calibration_frame_count = max(1, round(calibration_duration / self.frame_duration))
+        self.min_speech_frame_count = max(1, round(min_speech_duration / self.frame_duration))
+        self.end_of_turn_frame_count = max(1, round(end_of_turn_timeout / self.frame_duration))
+        self.speech_ratio = speech_ratio
+        self.silence_ratio = silence_ratio
+
+        # Keeps the ratios meaningful on a digitally silent line
+        self.min_noise_floor = 16.0
+        # Falling fast, rising slowly, so that speech does not pull the floor up
+        self.floor_fall_rate = 0.2
+        self.floor_rise_rate = 0.01
+        self.floor_rise_rate_in_speech = 0.001
+
         self.sample_counter = 0
-        self.current_samples = b""
-        self.skip_before_silence_sample_count = 0.5 / 0.02 # 0.5 seconds
-        self.silence_sample_count = 0.5 / 0.02 # 0.5 seconds
-        self.sample_count = 0.5 / 0.02  # 0.5 seconds
-        self.silence_upper_threshold = None
-        self.signal_lower_threshold = None
+        self.calibration_energy = 0
+        self.calibration_length = 0
+        self.noise_floor = None
+
         self.had_signal = False
+        self.onset_frames = 0
+        self.trailing_silence_frames = 0
 
     def add_sample_and_detect_silence(self, chunk):
-        if self.sample_counter < self.skip_before_silence_sample_count:
-            self.sample_counter += 1
+        if not chunk:
             return
 
-        if self.sample_counter < self.silence_sample_count + self.skip_before_silence_sample_count:
-            self.current_samples = self.current_samples + chunk
+        if self.sample_counter < self.skip_frame_count:
             self.sample_counter += 1
             return
 
-        if self.silence_upper_threshold is None:
-            self.silence_upper_threshold = self._calculate_level(self.current_samples) * 2
-            self.signal_lower_threshold = self.silence_upper_threshold * 5
-            self.current_samples = b""
-
-        self.current_samples = self.current_samples + chunk
+        energy = self._calculate_energy(chunk)
 
-        if self.sample_counter < self.silence_sample_count + self.skip_before_silence_sample_count + self.sample_count:
+        if self.sample_counter < self.skip_frame_count + self.calibration_frame_count:
+            self.calibration_energy += energy
+            self.calibration_length += len(chunk)
             self.sample_counter += 1
+            if self.sample_counter == self.skip_frame_count + self.calibration_frame_count:
+                level = self._calculate_level(self.calibration_energy, self.calibration_length)
+                self.noise_floor = max(self.min_noise_floor, level)
             return
 
-        level = self._calculate_level(self.current_samples)
-        silence_detected = False
+        level = self._calculate_level(energy, len(chunk))
 
-        if level > self.signal_lower_threshold:
-            self.had_signal = True
-        elif self.had_signal and level < self.silence_upper_threshold:
-            self.had_signal = False
-            silence_detected = True
+        if not self.had_signal:
+            if level > self.noise_floor * self.speech_ratio:
+                self.onset_frames += 1
+                if self.onset_frames >= self.min_speech_frame_count:
+                    self.had_signal = True
+                    self.trailing_silence_frames = 0
+                return False
 
+            # A click or a short burst is not speech, and it does not belong to the noise floor either
+            self.onset_frames = 0
+            self._update_noise_floor(level, self.floor_rise_rate)
+            return False
 
-        self.current_samples = self.current_samples[len(chunk):]
-        return silence_detected
+        if level > self.noise_floor * self.silence_ratio:
+            self.trailing_silence_frames = 0
+            self._update_noise_floor(level, self.floor_rise_rate_in_speech)
+            return False
+
+        self.trailing_silence_frames += 1
+        self._update_noise_floor(level, self.floor_rise_rate)
+
+        if self.trailing_silence_frames < self.end_of_turn_frame_count:
+            return False
+
+        self.reset_had_signal()
+        return True
 
     def reset_had_signal(self):
         self.had_signal = False
+        self.onset_frames = 0
+        self.trailing_silence_frames = 0
 
-    def _calculate_level(self, samples):
-        total = 0
+    def _update_noise_floor(self, level, rise_rate):
+        rate = self.floor_fall_rate if level < self.noise_floor else rise_rate
+        self.noise_floor = max(self.min_noise_floor, self.noise_floor + (level - self.noise_floor) * rate)
 
-        for i in range(len(samples)):
-            linear = mu_law_linear_to_sample(samples[i])
-            total = total + linear * linear
+    @staticmethod
+    def _calculate_energy(samples):
+        return sum(map(mu_law_squared_table.__getitem__, samples))
 
-        return math.sqrt(total / len(samples))
+    @staticmethod
+    def _calculate_level(energy, length):
+        return math.sqrt(energy / length)
 
 # https://docs.fileformat.com/audio/wav/
-def wave_header():
+def wave_header(channels = 1, data_size = None):
     sample_rate = 8000
     bits_per_sample = 8
-    channels = 1
 
     header = b""
     header = header + b"RIFF"
-    # We don't know the file size yet, opting for maximum
-    header = header + 0xffffffff.to_bytes(4, 'little')
+    # If we don't know the file size yet, opting for maximum
+    header = header + (0xffffffff if data_size is None else 36 + data_size).to_bytes(4, 'little')
     header = header + b"WAVEfmt "
     header = header + len(header).to_bytes(4, 'little')
     # ITU G.711 u-law (PCMU) = 0x0007
@@ -78,8 +122,8 @@ def wave_header():
     header = header + int(bits_per_sample * channels / 8).to_bytes(2, 'little')
     header = header + bits_per_sample.to_bytes(2, 'little')
     header = header + b"data"
-    # We don't know the data size yet, opting for maximum
-    header = header + 0xffffffff.to_bytes(4, 'little')
+    # If we don't know the data size yet, opting for maximum
+    header = header + (0xffffffff if data_size is None else data_size).to_bytes(4, 'little')
 
     return header
 
@@ -158,3 +202,39 @@ mu_decompress_table = [
 def mu_law_linear_to_sample(byte):
     return mu_decompress_table[byte]
 
+mu_law_squared_table = [sample * sample for sample in mu_decompress_table]
+
+
+
+# Bulk conversion tables. The encode table is indexed by the 16-bit sample reinterpreted as unsigned,
+# the decode tables map a mu-law byte to the low and high byte of its little-endian linear sample.
+mu_law_encode_table = bytes(linear_to_mu_law_sample(i - 65536 if i > 32767 else i) for i in range(65536))
+mu_law_decode_low_table = bytes(sample & 0xFF for sample in mu_decompress_table)
+mu_law_decode_high_table = bytes((sample >> 8) & 0xFF for sample in mu_decompress_table)
+
+if numpy is not None:
+    mu_law_encode_array = numpy.frombuffer(mu_law_encode_table, dtype=numpy.uint8)
+    mu_law_decode_array = numpy.array(mu_decompress_table, dtype='<i2')
+
+# Expects signed 16-bit little-endian samples, the buffer length must be even
+def linear_to_mu_law(pcm):
+    if numpy is not None:
+        return mu_law_encode_array[numpy.frombuffer(pcm, dtype='<u2')].tobytes()
+
+    samples = memoryview(pcm).cast('B').cast('H')
+    if sys.byteorder == 'big':
+        samples = array.array('H', samples)
+        samples.byteswap()
+
+    return bytes(map(mu_law_encode_table.__getitem__, samples))
+
+# Returns signed 16-bit little-endian samples
+def mu_law_to_linear(mu_law):
+    if numpy is not None:
+        return mu_law_decode_array[numpy.frombuffer(mu_law, dtype=numpy.uint8)].tobytes()
+
+    pcm = bytearray(len(mu_law) * 2)
+    pcm[0::2] = bytes(mu_law).translate(mu_law_decode_low_table)
+    pcm[1::2] = bytes(mu_law).translate(mu_law_decode_high_table)
+
+    return bytes(pcm)
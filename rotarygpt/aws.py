@@ -1,41 +1,40 @@
 import os
-import socket
-import ssl
 import json
 from hashlib import sha256
 import hmac
 import datetime
+import threading
+
+from rotarygpt.http import HTTPError, connection_pool
 
 class PollyRequest:
     default_voice = "Daniel"
-    voice = default_voice
 
     def __init__(self, chunk_callback, shutdown_event):
         self.chunk_callback = chunk_callback
         self.shutdown_event = shutdown_event
 
-        self.socket = None
+        self.connection = None
+        self.response = None
+        # Set from another thread when the caller interrupts the speech
+        self.cancelled = False
+        # Guards the connection between the reader releasing it and a cancel shutting it down
+        self.lock = threading.Lock()
         self.target_host = "polly.eu-west-1.amazonaws.com"
         self.target_port = 443
 
         self.aws_key = os.environ['AWS_ACCESS_KEY']
         self.aws_secret = os.environ['AWS_SECRET_KEY']
 
-    def send_request(self, text):
+    def send_request(self, text, voice = None):
         parameters = {
-          "VoiceId": PollyRequest.voice,
+          "VoiceId": voice if voice is not None else self.default_voice,
           "OutputFormat": "pcm",
           "Text": text,
           "Engine": "neural",
           "SampleRate": "8000"
         }
 
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        context = ssl.create_default_context()
-
-        self.socket = context.wrap_socket(client_socket, server_hostname=self.target_host)
-        self.socket.connect((self.target_host, self.target_port))
-
         http_body = json.dumps(parameters).encode('utf-8')
         timestamp = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ').encode('ascii')
         signature = self._get_signature(timestamp, http_body)
@@ -44,49 +43,43 @@ class PollyRequest:
                         b"/eu-west-1/polly/aws4_request, SignedHeaders=content-type;host;x-amz-date, Signature=" + \
                         signature.encode('ascii')
 
-        http_header = b"""POST /v1/speech HTTP/1.1
+        http_header = (b"""POST /v1/speech HTTP/1.1
 Host: """ + self.target_host.encode('ascii') + b"""
 Content-Type: application/json
 Content-Length: """ + str(len(http_body)).encode('ascii') + b"""
 X-Amz-Date: """ + timestamp + b"""
-Authorization: """ + authorization + b"""
-Connection: close""".replace(b"\n", b"\r\n")
-
-        self.socket.sendall(http_header + b"\r\n\r\n" + http_body)
-
-    def get_response(self):
-        response = b""
-        body = b""
-
-        while not self.shutdown_event.is_set():
-            chunk = self.socket.recv(1024)
-            response += chunk
+Authorization: """ + authorization).replace(b"\n", b"\r\n")
 
-            if b'\r\n\r\n' in response:
-                header, body = response.split(b'\r\n\r\n', 1)
-                print(header)
-                break
+        connection, self.response = connection_pool.request(self.target_host, http_header + b"\r\n\r\n" + http_body,
+                                                            self.target_port)
+        with self.lock:
+            self.connection = connection
 
-        while not self.shutdown_event.is_set():
-            while b"\r\n" not in body and not self.shutdown_event.is_set():
-                body += self.socket.recv(1024)
-
-            if self.shutdown_event.is_set():
-                break
-
-            chunk_size, chunk = body.split(b"\r\n", 1)
-            chunk_size = int(chunk_size, 16)
-
-            if 0 == chunk_size:
-                break
-
-            while len(chunk) < chunk_size + 2:
-                chunk += self.socket.recv(1024)
-
-            chunk, body = chunk[:chunk_size], chunk[chunk_size + 2:]
-
-            self.chunk_callback(chunk)
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            # Only while this request owns it, once back in the pool it may serve the next request
+            if self.connection is not None:
+                # Wakes up a read blocked in get_response
+                self.connection.shutdown()
 
+    def get_response(self):
+        try:
+            if self.response.status != 200:
+                raise Exception(f"Polly returned an error: {self.response.read().decode('utf-8', 'replace')}")
+            # The PCM is streamed to the callback as it arrives
+            self.response.read_chunks(self.chunk_callback, self._is_stopped)
+        except (OSError, HTTPError):
+            if not self.cancelled:
+                raise
+        finally:
+            # Back in the pool, a late cancel must not shut it down
+            with self.lock:
+                connection, self.connection = self.connection, None
+            connection_pool.release(connection)
+
+    def _is_stopped(self):
+        return self.cancelled or self.shutdown_event.is_set()
 
     def _get_signature(self, timestamp, http_body):
         # This is the most convoluted way to sign a request I've ever seen
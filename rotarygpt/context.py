@@ -0,0 +1,143 @@
+import logging
+import os
+import re
+import threading
+
+from rotarygpt.openai import GPTRequest
+
+# Roughly how the GPT tokenizer splits text: short runs of letters or digits, and each punctuation mark. English
+# words average about four characters a token, this errs on the high side.
+token_regex = re.compile(r'[^\W\d_]{1,4}|\d{1,3}|[^\w\s]')
+
+
+def estimate_tokens(text):
+    if not text:
+        return 0
+    return len(token_regex.findall(text))
+
+
+def estimate_message_tokens(message):
+    # Every message costs a few tokens of framing on top of its content
+    # https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+    tokens = 4 + estimate_tokens(message.get('content')) + estimate_tokens(message.get('name'))
+    if 'function_call' in message:
+        tokens += estimate_tokens(message['function_call']['name'])
+        tokens += estimate_tokens(message['function_call']['arguments'])
+    return tokens
+
+
+# The history of a call sent with every GPT request. It's kept within a token budget so requests don't grow turn by
+# turn: function results of older turns are shortened, and once that's not enough the older turns are summarized in
+# the background. The newest turns always go out verbatim.
+class ConversationContext:
+    # Turns of the caller, with everything that followed them, never shortened or summarized
+    recent_turns = 2
+    # Characters of a function result kept once its turn is no longer recent
+    old_function_result_length = 300
+    summary_prompt = "Summarize the phone call below in a few sentences, for yourself to continue it later. " + \
+                     "Keep names, numbers, decisions and anything the caller asked for that may come up again."
+
+    def __init__(self, token_budget = None):
+        if token_budget is None:
+            token_budget = int(os.environ.get('ROTARYGPT_CONTEXT_TOKEN_BUDGET', 1500))
+        self.token_budget = token_budget
+
+        # Messages not covered by the summary, oldest first
+        self.items = []
+        self.summary = None
+        self.summarizing = False
+        self.lock = threading.Lock()
+
+    def append(self, item):
+        with self.lock:
+            self.items.append(item)
+
+    def messages(self, shutdown_event):
+        # The messages to send, within the budget as far as the recent turns allow
+        with self.lock:
+            items = list(self.items)
+            summary = self.summary
+            summarizing = self.summarizing
+
+        recent_start = self._recent_start(items)
+        old_items = [self._shorten(item) for item in items[:recent_start]]
+        recent_items = items[recent_start:]
+
+        summary_messages = []
+        if summary is not None:
+            summary_messages = [{"role": "system", "content": "Summary of the call so far: " + summary}]
+
+        tokens = sum(map(estimate_message_tokens, summary_messages + old_items + recent_items))
+        if tokens <= self.token_budget:
+            return summary_messages + old_items + recent_items
+
+        if not summarizing and old_items:
+            self._start_summary(items[:recent_start], summary, shutdown_event)
+
+        # Until the summary is there, the oldest turns are left out, they will be in it
+        while old_items and tokens > self.token_budget:
+            dropped = [old_items.pop(0)]
+            # A function result makes no sense without its call
+            while old_items and old_items[0]['role'] == 'function':
+                dropped.append(old_items.pop(0))
+            tokens -= sum(map(estimate_message_tokens, dropped))
+
+        return summary_messages + old_items + recent_items
+
+    def _recent_start(self, items):
+        turns = 0
+        for index in range(len(items) - 1, -1, -1):
+            if items[index]['role'] == 'user':
+                turns += 1
+                if turns == self.recent_turns:
+                    return index
+        return 0
+
+    def _shorten(self, item):
+        if item['role'] != 'function' or len(item['content']) <= self.old_function_result_length:
+            return item
+        return dict(item, content=item['content'][:self.old_function_result_length] + '...')
+
+    def _start_summary(self, items, summary, shutdown_event):
+        with self.lock:
+            self.summarizing = True
+        thread = threading.Thread(target=self._summarize, args=(items, summary, shutdown_event),
+                                  daemon=True, name='Summary')
+        thread.start()
+
+    def _summarize(self, items, summary, shutdown_event):
+        logging.debug(f'Summarizing {len(items)} messages of the conversation')
+        try:
+            lines = []
+            if summary is not None:
+                lines.append("Earlier: " + summary)
+            for item in items:
+                lines.append(self._transcript_line(self._shorten(item)))
+
+            gpt_request = GPTRequest(shutdown_event)
+            gpt_request.send_request([], [{"role": "user", "content": self.summary_prompt + "\n\n" + '\n'.join(lines)}])
+            message = gpt_request.get_response()
+            if message is None or not message.get('content'):
+                return
+
+            with self.lock:
+                # Only appended to meanwhile, the summarized messages are still the first ones
+                self.summary = message['content'].strip()
+                del self.items[:len(items)]
+            logging.info(f'Conversation summary: {self.summary}')
+        except Exception as error:
+            # The old turns keep being left out, the next request tries again
+            logging.warning(f'Could not summarize the conversation: {error}')
+        finally:
+            with self.lock:
+                self.summarizing = False
+
+    @staticmethod
+    def _transcript_line(item):
+        if item['role'] == 'user':
+            return "Caller: " + item['content']
+        if item['role'] == 'function':
+            return f"Function {item['name']} returned: {item['content']}"
+        if 'function_call' in item:
+            return f"Agent called {item['function_call']['name']} with {item['function_call']['arguments']}"
+        return "Agent: " + (item['content'] or '')
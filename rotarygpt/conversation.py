@@ -1,36 +1,159 @@
+import asyncio
+import collections
 import json
 import logging
+import os
+import queue
+import re
 import threading
-import time
 
-from rotarygpt.audio import PCMUSilenceDetector, linear_to_mu_law_sample
+from rotarygpt.audio import PCMUSilenceDetector, linear_to_mu_law
 from rotarygpt.aws import PollyRequest
+from rotarygpt.context import ConversationContext
+from rotarygpt.http import connection_pool
 from rotarygpt.openai import WhisperRequest, GPTRequest
-from rotarygpt.utils import clear_queue
+
+
+# The end of a sentence, seen once the next one has started. Decimal points and the like have no space after them.
+sentence_end_regex = re.compile(r'[.!?…:;](?=\s)|\n')
+
+
+class SentenceSplitter:
+    # Shorter pieces wait for the next sentence, Polly sounds choppy on fragments
+    min_length = 12
+
+    def __init__(self):
+        self.text = ''
+
+    def add(self, text):
+        self.text += text
+
+        sentences = []
+        start = 0
+        for match in sentence_end_regex.finditer(self.text):
+            sentence = self.text[start:match.end()].strip()
+            if len(sentence) >= self.min_length:
+                sentences.append(sentence)
+                start = match.end()
+
+        self.text = self.text[start:]
+        return sentences
+
+    def finish(self):
+        rest = self.text.strip()
+        self.text = ''
+        return rest
+
+
+# A GPT reply read in the background as it streams, cut into sentences so Polly can start on the first one
+# while the rest is generated
+class StreamedReply:
+    def __init__(self, gpt_request):
+        self.gpt_request = gpt_request
+        self.sentences = queue.SimpleQueue()
+        self.splitter = SentenceSplitter()
+        # Set on the first text, or at the end for a reply without any like a function call
+        self.started = threading.Event()
+        self.parts = []
+        self.message = None
+        self.error = None
+        self.future = None
+
+    def start(self, run_in_background):
+        self.future = run_in_background(self._receive)
+
+    def wait(self):
+        self.future.result()
+
+    def text(self):
+        return ''.join(self.parts)
+
+    def cancel(self):
+        self.gpt_request.cancel()
+
+    def _receive(self):
+        try:
+            self.message = self.gpt_request.get_streamed_response(self._on_text)
+        except Exception as error:
+            self.error = error
+        finally:
+            rest = self.splitter.finish()
+            if rest and not self.gpt_request.cancelled:
+                self.sentences.put(rest)
+            # Marks the end for the Polly synthesis
+            self.sentences.put(None)
+            self.started.set()
+
+    def _on_text(self, text):
+        self.parts.append(text)
+        self.started.set()
+        for sentence in self.splitter.add(text):
+            self.sentences.put(sentence)
 
 
 class Conversation:
-    def __init__(self, audio_chunk_queue_in, audio_chunk_queue_out, function_manager):
-        self.audio_chunk_queue_in = audio_chunk_queue_in
-        self.audio_chunk_queue_out = audio_chunk_queue_out
+    wait_speaker_delay = 4.0
+    # Inbound audio kept while the agent speaks, so the start of an interruption reaches Whisper
+    pre_roll_duration = 0.5
+    # Speech that has to continue after its onset before the agent stops talking, coughs and echo are shorter
+    barge_in_duration = 0.2
+    # Rough speaking rate, for estimating how much of the reply was heard when Polly is still streaming
+    characters_per_second = 15
+    # Idle connections made ready ahead of the requests. When the call is answered the first Whisper request takes
+    # the OpenAI one, while the caller speaks it's there for the GPT request that follows.
+    upstream_connections = [('api.openai.com', 443, 1), ('polly.eu-west-1.amazonaws.com', 443, 1)]
+    # Functions called lately that are offered to GPT again whatever the caller says next
+    recently_used_functions = 3
+
+    def __init__(self, audio_in, audio_out, function_manager, prompt_store, loop, digit_collector = None):
+        # Ring buffers of 20ms frames, the RTP side reads and writes the other end
+        self.audio_in = audio_in
+        self.audio_out = audio_out
         self.function_manager = function_manager
-
-        self.conversation_items = []
+        self.prompt_store = prompt_store
+        # The event loop running the call's RTP, used for timers instead of extra threads
+        self.loop = loop
+        # Dialed shortcuts, None when the phone sends no digits or none are configured
+        self.digit_collector = digit_collector
+
+        self.conversation_items = ConversationContext()
+        # Picks the functions offered to GPT
+        self.last_user_message = None
+        self.used_functions = collections.deque(maxlen=self.recently_used_functions)
         self.current_whisper_request = None
-        self.silence_detector = PCMUSilenceDetector()
+        self.silence_detector = PCMUSilenceDetector(
+            end_of_turn_timeout=float(os.environ.get('ROTARYGPT_END_OF_TURN_TIMEOUT', 0.5))
+        )
         self.shutdown_event = None
         self.response_arrived_event = threading.Event()
+        self.polly_odd_byte = b''
+        self.polly_request = None
+        # Per call, changing the accent in one call leaves the others alone
+        self.voice = PollyRequest.default_voice
+        # Set when the reply is interrupted, the Polly synthesis stops before the next sentence
+        self.speech_cancelled = False
+        self.pre_roll = collections.deque(maxlen=round(self.pre_roll_duration / 0.02))
+        self.barge_in_frames = 0
+        # Where the reply being spoken starts in the stream of the out buffer, after whatever was queued before it
+        self.reply_start = 0
+        self.warmed_up_turn = False
+
+    @classmethod
+    def warm_up(cls):
+        for host, port, count in cls.upstream_connections:
+            connection_pool.warm_up(host, port, count)
 
     def start(self, shutdown_event = None):
         logging.info("Conversation started")
         self.shutdown_event = shutdown_event
-        PollyRequest.voice = PollyRequest.default_voice
 
         try:
             self._greet()
 
             while not self.shutdown_event.is_set():
-                self._start_whisper_request()
+                # After a barge-in the request is already running with the start of the speech in it
+                if self.current_whisper_request is None:
+                    self._start_whisper_request()
                 self._receive_audio()
                 if self.shutdown_event.is_set():
                     break
@@ -40,27 +163,16 @@ class Conversation:
                 self._start_wait_speaker()
                 self._finish_current_whisper_request()
 
-                agent_text = None
-                while agent_text is None and not self.shutdown_event.is_set():
-                    agent_text = self._send_gpt_request()
+                reply = None
+                while reply is None and not self.shutdown_event.is_set():
+                    reply = self._send_gpt_request()
                     if self.shutdown_event.is_set():
                         break
 
                 if self.shutdown_event.is_set():
                     break
 
-                self._send_polly_request(agent_text)
-
-                logging.debug("Polly fully returned, waiting for audio out queue to be consumed")
-
-                while not self.audio_chunk_queue_out.empty() and not self.shutdown_event.is_set():
-                    # Wait until the speech is finished, otherwise the Whisper request times out.
-                    pass
-
-                logging.debug("Audio out queue empty")
-
-                clear_queue(self.audio_chunk_queue_in)
-                self.silence_detector.reset_had_signal()
+                self._speak(reply)
 
         except:
             logging.exception('Exception during the conversation')
@@ -74,24 +186,233 @@ class Conversation:
         self.response_arrived_event.set()
 
         logging.debug("Polly chunk arrived, sending to RTP")
-        converted_chunk = b''
-        for i in range(0, len(chunk), 2):
-            sample = int.from_bytes(chunk[i:i+2], 'little', signed=True)
-            mu_sample = linear_to_mu_law_sample(sample)
-            converted_chunk += mu_sample.to_bytes(1, 'little')
 
-        self.audio_chunk_queue_out.put(converted_chunk)
+        # HTTP chunks are not aligned to samples, carrying over the odd byte to the next chunk. The chunk is a view
+        # into the receive buffer, converted in place rather than joined to the odd byte.
+        if self.polly_odd_byte and chunk:
+            self.audio_out.write(linear_to_mu_law(self.polly_odd_byte + chunk[:1]))
+            chunk = chunk[1:]
+            self.polly_odd_byte = b''
+
+        even_length = len(chunk) & ~1
+        if even_length:
+            self.audio_out.write(linear_to_mu_law(chunk[:even_length]))
+        if even_length < len(chunk):
+            self.polly_odd_byte = bytes(chunk[even_length:])
 
     def _receive_audio(self):
         logging.debug("Receiving audio")
         while not self.shutdown_event.is_set():
-            chunk = self.audio_chunk_queue_in.get()
+            shortcut = self._poll_shortcut()
+            if shortcut is not None:
+                self._run_shortcut(shortcut)
+                continue
+
+            chunk = self.audio_in.read_frame(timeout=0.2)
+            if chunk is None:
+                continue
+
+            if not self.audio_out.drained():
+                # A prompt is playing, the caller can talk over it
+                if not self._detect_barge_in(chunk):
+                    continue
+                self.audio_out.flush()
+                self._send_pre_roll()
+                continue
+
+            self.pre_roll.clear()
+            self.current_whisper_request.add_audio_chunk(chunk)
+            if self.silence_detector.add_sample_and_detect_silence(chunk):
+                self.warmed_up_turn = False
+                break
+
+            if self.silence_detector.had_signal and not self.warmed_up_turn:
+                # The caller started speaking, the connections for the reply get ready meanwhile
+                self.warmed_up_turn = True
+                self.loop.call_soon_threadsafe(self.loop.run_in_executor, None, self.warm_up)
+
+    def _speak(self, reply):
+        # Caller audio queued up while Whisper and GPT were busy is stale, barge-in only listens from here on
+        self.audio_in.flush()
+        self.pre_roll.clear()
+        self.barge_in_frames = 0
+        self.silence_detector.reset_had_signal()
+
+        self.reply_start = self.audio_out.write_position
+        self.speech_cancelled = False
+        self.polly_request = None
+
+        # Synthesizing sentence by sentence in the background, this thread listens to the caller meanwhile
+        polly_errors = []
+        polly_future = self._run_in_background(self._speak_sentences, reply, polly_errors)
+
+        barged_in = False
+        polly_finished = False
+        shortcut = None
+        while not self.shutdown_event.is_set():
+            if polly_future.done() and self.audio_out.drained():
+                break
+
+            # Dialing a shortcut interrupts the agent like speaking does
+            shortcut = self._poll_shortcut()
+            if shortcut is not None:
+                barged_in = True
+                polly_finished = polly_future.done()
+                break
+
+            chunk = self.audio_in.read_frame(timeout=0.02)
+            if chunk is None:
+                continue
+
+            if self._detect_barge_in(chunk):
+                barged_in = True
+                polly_finished = polly_future.done()
+                break
+
+        # The rest of the reply is not wanted after an interruption, nor on shutdown
+        self.speech_cancelled = True
+        reply.cancel()
+        if self.polly_request is not None:
+            self.polly_request.cancel()
+        # What was read from the buffer went out to the caller, the rest of the reply is thrown away
+        played_size = max(0, self.audio_out.read_position - self.reply_start)
+        # A Polly synthesis waiting for room in the buffer gets it, and sees the cancellation after that write
+        if barged_in:
+            self.audio_out.flush()
+        polly_future.result()
+        reply.wait()
+        if not barged_in:
+            if reply.error is not None:
+                raise reply.error
+            if polly_errors:
+                raise polly_errors[0]
+
+        text = reply.text()
+        message = {"role": "assistant", "content": text}
+
+        if not barged_in:
+            logging.info("Agent message: \x1b[33;1m" + text + "\x1b[0m")
+            self.conversation_items.append(message)
+            logging.debug("Audio out buffer drained")
+            self.pre_roll.clear()
+            self.audio_in.flush()
+            self.silence_detector.reset_had_signal()
+            return
+
+        self.audio_out.flush()
+        # With the padding of the last frame, the words are spread over it too
+        total_size = self.audio_out.write_position - self.reply_start
+        if not polly_finished:
+            total_size = max(total_size, len(text) / self.characters_per_second * 8000)
+
+        # The history keeps only what the caller heard
+        played_text = self._played_text(text, played_size, total_size)
+        if played_text:
+            message['content'] = played_text
+            self.conversation_items.append(message)
+        logging.info("Agent interrupted after: \x1b[33;1m" + played_text + "\x1b[0m")
+
+        if shortcut is not None:
+            self._run_shortcut(shortcut)
+            return
 
-            if self.current_whisper_request is not None and self.audio_chunk_queue_out.empty():
-                self.current_whisper_request.add_audio_chunk(chunk)
-                if self.silence_detector.add_sample_and_detect_silence(chunk):
+        self._start_whisper_request()
+        self._send_pre_roll()
+
+    def _speak_sentences(self, reply, errors):
+        try:
+            while not self.speech_cancelled:
+                sentence = reply.sentences.get()
+                if sentence is None:
                     break
 
+                logging.debug("Sending Polly request")
+                self.polly_odd_byte = b''
+                self.polly_request = PollyRequest(self.on_polly_chunk, self.shutdown_event)
+                self.polly_request.send_request(sentence, self.voice)
+                if self.speech_cancelled:
+                    # Cancelled before the request was there to be cancelled
+                    self.polly_request.cancel()
+                self.polly_request.get_response()
+
+            self.audio_out.pad_frame()
+        except Exception as error:
+            errors.append(error)
+
+    def _detect_barge_in(self, chunk):
+        # The frame is only valid until the next read, the pre-roll keeps a copy
+        self.pre_roll.append(bytes(chunk))
+
+        if self.silence_detector.add_sample_and_detect_silence(chunk) or not self.silence_detector.had_signal:
+            self.barge_in_frames = 0
+            return False
+
+        self.barge_in_frames += 1
+        if self.barge_in_frames < round(self.barge_in_duration / 0.02):
+            return False
+
+        logging.info("Caller barged in")
+        self.barge_in_frames = 0
+        return True
+
+    def _poll_shortcut(self):
+        if self.digit_collector is None:
+            return None
+        return self.digit_collector.poll()
+
+    def _run_shortcut(self, shortcut):
+        logging.info(f'Shortcut {shortcut.digits} dialed, calling {shortcut.function}')
+
+        # The confirmation plays while the function runs, it only has to be said, not waited for
+        self.audio_out.flush()
+        for frame in self.digit_collector.shortcut_store.confirmation_frames(shortcut, self.shutdown_event):
+            self.audio_out.write(frame)
+
+        self._use_function(shortcut.function)
+        function_response = self.function_manager.call(shortcut.function, dict(shortcut.arguments), self)
+        logging.info("Function response: \x1b[32;1m" + function_response + "\x1b[0m")
+        # Recorded as if GPT had called the function, so it knows what happened
+        self.conversation_items.append({
+            "role": "assistant",
+            "content": None,
+            "function_call": {"name": shortcut.function, "arguments": json.dumps(shortcut.arguments)}
+        })
+        self.conversation_items.append(
+            {"role": "function", "content": function_response, "name": shortcut.function}
+        )
+
+        # The tones are in the turn Whisper has heard so far, starting it over
+        self._discard_current_whisper_request()
+        self._start_whisper_request()
+        self.pre_roll.clear()
+        self.audio_in.flush()
+        self.silence_detector.reset_had_signal()
+
+    def _use_function(self, name):
+        if name in self.used_functions:
+            self.used_functions.remove(name)
+        self.used_functions.append(name)
+
+    def _send_pre_roll(self):
+        for chunk in self.pre_roll:
+            self.current_whisper_request.add_audio_chunk(chunk)
+        self.pre_roll.clear()
+
+    def _played_text(self, text, played_size, total_size):
+        # Polly gives no timings, assuming the words are spread evenly over the audio
+        if total_size <= 0:
+            return ''
+        played_length = round(len(text) * max(0.0, min(1.0, played_size / total_size)))
+        if played_length >= len(text):
+            return text
+
+        played_text = text[:played_length]
+        if not text[played_length].isspace():
+            # Dropping the word that was cut off
+            played_text = played_text.rsplit(' ', 1)[0] if ' ' in played_text else ''
+
+        return played_text.rstrip() + '...' if played_text.strip() else ''
+
     def _finish_current_whisper_request(self):
         logging.debug("Sending Whisper request")
         self.current_whisper_request.finish_request()
@@ -104,6 +425,7 @@ class Conversation:
             self.conversation_items.append(
                 {"role": "user", "content": text}
             )
+            self.last_user_message = text
             logging.info("User message: \x1b[31;1m" + text + "\x1b[0m")
 
     def _discard_current_whisper_request(self):
@@ -120,22 +442,36 @@ class Conversation:
     def _send_gpt_request(self):
         logging.debug("Sending GPT request")
         gpt_request = GPTRequest(self.shutdown_event)
-        gpt_request.send_request(self.function_manager.available_functions(), self.conversation_items)
-        message = gpt_request.get_response()
+        function_definitions = self.function_manager.available_functions(self.last_user_message, self.used_functions)
+        gpt_request.send_request(function_definitions,
+                                 self.conversation_items.messages(self.shutdown_event), stream=True)
+        reply = StreamedReply(gpt_request)
+        reply.start(self._run_in_background)
+
+        # Speaking starts with the first sentence, a function call has no text and is only complete at the end
+        reply.started.wait()
+        if reply.parts:
+            return reply
+
+        reply.wait()
+        if reply.error is not None:
+            raise reply.error
+        message = reply.message
 
         if message is None:
             return None
 
-        self.conversation_items.append(
-            message
-        )
-
         if 'function_call' in message:
+            self.conversation_items.append(
+                message
+            )
             logging.info('Function call: ' + str(message))
+            self._use_function(message['function_call']['name'])
 
             function_response = self.function_manager.call(
                 message['function_call']['name'],
-                json.loads(message['function_call']['arguments'])
+                json.loads(message['function_call']['arguments']),
+                self
             )
             self.conversation_items.append(
                 {"role": "function", "content": function_response, "name": message['function_call']['name']}
@@ -143,57 +479,45 @@ class Conversation:
             logging.info("Function response: \x1b[32;1m" + function_response + "\x1b[0m")
             return None
 
-        logging.info("Agent message: \x1b[33;1m" + message['content'] + "\x1b[0m")
-
-        return message['content']
-
-    def _send_polly_request(self, text):
-        logging.debug("Sending Polly request")
-        polly_request = PollyRequest(self.on_polly_chunk, self.shutdown_event)
-        polly_request.send_request(text)
-        polly_request.get_response()
+        return reply
 
     def _greet(self):
         logging.debug("Sending greeting")
-        self._play_pcm("audio/greeting.pcm")
+        self._play_prompt("greeting")
         self.conversation_items.append(
             {"role": "assistant", "content": "Hallo. How can I help?"}
         )
 
     def _send_error_message(self):
         logging.debug("Sending error message")
-        self._play_pcm("audio/error-message.pcm")
+        self._play_prompt("error-message")
 
     def _start_wait_speaker(self):
         self.response_arrived_event.clear()
-        thread = threading.Thread(target=self._speak_if_waiting_too_long, daemon=True, name='Wait speaker')
-        thread.start()
+        # Playing from the executor, the loop must not wait for room in the out buffer
+        self.loop.call_soon_threadsafe(self.loop.call_later, self.wait_speaker_delay, self.loop.run_in_executor, None,
+                                       self._speak_if_waiting_too_long)
 
     def _speak_if_waiting_too_long(self):
-        wait_time = 4.0
-        time.sleep(wait_time)
-        if self.response_arrived_event.is_set():
+        if self.response_arrived_event.is_set() or self.shutdown_event.is_set():
             return
 
-        logging.info(f"Waited longer than {wait_time}s to respond, sending wait a moment")
-        self._play_pcm("audio/one-second.pcm")
+        logging.info(f"Waited longer than {self.wait_speaker_delay}s to respond, sending wait a moment")
+        self._play_prompt("one-second")
         self.conversation_items.append(
             {"role": "assistant", "content": "One second, bitte."}
         )
 
-    def _play_pcm(self, file_path):
-        converted_chunk = b''
-        with open(file_path, 'rb') as file:
-            while not self.shutdown_event.is_set():
-                chunk = file.read(2)
-                if chunk == b"":
-                    break
-
-                sample = int.from_bytes(chunk, 'little', signed=True)
-                mu_sample = linear_to_mu_law_sample(sample)
-                converted_chunk += mu_sample.to_bytes(1, 'little')
+    def _run_in_background(self, function, *args):
+        # On the executor serve() sizes for the calls, not a new thread per turn. The future can be waited on from
+        # this thread, unlike the loop's own.
+        async def run():
+            return await self.loop.run_in_executor(None, function, *args)
+        return asyncio.run_coroutine_threadsafe(run(), self.loop)
 
-        self.audio_chunk_queue_out.put(converted_chunk)
+    def _play_prompt(self, name):
+        for frame in self.prompt_store.frames(name):
+            self.audio_out.write(frame)
 
     def _germanize(self, text):
         return text.\
@@ -0,0 +1,181 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from hashlib import sha256
+
+from rotarygpt.audio import linear_to_mu_law
+from rotarygpt.aws import PollyRequest
+
+# 20ms of 8 bit PCMU
+FRAME_SIZE = 160
+MU_LAW_SILENCE = b'\xff'
+
+# Event codes 0-15 of RFC 4733 telephone events
+# https://datatracker.ietf.org/doc/html/rfc4733#section-3.2
+event_digits = '0123456789*#ABCD'
+
+
+class Shortcut:
+    def __init__(self, digits, function, arguments, confirmation):
+        self.digits = digits
+        self.function = function
+        self.arguments = arguments
+        self.confirmation = confirmation
+
+
+# Digit sequences that call a function directly, skipping Whisper and GPT. The confirmations are synthesized once and
+# cached on disk, so dialing a shortcut answers as fast as a prompt.
+class ShortcutStore:
+    def __init__(self, cache_directory):
+        self.cache_directory = cache_directory
+        self.shortcuts = {}
+        self.confirmations = {}
+        # Confirmations being synthesized, to their events set once done
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def load(self, path):
+        # {"0": {"function": "lights__all_lights_off", "arguments": {}, "confirmation": "All lights are off."}}
+        with open(path) as file:
+            definitions = json.load(file)
+
+        for digits, definition in definitions.items():
+            if not digits or any(digit not in event_digits for digit in digits):
+                logging.warning(f'Ignoring shortcut {digits}, it can only have the digits {event_digits}')
+                continue
+
+            self.shortcuts[digits] = Shortcut(digits, definition['function'], definition.get('arguments', {}),
+                                              definition.get('confirmation'))
+            logging.debug(f'Registered shortcut {digits} for {definition["function"]}')
+
+    def prepare(self, shutdown_event):
+        # Synthesizing the missing confirmations ahead of the first call, meant for a background thread
+        for shortcut in self.shortcuts.values():
+            if shutdown_event.is_set():
+                return
+            try:
+                self.confirmation_frames(shortcut, shutdown_event)
+            except Exception:
+                logging.exception(f'Could not prepare the confirmation of shortcut {shortcut.digits}')
+
+    def confirmation_frames(self, shortcut, shutdown_event):
+        if not shortcut.confirmation:
+            return []
+
+        text = shortcut.confirmation
+        # The lock only guards the dictionaries, Polly is called outside of it so other shortcuts aren't held up
+        with self.lock:
+            frames = self.confirmations.get(text)
+            if frames is not None:
+                return frames
+            pending = self.pending.get(text)
+            synthesizing = pending is None
+            if synthesizing:
+                pending = self.pending[text] = threading.Event()
+
+        if not synthesizing:
+            # Another thread is already on the same confirmation
+            while not pending.wait(0.1):
+                if shutdown_event.is_set():
+                    return []
+            # Cached by now, unless that one was cut short or failed, this thread tries then
+            return self.confirmation_frames(shortcut, shutdown_event)
+
+        try:
+            # Always the default voice, the cache doesn't follow accent changes
+            key = sha256(f'{PollyRequest.default_voice}\n{text}'.encode('utf-8')).hexdigest()[:16]
+            cache_path = os.path.join(self.cache_directory, key + '.ulaw')
+            complete = True
+            try:
+                with open(cache_path, 'rb') as file:
+                    audio = file.read()
+            except FileNotFoundError:
+                audio, complete = self._synthesize(text, cache_path, shutdown_event)
+
+            frames = [audio[i:i + FRAME_SIZE] for i in range(0, len(audio), FRAME_SIZE)]
+            if complete:
+                # A clip cut short by a hang-up is only good for that call, the next one synthesizes it again
+                with self.lock:
+                    self.confirmations[text] = frames
+            return frames
+        finally:
+            with self.lock:
+                del self.pending[text]
+            pending.set()
+
+    def _synthesize(self, text, cache_path, shutdown_event):
+        # Returns the audio and whether it was synthesized to the end
+        logging.info(f'Synthesizing shortcut confirmation to {cache_path}')
+
+        pcm = bytearray()
+        polly_request = PollyRequest(pcm.extend, shutdown_event)
+        polly_request.send_request(text, PollyRequest.default_voice)
+        polly_request.get_response()
+
+        audio = linear_to_mu_law(pcm[:len(pcm) & ~1])
+        # Padding the last frame so that every frame is exactly 20ms
+        if len(audio) % FRAME_SIZE:
+            audio += MU_LAW_SILENCE * (FRAME_SIZE - len(audio) % FRAME_SIZE)
+
+        if shutdown_event.is_set():
+            # Possibly cut short, not worth keeping
+            return audio, False
+
+        os.makedirs(self.cache_directory, exist_ok=True)
+        temporary_path = cache_path + '.tmp'
+        with open(temporary_path, 'wb') as file:
+            file.write(audio)
+        os.replace(temporary_path, cache_path)
+
+        return audio, True
+
+
+# Collects the digits of one call into shortcuts. Digits arrive from the event loop, the conversation thread polls for
+# a complete shortcut between frames.
+class DigitCollector:
+    # Seconds to wait for the next digit when the digits so far are a shortcut but also the start of a longer one
+    inter_digit_timeout = 1.5
+
+    def __init__(self, shortcut_store):
+        self.shortcut_store = shortcut_store
+        self.digits_received = queue.SimpleQueue()
+        self.digits = ''
+        self.last_digit_time = None
+
+    def add(self, digit):
+        self.digits_received.put((digit, time.monotonic()))
+
+    def poll(self):
+        # Returns the shortcut dialed, if any
+        shortcuts = self.shortcut_store.shortcuts
+        while True:
+            try:
+                digit, self.last_digit_time = self.digits_received.get_nowait()
+            except queue.Empty:
+                break
+
+            self.digits += digit
+            logging.info(f'Digit dialed: {digit}')
+            if not any(digits.startswith(self.digits) for digits in shortcuts):
+                logging.info(f'No shortcut for {self.digits}')
+                self.digits = ''
+                continue
+
+            if not any(len(digits) > len(self.digits) and digits.startswith(self.digits) for digits in shortcuts):
+                return self._complete()
+
+        if self.digits and time.monotonic() - self.last_digit_time > self.inter_digit_timeout:
+            if self.digits in shortcuts:
+                return self._complete()
+            logging.info(f'No shortcut for {self.digits}')
+            self.digits = ''
+
+        return None
+
+    def _complete(self):
+        shortcut = self.shortcut_store.shortcuts[self.digits]
+        self.digits = ''
+        return shortcut
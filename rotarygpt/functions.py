@@ -1,25 +1,135 @@
+import collections
 import logging
+import math
+import re
+
+word_regex = re.compile(r'[a-z0-9]+')
+# Words in almost every request and description, they only blur the ranking. On and off do matter, for lights.
+stop_words = frozenset([
+    'all', 'an', 'and', 'any', 'are', 'be', 'by', 'can', 'could', 'do', 'does', 'for', 'from', 'get', 'given',
+    'how', 'in', 'is', 'it', 'me', 'my', 'of', 'or', 'please', 'some', 'that', 'the', 'this', 'to', 'what',
+    'with', 'would', 'you', 'your',
+])
+
+
+def index_terms(text):
+    terms = []
+    for word in word_regex.findall(text.lower()):
+        # Single letters are mostly left over from contractions, like the s of what's
+        if len(word) < 2 or word in stop_words:
+            continue
+        # Crude stemming, enough for the plurals and verb forms of short descriptions
+        if len(word) > 5 and word.endswith('ing'):
+            word = word[:-3]
+        elif len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+        terms.append(word)
+    return terms
+
+
+def schema_text(schema):
+    # Property names, descriptions and allowed values of a JSON schema
+    parts = []
+    if isinstance(schema, dict):
+        if isinstance(schema.get('description'), str):
+            parts.append(schema['description'])
+        for value in schema.get('enum', []):
+            parts.append(str(value))
+        for name, property_schema in schema.get('properties', {}).items():
+            parts.append(name.replace('_', ' '))
+            parts.append(schema_text(property_schema))
+        if 'items' in schema:
+            parts.append(schema_text(schema['items']))
+    return ' '.join(parts)
 
 
 class FunctionManager:
+    # With more functions registered than this, only the ones relevant to the caller's request are sent to GPT
+    max_functions = 6
+    # BM25 score of the best match below which the request is too vague to choose, every function is sent then
+    min_score = 3.0
+    # https://en.wikipedia.org/wiki/Okapi_BM25
+    bm25_k1 = 1.2
+    bm25_b = 0.75
+
     def __init__(self):
         self.functions = dict()
+        # The index of names, descriptions and parameters, built as functions are registered
+        self.texts = dict()
+        self.term_counts = dict()
+        self.document_frequencies = collections.Counter()
 
     def register(self, function):
-        self.functions[function['name']] = function
+        name = function['name']
+        if name in self.term_counts:
+            self.document_frequencies.subtract(self.term_counts[name].keys())
+
+        self.functions[name] = function
+        self.texts[name] = ' '.join((name.replace('_', ' '), function.get('description', ''),
+                                     schema_text(function.get('parameters'))))
+        self.term_counts[name] = collections.Counter(index_terms(self.texts[name]))
+        self.document_frequencies.update(self.term_counts[name].keys())
         logging.debug(f'Registered function {function["name"]}')
 
-    def available_functions(self):
+    def available_functions(self, query = None, recently_used = ()):
+        # Every function without a query, otherwise the ones relevant to it and the recently used ones
+        names = self.relevant_functions(query, recently_used) if query else list(self.functions)
         return [
             {
-                'name': function['name'],
-                'description': function['description'],
-                'parameters': function['parameters']
+                'name': self.functions[name]['name'],
+                'description': self.functions[name]['description'],
+                'parameters': self.functions[name]['parameters']
             }
-            for function in self.functions.values()
+            for name in names
         ]
 
-    def call(self, name, params):
+    def relevant_functions(self, query, recently_used = ()):
+        if len(self.functions) <= self.max_functions:
+            return list(self.functions)
+
+        scores = self._scores(index_terms(query))
+        ranked = sorted((name for name in scores if scores[name] > 0), key=scores.get, reverse=True)
+        if not ranked or scores[ranked[0]] < self.min_score:
+            logging.debug(f'No function clearly relevant to "{query}", sending all of them')
+            return list(self.functions)
+
+        selected = set(ranked[:self.max_functions])
+        # Functions the chosen ones point to, like the one looking up the IDs they take
+        for name in list(selected):
+            for other_name in self.functions:
+                short_name = other_name.rsplit('__', 1)[-1]
+                if '_' in short_name and short_name in self.texts[name]:
+                    selected.add(other_name)
+        # A follow-up like "and tomorrow?" may have no words of its own for the function it needs
+        selected.update(name for name in recently_used if name in self.functions)
+
+        names = [name for name in self.functions if name in selected]
+        logging.debug(f'Functions relevant to "{query}": {", ".join(names)}')
+        return names
+
+    def call(self, name, params, conversation = None):
         if name not in self.functions:
             return f'Function with name {name} not found.'
-        return self.functions[name]['callable'](params)
\ No newline at end of file
+        function = self.functions[name]
+        # Functions changing how a single call behaves, like its voice, get the conversation too
+        if function.get('needs_conversation'):
+            return function['callable'](params, conversation)
+        return function['callable'](params)
+
+    def _scores(self, query_terms):
+        count = len(self.term_counts)
+        average_length = sum(sum(terms.values()) for terms in self.term_counts.values()) / count
+
+        scores = dict.fromkeys(self.term_counts, 0.0)
+        for term in set(query_terms):
+            frequency = self.document_frequencies[term]
+            if frequency <= 0:
+                continue
+            idf = math.log(1 + (count - frequency + 0.5) / (frequency + 0.5))
+            for name, terms in self.term_counts.items():
+                if term not in terms:
+                    continue
+                length = sum(terms.values())
+                scores[name] += idf * terms[term] * (self.bm25_k1 + 1) / \
+                    (terms[term] + self.bm25_k1 * (1 - self.bm25_b + self.bm25_b * length / average_length))
+        return scores
@@ -0,0 +1,418 @@
+import logging
+import socket
+import ssl
+import threading
+import time
+import zlib
+
+# One TLS context for every connection, the CA bundle is loaded once
+ssl_context = ssl.create_default_context()
+
+
+class HTTPError(Exception):
+    pass
+
+
+class DNSCache:
+    # Seconds a lookup is reused, the APIs sit behind CDNs that move rarely within a call
+    ttl = 300.0
+
+    def __init__(self):
+        self.addresses = {}
+        self.lock = threading.Lock()
+
+    def resolve(self, host, port):
+        now = time.monotonic()
+        with self.lock:
+            cached = self.addresses.get((host, port))
+            if cached is not None and cached[0] > now:
+                return cached[1]
+
+        addresses = socket.getaddrinfo(host, port, socket.AF_UNSPEC, socket.SOCK_STREAM)
+        with self.lock:
+            self.addresses[(host, port)] = (now + self.ttl, addresses)
+        return addresses
+
+    def forget(self, host, port):
+        with self.lock:
+            self.addresses.pop((host, port), None)
+
+
+class HTTPResponse:
+    def __init__(self, connection, status, reason, headers):
+        self.connection = connection
+        self.status = status
+        self.reason = reason
+        # Lowercase names to values, the last one wins
+        self.headers = headers
+
+    def header(self, name, default = None):
+        return self.headers.get(name.lower(), default)
+
+    def read(self, is_stopped = None):
+        # The whole body, None when stopped before the end
+        body = bytearray()
+        if not self.read_chunks(body.extend, is_stopped):
+            return None
+        return bytes(body)
+
+    def read_chunks(self, callback, is_stopped = None):
+        # Streams the body to the callback as it arrives. The chunks are views into the receive buffer, only valid
+        # until the callback returns, so a callback keeping them has to copy. Returns whether the whole body was read,
+        # the connection can only be reused after that.
+        connection = self.connection
+        transfer_encoding = self.header('Transfer-Encoding', '').lower()
+        content_length = self.header('Content-Length')
+
+        decompressor = None
+        if self.header('Content-Encoding', '').lower() in ('gzip', 'deflate'):
+            # Either header, gzip or zlib
+            decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+            compressed_callback = callback
+            callback = lambda chunk: compressed_callback(decompressor.decompress(chunk))
+
+        if 'chunked' in transfer_encoding:
+            # https://datatracker.ietf.org/doc/html/rfc9112#section-7.1
+            while True:
+                if is_stopped is not None and is_stopped():
+                    return False
+
+                size_line = connection.read_line(1024)
+                try:
+                    chunk_size = int(size_line.split(b';', 1)[0], 16)
+                except ValueError:
+                    raise HTTPError(f'Malformed chunk size: {size_line!r}')
+                if chunk_size == 0:
+                    break
+
+                if not connection.read_body(chunk_size, callback, is_stopped):
+                    return False
+                if connection.read_line(2).strip():
+                    raise HTTPError('Chunk longer than its size')
+
+            # Trailers, up to the empty line
+            while connection.read_line().strip():
+                pass
+        elif content_length is not None:
+            if not content_length.isdecimal():
+                raise HTTPError(f'Malformed Content-Length: {content_length}')
+            if not connection.read_body(int(content_length), callback, is_stopped):
+                return False
+        else:
+            # The body ends with the connection
+            connection.reusable = False
+            if not connection.read_body(None, callback, is_stopped):
+                return False
+
+        if decompressor is not None:
+            compressed_callback(decompressor.flush())
+
+        if self.header('Connection', '').lower() == 'close':
+            connection.reusable = False
+        connection.response_complete = True
+        return True
+
+
+# https://html.spec.whatwg.org/multipage/server-sent-events.html#event-stream-interpretation
+class ServerSentEventParser:
+    def __init__(self):
+        # The incomplete last line, events can be split anywhere across chunks
+        self.buffer = b''
+        self.data = []
+
+    def feed(self, chunk):
+        # Returns the data of the events completed by the chunk
+        lines = (self.buffer + chunk).split(b'\n')
+        self.buffer = lines.pop()
+
+        events = []
+        for line in lines:
+            line = line.rstrip(b'\r')
+            if not line:
+                if self.data:
+                    events.append('\n'.join(self.data))
+                    self.data = []
+                continue
+
+            field, _, value = line.partition(b':')
+            if field == b'data':
+                self.data.append(value[1:].decode('utf-8') if value.startswith(b' ') else value.decode('utf-8'))
+            # Comments, event names, ids and retry times don't matter here
+
+        return events
+
+
+class HTTPConnection:
+    # Reads go straight into this buffer, only a partial line is ever moved within it
+    receive_buffer_size = 65536
+    # For reads, a stalled server fails the request instead of hanging the call
+    read_timeout = 60.0
+
+    def __init__(self, host, port, ssl_socket):
+        self.host = host
+        self.port = port
+        self.socket = ssl_socket
+        self.socket.settimeout(self.read_timeout)
+        self.buffer = bytearray(self.receive_buffer_size)
+        self.view = memoryview(self.buffer)
+        # The unread data is buffer[start:end]
+        self.start = 0
+        self.end = 0
+        # Cleared on anything that leaves the connection in an unknown state
+        self.reusable = True
+        self.response_complete = True
+        self.reused = False
+        self.idle_since = None
+        # Whether anything of the current response arrived, and whether the server ended the connection
+        self.response_started = False
+        self.closed_by_peer = False
+
+    def send(self, data):
+        self.response_complete = False
+        self.response_started = False
+        self.socket.sendall(data)
+
+    def get_response(self):
+        # Status line and headers are parsed once, the body is left in the buffer for the response to read
+        status_line = self.read_line()
+        parts = status_line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+        if len(parts) < 2 or not parts[0].startswith('HTTP/') or not parts[1].isdecimal():
+            raise HTTPError(f'Malformed status line: {status_line!r}')
+
+        headers = {}
+        while True:
+            line = self.read_line().rstrip(b'\r\n')
+            if not line:
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        status = int(parts[1])
+        if status < 200:
+            # Interim responses such as 100 Continue, the real one follows
+            return self.get_response()
+        return HTTPResponse(self, status, parts[2] if len(parts) > 2 else '', headers)
+
+    def read_line(self, limit = 65536):
+        while True:
+            index = self.buffer.find(b'\n', self.start, self.end)
+            if index >= 0:
+                line = bytes(self.view[self.start:index + 1])
+                self.start = index + 1
+                return line
+
+            if self.end - self.start >= limit:
+                raise HTTPError('Line too long')
+            if not self._receive():
+                raise HTTPError('Connection closed in the middle of a line')
+
+    def read_body(self, size, callback, is_stopped = None):
+        # Passes size bytes to the callback, or everything up to the end of the connection when size is None
+        while size is None or size > 0:
+            if self.start == self.end:
+                if is_stopped is not None and is_stopped():
+                    return False
+                if not self._receive():
+                    if size is None:
+                        return True
+                    raise HTTPError('Connection closed in the body')
+
+            length = self.end - self.start if size is None else min(size, self.end - self.start)
+            callback(self.view[self.start:self.start + length])
+            self.start += length
+            if size is not None:
+                size -= length
+
+        return True
+
+    def _receive(self):
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buffer):
+            remaining = self.end - self.start
+            self.buffer[:remaining] = bytes(self.view[self.start:self.end])
+            self.start, self.end = 0, remaining
+
+        count = self.socket.recv_into(self.view[self.end:])
+        self.end += count
+        if count > 0:
+            self.response_started = True
+        else:
+            self.closed_by_peer = True
+        return count > 0
+
+    def failed_before_response(self, error):
+        # Whether the server had dropped the connection before taking the request: it was reset or ended with not a
+        # byte of a response. After anything else, a timeout above all, the server may have acted on the request.
+        if self.response_started:
+            return False
+        if isinstance(error, HTTPError):
+            return self.closed_by_peer
+        return isinstance(error, (ConnectionError, ssl.SSLEOFError, ssl.SSLZeroReturnError))
+
+    def shutdown(self):
+        # Wakes up a read blocked in another thread
+        self.reusable = False
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        self.reusable = False
+        self.socket.close()
+
+    def is_stale(self):
+        # An idle connection has nothing to read, anything there is the server closing it
+        self.socket.setblocking(False)
+        try:
+            self.socket.recv(1)
+            return True
+        except (ssl.SSLWantReadError, BlockingIOError):
+            return False
+        except OSError:
+            return True
+        finally:
+            self.socket.settimeout(self.read_timeout)
+
+
+# Keep-alive connections per host, shared by every call. A turn sends Whisper, GPT and Polly requests to two hosts,
+# reusing warm connections saves a TCP and a TLS handshake each time. TLS sessions are kept per host too, so a new
+# connection resumes the last session with an abbreviated handshake.
+class HTTPConnectionPool:
+    max_idle_connections = 4
+    # Servers drop idle keep-alive connections after a while, not waiting to find out
+    idle_timeout = 30.0
+    connect_timeout = 10.0
+
+    def __init__(self):
+        self.dns_cache = DNSCache()
+        self.idle_connections = {}
+        self.sessions = {}
+        self.warming = set()
+        self.lock = threading.Lock()
+
+    def connect(self, host, port = 443):
+        while True:
+            with self.lock:
+                idle = self.idle_connections.get((host, port))
+                connection = idle.pop() if idle else None
+
+            if connection is None:
+                return self._open(host, port)
+
+            if time.monotonic() - connection.idle_since < self.idle_timeout and not connection.is_stale():
+                connection.reused = True
+                return connection
+            connection.close()
+
+    def release(self, connection):
+        # Closed by the server along with the response, it would only fail the next request
+        if not connection.reusable or not connection.response_complete or connection.is_stale():
+            connection.close()
+            return
+
+        key = (connection.host, connection.port)
+        connection.idle_since = time.monotonic()
+        with self.lock:
+            # Session tickets arrive after the handshake, the latest one is the best to resume
+            self.sessions[key] = connection.socket.session
+            idle = self.idle_connections.setdefault(key, [])
+            idle.append(connection)
+            if len(idle) <= self.max_idle_connections:
+                return
+            connection = idle.pop(0)
+        connection.close()
+
+    def warm_up(self, host, port = 443, count = 1):
+        # Opens connections ahead of the requests that need them, so the handshakes are off the critical path.
+        # Idle connections past the idle timeout or closed by the server are replaced, at least count are left ready.
+        key = (host, port)
+        with self.lock:
+            if key in self.warming:
+                return
+            self.warming.add(key)
+            idle = self.idle_connections.get(key, [])
+            self.idle_connections[key] = []
+
+        try:
+            ready = []
+            for connection in idle:
+                if time.monotonic() - connection.idle_since < self.idle_timeout and not connection.is_stale():
+                    ready.append(connection)
+                else:
+                    connection.close()
+
+            # Back in front of any released meanwhile, keeping their age, the pool hands out the newest first
+            with self.lock:
+                self.idle_connections.setdefault(key, [])[:0] = ready
+            for _ in range(count - len(ready)):
+                self.release(self._open(host, port))
+        except (OSError, ValueError) as error:
+            # The request itself connects again, and fails properly if it has to
+            logging.warning(f'Could not warm up a connection to {host}:{port}: {error}')
+        finally:
+            with self.lock:
+                self.warming.discard(key)
+
+    def request(self, host, data, port = 443):
+        # Sends a whole request and returns the connection with its response
+        connection = self.connect(host, port)
+        try:
+            connection.send(data)
+            return connection, connection.get_response()
+        except (OSError, HTTPError) as error:
+            connection = self.reconnect(connection, error, data)
+
+        try:
+            return connection, connection.get_response()
+        except:
+            connection.close()
+            raise
+
+    def reconnect(self, connection, error, data):
+        # For a request that failed with the error on the connection, after sending the data. A reused connection the
+        # server closed in the meantime fails before any response, the data is then sent once more on a new connection
+        # and that one is returned. The requests are not idempotent, any other failure is passed on rather than risking
+        # sending one twice.
+        connection.close()
+        if not connection.reused or not connection.failed_before_response(error):
+            raise error
+        logging.debug(f'Kept-alive connection to {connection.host} was closed, reconnecting')
+
+        connection = self._open(connection.host, connection.port)
+        try:
+            connection.send(data)
+        except:
+            connection.close()
+            raise
+        return connection
+
+    def _open(self, host, port):
+        error = None
+        for family, socket_type, protocol, _, address in self.dns_cache.resolve(host, port):
+            client_socket = socket.socket(family, socket_type, protocol)
+            try:
+                client_socket.settimeout(self.connect_timeout)
+                client_socket.connect(address)
+                # Whisper audio goes out in small chunks, not holding them back
+                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                with self.lock:
+                    session = self.sessions.get((host, port))
+                ssl_socket = ssl_context.wrap_socket(client_socket, server_hostname=host, session=session)
+                ssl_socket.settimeout(None)
+            except (OSError, ValueError) as connect_error:
+                # ValueError when the session can't be used for this connection
+                client_socket.close()
+                error = connect_error
+                continue
+
+            logging.debug(f'Connected to {host}:{port}' + (', TLS session resumed' if ssl_socket.session_reused else ''))
+            return HTTPConnection(host, port, ssl_socket)
+
+        # Maybe the lookup is out of date
+        self.dns_cache.forget(host, port)
+        raise error
+
+
+connection_pool = HTTPConnectionPool()
@@ -0,0 +1,206 @@
+from rotarygpt.audio import mu_decompress_table, mu_law_encode_table
+
+SAMPLE_RATE = 8000
+FRAME_DURATION = 0.02
+MU_LAW_SILENCE = b'\xff'
+
+# Gains applied to the last good frame for each consecutive lost packet, silence after that
+concealment_gains = [0.75, 0.5, 0.25]
+concealment_tables = [
+    bytes(mu_law_encode_table[int(sample * gain) & 0xFFFF] for sample in mu_decompress_table)
+    for gain in concealment_gains
+]
+
+
+# Reorders RTP frames by sequence number and releases them on a schedule derived from their timestamps,
+# delayed by a target delay that grows when packets arrive too late and decays back toward what the measured jitter
+# needs while they arrive in time. Lost packets are concealed by fading out
+# the previous frame. Accepted frames are handed to release_frame once their payload has been copied out.
+class JitterBuffer:
+    def __init__(self, target_delay = 0.06, max_delay = 0.2, max_concealed_frames = 10, release_frame = None):
+        self.target_delay = target_delay
+        self.release_frame = release_frame
+        self.max_delay = max_delay
+        self.max_concealed_frames = max_concealed_frames
+        # A sequence number this far from the expected one means the sender restarted the stream
+        self.resynchronize_threshold = 100
+        # After this many packets in a row in time, the delay comes down a step, a single spike doesn't add latency
+        # for the rest of the call
+        self.decay_packets = 50
+        self.decay_step = 0.01
+
+        self.packets = {}
+        # Sequence numbers of packets without audio, like telephone events, their slots are passed over
+        self.skipped = set()
+        self.next_sequence_number = None
+        self.base_timestamp = None
+        self.base_time = None
+        self.current_delay = target_delay
+        self.next_due_time = None
+        self.last_frame = None
+        self.consecutive_lost = 0
+        self.packets_in_time = 0
+
+        self.received_packets = 0
+        self.late_packets = 0
+        self.lost_packets = 0
+        self.duplicate_packets = 0
+
+        # RFC 3550 interarrival jitter in seconds, used to pick the delay when the stream (re)starts
+        self.jitter = 0.0
+        self.last_transit = None
+
+    # Returns whether the frame was kept, the caller still owns it otherwise
+    def put(self, frame):
+        sequence_number = frame.sequence_number
+        self.received_packets += 1
+        self._update_jitter(frame.timestamp, frame.arrival_time)
+
+        if self.next_sequence_number is None:
+            self._synchronize(sequence_number, frame.timestamp, frame.arrival_time)
+
+        # Sequence numbers wrap at 16 bits
+        offset = (sequence_number - self.next_sequence_number) & 0xFFFF
+        if offset >= 0x8000:
+            offset -= 0x10000
+
+        if abs(offset) > self.resynchronize_threshold:
+            self._synchronize(sequence_number, frame.timestamp, frame.arrival_time)
+        elif offset < 0:
+            # Behind the next one to play, it has missed its slot
+            self.late_packets += 1
+            self.packets_in_time = 0
+            if self.current_delay + FRAME_DURATION <= self.max_delay:
+                self.current_delay += FRAME_DURATION
+            return False
+        else:
+            self._decay_delay()
+
+        if sequence_number in self.packets:
+            self.duplicate_packets += 1
+            return False
+
+        self.packets[sequence_number] = frame
+        return True
+
+    def skip(self, sequence_number):
+        # A packet of the stream that has no audio, its slot is neither played nor concealed as lost
+        if self.next_sequence_number is None:
+            return
+
+        offset = (sequence_number - self.next_sequence_number) & 0xFFFF
+        if offset < self.resynchronize_threshold:
+            self.skipped.add(sequence_number)
+
+    def pop_ready(self, now):
+        frames = []
+        while self.next_sequence_number is not None:
+            due_time = self._due_time()
+            if now < due_time:
+                break
+
+            frame = self.packets.pop(self.next_sequence_number, None)
+            if self.next_sequence_number in self.skipped:
+                # The slot passes without audio
+                self.skipped.discard(self.next_sequence_number)
+                if frame is not None:
+                    self._release(frame)
+            elif frame is not None:
+                # The only copy of the payload on the way from the socket to the conversation
+                self.last_frame = bytes(frame.payload)
+                self._release(frame)
+                self.consecutive_lost = 0
+                frames.append(self.last_frame)
+            elif not self.packets and self.consecutive_lost >= self.max_concealed_frames:
+                # The stream has stopped, waiting for it to start again instead of concealing forever
+                self.next_sequence_number = None
+                break
+            else:
+                # Only a gap before a packet that did arrive is a loss, a quiet stream is just running dry
+                if self.packets:
+                    self.lost_packets += 1
+                frames.append(self._conceal())
+
+            self.next_sequence_number = (self.next_sequence_number + 1) & 0xFFFF
+            self.next_due_time = due_time + FRAME_DURATION
+
+        return frames
+
+    def time_until_next(self, now):
+        if self.next_sequence_number is None:
+            return None
+
+        return max(0.0, self._due_time() - now)
+
+    def stats(self):
+        return {
+            'received': self.received_packets,
+            'late': self.late_packets,
+            'lost': self.lost_packets,
+            'duplicate': self.duplicate_packets,
+            'jitter_ms': round(self.jitter * 1000, 2),
+            'delay_ms': round(self.current_delay * 1000, 2),
+        }
+
+    def _synchronize(self, sequence_number, timestamp, arrival_time):
+        for frame in self.packets.values():
+            self._release(frame)
+        self.packets = {}
+        self.skipped = set()
+        self.next_sequence_number = sequence_number
+        self.base_timestamp = timestamp
+        self.base_time = arrival_time
+        self.current_delay = self._jitter_delay()
+        self.next_due_time = None
+        self.consecutive_lost = 0
+        self.packets_in_time = 0
+
+    def _jitter_delay(self):
+        return min(self.max_delay, max(self.target_delay, 3 * self.jitter))
+
+    def _decay_delay(self):
+        self.packets_in_time += 1
+        if self.packets_in_time < self.decay_packets:
+            return
+        self.packets_in_time = 0
+
+        # Frames due a little earlier, the next ones play out slightly sooner than their slot
+        if self.current_delay > self._jitter_delay():
+            self.current_delay = max(self._jitter_delay(), self.current_delay - self.decay_step)
+            if self.next_due_time is not None:
+                self.next_due_time -= self.decay_step
+
+    def _release(self, frame):
+        if self.release_frame is not None:
+            self.release_frame(frame)
+
+    def _due_time(self):
+        frame = self.packets.get(self.next_sequence_number)
+        if frame is None:
+            if self.next_due_time is None:
+                return self.base_time + self.current_delay
+            return self.next_due_time
+
+        elapsed = ((frame.timestamp - self.base_timestamp) & 0xFFFFFFFF) / SAMPLE_RATE
+        return self.base_time + elapsed + self.current_delay
+
+    def _conceal(self):
+        self.consecutive_lost += 1
+
+        if self.last_frame is None:
+            return MU_LAW_SILENCE * int(SAMPLE_RATE * FRAME_DURATION)
+
+        if self.consecutive_lost > len(concealment_tables):
+            return MU_LAW_SILENCE * len(self.last_frame)
+
+        return self.last_frame.translate(concealment_tables[self.consecutive_lost - 1])
+
+    def _update_jitter(self, timestamp, arrival_time):
+        # https://datatracker.ietf.org/doc/html/rfc3550#appendix-A.8
+        transit = arrival_time - timestamp / SAMPLE_RATE
+        if self.last_transit is not None:
+            difference = abs(transit - self.last_transit)
+            # Ignoring timestamp wraps and stream restarts
+            if difference < 1.0:
+                self.jitter += (difference - self.jitter) / 16
+        self.last_transit = transit
@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import threading
+
+from rotarygpt.conversation import Conversation
+from rotarygpt.dtmf import DigitCollector
+from rotarygpt.rtcp import RTCPSession
+from rotarygpt.ringbuffer import AudioRingBuffer, OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST
+from rotarygpt.rtp import RTPReceiver, RTPSender, SharedSocket
+
+
+class PortPool:
+    def __init__(self, first_port, last_port):
+        # RTP uses even ports, the odd one above is left for RTCP
+        self.free_ports = list(range(first_port + first_port % 2, last_port + 1, 2))
+
+    def allocate(self):
+        if not self.free_ports:
+            return None
+        return self.free_ports.pop(0)
+
+    def release(self, port):
+        self.free_ports.append(port)
+
+
+class MediaSession:
+    # Buffer sizes in 20ms frames. Inbound audio nobody listens to is dropped oldest first,
+    # outbound audio holds up the Polly stream until the sender catches up.
+    inbound_buffer_frames = 250
+    outbound_buffer_frames = 500
+    # Anything taking the same arguments, the load test swaps in one that needs no API keys
+    conversation_class = Conversation
+
+    def __init__(self, call_id, bind_address, port, function_manager, prompt_store, recording_manager,
+                 shortcut_store = None):
+        self.call_id = call_id
+        self.bind_address = bind_address
+        self.port = port
+        self.function_manager = function_manager
+        self.prompt_store = prompt_store
+        self.recording_manager = recording_manager
+        self.shortcut_store = shortcut_store
+
+        self.loop = asyncio.get_running_loop()
+        self.audio_in = AudioRingBuffer(self.inbound_buffer_frames, OVERFLOW_DROP_OLDEST)
+        self.audio_out = AudioRingBuffer(self.outbound_buffer_frames, OVERFLOW_BLOCK, loop=self.loop)
+        # The conversation runs in an executor thread and checks this between blocking steps
+        self.shutdown_event = threading.Event()
+        self.recording = None
+        self.shared_socket = SharedSocket()
+        self.rtcp_transport = None
+        self.rtp_receiver = None
+        self.rtp_sender = None
+        self.rtp_sender_task = None
+        self.rtcp_session = None
+        self.conversation_future = None
+        self.statistics = None
+
+    async def bind(self):
+        self.shared_socket.bind(self.bind_address, self.port)
+        self.rtp_receiver = RTPReceiver(self.audio_in)
+        self.rtp_receiver.start(self.shared_socket)
+
+        self.rtcp_session = RTCPSession(self.rtp_receiver.reception_statistics)
+        self.rtp_receiver.rtcp_session = self.rtcp_session
+        try:
+            self.rtcp_transport, _ = await self.loop.create_datagram_endpoint(
+                lambda: self.rtcp_session, local_addr=(self.bind_address, self.port + 1)
+            )
+        except OSError:
+            self.rtp_receiver.stop()
+            self.shared_socket.close()
+            raise
+
+        # The call is being answered, connecting upstream while the greeting plays
+        self.loop.run_in_executor(None, self.conversation_class.warm_up)
+
+    def start(self, remote_address, remote_port, comfort_noise = False, telephone_event = None):
+        logging.info(f'Starting media session for call {self.call_id} on port {self.port} ' +
+                     f'with peer {remote_address}:{remote_port}')
+
+        self.recording = self.recording_manager.start_recording(self.loop)
+        self.rtp_receiver.recording = self.recording
+
+        self.rtp_sender = RTPSender(self.shared_socket, remote_address, remote_port, self.audio_out, self.recording,
+                                    comfort_noise)
+        self.rtp_sender_task = self.loop.create_task(self.rtp_sender.start())
+        self.rtcp_session.start(self.rtp_sender, remote_address, remote_port)
+
+        digit_collector = None
+        self.rtp_receiver.telephone_event_payload_type = telephone_event
+        if telephone_event is not None and self.shortcut_store is not None and self.shortcut_store.shortcuts:
+            digit_collector = DigitCollector(self.shortcut_store)
+            self.rtp_receiver.on_digit = digit_collector.add
+
+        conversation = self.conversation_class(self.audio_in, self.audio_out, self.function_manager,
+                                               self.prompt_store, self.loop, digit_collector)
+        self.conversation_future = self.loop.run_in_executor(None, conversation.start, self.shutdown_event)
+
+    async def stop(self):
+        self.shutdown_event.set()
+        # Wakes up a conversation waiting for room in the buffer or for audio
+        self.audio_out.close()
+        self.audio_in.close()
+
+        if self.rtp_sender_task is not None:
+            self.rtp_sender_task.cancel()
+            await asyncio.gather(self.rtp_sender_task, return_exceptions=True)
+
+        if self.rtcp_session is not None:
+            self.rtcp_session.stop()
+            self.statistics = self._collect_statistics()
+            logging.info(f'Media statistics for call {self.call_id}: {self.statistics}')
+
+        if self.rtp_receiver is not None:
+            self.rtp_receiver.stop()
+        self.shared_socket.close()
+        if self.rtcp_transport is not None:
+            self.rtcp_transport.close()
+
+        if self.conversation_future is not None:
+            await asyncio.gather(self.conversation_future, return_exceptions=True)
+
+        if self.recording is not None:
+            # Writes the rest and patches the file header, keeping it off the event loop
+            await self.loop.run_in_executor(None, self.recording.close)
+
+        logging.info(f'Media session for call {self.call_id} stopped')
+
+    def _collect_statistics(self):
+        reception = self.rtp_receiver.reception_statistics
+        statistics = {
+            'received_packets': reception.received,
+            'lost_packets': reception.lost(),
+            'jitter_ms': round(reception.jitter / 8, 2),
+            'jitter_buffer': self.rtp_receiver.jitter_buffer.stats(),
+        }
+
+        if self.rtp_sender is not None:
+            statistics['sent_packets'] = self.rtp_sender.packets_sent
+            statistics['suppressed_packets'] = self.rtp_sender.suppressed_packets
+            statistics['late_packets'] = self.rtp_sender.late_packets
+
+        statistics.update(self.rtcp_session.stats())
+
+        return statistics
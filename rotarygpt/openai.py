@@ -1,27 +1,26 @@
-import socket
-import ssl
 import json
 from datetime import datetime
 import os
+import threading
 
 from rotarygpt.audio import wave_header
+from rotarygpt.http import HTTPError, ServerSentEventParser, connection_pool
 
 class WhisperRequest:
     def __init__(self, shutdown_event):
         self.shutdown_event = shutdown_event
         self.api_key = os.environ['OPENAI_API_KEY']
 
-        self.socket = None
+        self.connection = None
+        # Everything sent on a reused connection, to send again if the server turns out to have closed it
+        self.sent = bytearray()
         self.target_host = "api.openai.com"
         self.target_port = 443
         self.is_accepting_audio = False
 
     def start_request(self):
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        context = ssl.create_default_context()
-
-        self.socket = context.wrap_socket(client_socket, server_hostname=self.target_host)
-        self.socket.connect((self.target_host, self.target_port))
+        # Audio is streamed as the caller speaks, a kept-alive connection is checked for staleness before
+        self.connection = connection_pool.connect(self.target_host, self.target_port)
 
         http_body = b"--112FEUERNOTRUF110\r\nContent-Disposition: form-data; name=\"model\"\r\n\r\nwhisper-1\r\n--112FEUERNOTRUF110\r\nContent-Disposition: form-data; name=\"file\"; filename=\"data.wav\"\r\n\r\n"
         http_body = http_body + wave_header()
@@ -30,11 +29,10 @@ class WhisperRequest:
 Host: """ + self.target_host.encode('ascii') + b"""
 Authorization: Bearer """ + self.api_key.encode('ascii') + b"""
 Transfer-Encoding: chunked
-Connection: close
 Content-Type: multipart/form-data; boundary=112FEUERNOTRUF110""".replace(b"\n", b"\r\n")
 
         http_chunk = '{:x}'.format(len(http_body)).encode('ascii') + b"\r\n" + http_body + b"\r\n"
-        self.socket.sendall(http_header + b"\r\n\r\n" + http_chunk)
+        self._send(http_header + b"\r\n\r\n" + http_chunk)
 
         self.is_accepting_audio = True
 
@@ -42,8 +40,9 @@ Content-Type: multipart/form-data; boundary=112FEUERNOTRUF110""".replace(b"\n",
         if not self.is_accepting_audio:
             return
 
-        http_chunk = '{:x}'.format(len(chunk)).encode('ascii') + b"\r\n" + chunk + b"\r\n"
-        self.socket.sendall(http_chunk)
+        # Joining in one go, the audio chunk is copied only once
+        http_chunk = b"".join(('{:x}\r\n'.format(len(chunk)).encode('ascii'), chunk, b"\r\n"))
+        self._send(http_chunk)
 
     def finish_request(self):
         if not self.is_accepting_audio:
@@ -53,36 +52,49 @@ Content-Type: multipart/form-data; boundary=112FEUERNOTRUF110""".replace(b"\n",
         closing_boundary = b'\r\n--112FEUERNOTRUF110--\r\n'
         http_chunk = '{:x}'.format(len(closing_boundary)).encode('ascii') + b"\r\n" + closing_boundary + b"\r\n"
         http_chunk = http_chunk + b"0\r\n\r\n"
-        self.socket.sendall(http_chunk)
+        self._send(http_chunk)
 
 
     def discard_request(self):
         self.is_accepting_audio = False
-        if self.socket is not None:
-            self.socket.close()
-            self.socket = None
+        self.sent = bytearray()
+        if self.connection is not None:
+            # Half sent, not reusable
+            self.connection.close()
+            self.connection = None
+
+    def _send(self, data):
+        if self.connection.reused:
+            self.sent += data
+        try:
+            self.connection.send(data)
+        except (OSError, HTTPError) as error:
+            # A new connection, everything so far is sent again on it
+            self.connection = connection_pool.reconnect(self.connection, error, self.sent)
+            self.sent = bytearray()
 
     def get_response(self):
-        if self.socket is None:
+        if self.connection is None:
             return
 
-        response = b""
-        while not self.shutdown_event.is_set():
-            data = self.socket.recv(1024)
-            if not data:
-                break
-            response += data
-
-        if self.shutdown_event.is_set():
+        try:
+            try:
+                response = self.connection.get_response()
+            except (OSError, HTTPError) as error:
+                self.connection = connection_pool.reconnect(self.connection, error, self.sent)
+                response = self.connection.get_response()
+            body = response.read(self.shutdown_event.is_set)
+        finally:
+            connection_pool.release(self.connection)
+            self.connection = None
+            self.sent = bytearray()
+
+        if body is None:
             return None
 
-        body = response.split(b'\r\n\r\n', 1)[1]
         parsed_body = json.loads(body)
         text = parsed_body['text'] if 'text' in parsed_body else None
 
-        self.socket.close()
-        self.socket = None
-
         return text
 
 
@@ -92,11 +104,16 @@ class GPTRequest:
         self.api_key = os.environ['OPENAI_API_KEY']
         self.physical_location = os.environ['ROTARYGPT_PHYSICAL_LOCATION']
 
-        self.socket = None
+        self.connection = None
+        self.response = None
+        # Set from another thread when the caller interrupts a streamed reply
+        self.cancelled = False
+        # Guards the connection between the reader releasing it and a cancel shutting it down
+        self.lock = threading.Lock()
         self.target_host = "api.openai.com"
         self.target_port = 443
 
-    def send_request(self, function_definitions, conversation_items):
+    def send_request(self, function_definitions, conversation_items, stream = False):
         conversation_items = [{
             "role": "system",
             "content": "You are a phone agent living in an old rotary phone, acting as a smart home assistant. " + \
@@ -105,41 +122,36 @@ class GPTRequest:
                        self.physical_location + ".",
         }] + conversation_items
 
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        context = ssl.create_default_context()
-
-        self.socket = context.wrap_socket(client_socket, server_hostname=self.target_host)
-        self.socket.connect((self.target_host, self.target_port))
-
-        http_body = json.dumps({
+        parameters = {
             "model": "gpt-3.5-turbo-0613",
             "messages": conversation_items,
-            "functions": function_definitions
-        }).encode('utf-8')
-
-        http_header = b"""POST /v1/chat/completions HTTP/1.1
+        }
+        # An empty list is rejected
+        if function_definitions:
+            parameters["functions"] = function_definitions
+        if stream:
+            parameters["stream"] = True
+        http_body = json.dumps(parameters).encode('utf-8')
+
+        http_header = (b"""POST /v1/chat/completions HTTP/1.1
 Host: """ + self.target_host.encode('ascii') + b"""
 Authorization: Bearer """ + self.api_key.encode('ascii') + b"""
 Content-Type: application/json
-Content-Length: """ + str(len(http_body)).encode('ascii') + b"""
-Connection: close""".replace(b"\n", b"\r\n")
+Content-Length: """ + str(len(http_body)).encode('ascii')).replace(b"\n", b"\r\n")
 
-        self.socket.sendall(http_header + b"\r\n\r\n" + http_body)
+        connection, self.response = connection_pool.request(self.target_host, http_header + b"\r\n\r\n" + http_body,
+                                                            self.target_port)
+        with self.lock:
+            self.connection = connection
 
     def get_response(self):
-        response = b""
-        while not self.shutdown_event.is_set():
-            data = self.socket.recv(1024)
-            if not data:
-                break
-            response += data
-
-        if self.shutdown_event.is_set():
-            return None
+        try:
+            body = self.response.read(self.shutdown_event.is_set)
+        finally:
+            self._release_connection()
 
-        header, body = response.split(b'\r\n\r\n', 1)
-        if b'Transfer-Encoding: chunked' in header:
-            body = self._unchunk_body(body)
+        if body is None:
+            return None
 
         decoded_body = body.decode('utf-8')
         parsed_body = json.loads(decoded_body)
@@ -149,21 +161,64 @@ Connection: close""".replace(b"\n", b"\r\n")
 
         text = parsed_body['choices'][0]['message'] if 'choices' in parsed_body else None
 
-        self.socket.close()
-        self.socket = None
-
         return text
 
-    def _unchunk_body(self, body):
-        unchunked_body = b''
-        while True:
-            chunk_size, rest = body.split(b"\r\n", 1)
-            chunk_size = int(chunk_size, 16)
-
-            if 0 == chunk_size:
-                break
-
-            chunk, body = rest[:chunk_size], rest[chunk_size + 2:]
-            unchunked_body += chunk
+    def get_streamed_response(self, text_callback):
+        # Passes the content to the callback as it's generated and returns the whole message at the end,
+        # with the arguments of a function call put together from their pieces
+        # https://platform.openai.com/docs/api-reference/chat/streaming
+        parser = ServerSentEventParser()
+        content = []
+        function_call = None
+
+        def on_chunk(chunk):
+            nonlocal function_call
+            for data in parser.feed(chunk):
+                if data == '[DONE]':
+                    continue
+
+                choices = json.loads(data).get('choices')
+                delta = choices[0].get('delta', {}) if choices else {}
+                if delta.get('content'):
+                    content.append(delta['content'])
+                    text_callback(delta['content'])
+                if 'function_call' in delta:
+                    if function_call is None:
+                        function_call = {"name": "", "arguments": ""}
+                    function_call['name'] += delta['function_call'].get('name', '')
+                    function_call['arguments'] += delta['function_call'].get('arguments', '')
+
+        complete = False
+        try:
+            if self.response.status != 200:
+                raise Exception(f"GPT returned an error: {self.response.read().decode('utf-8', 'replace')}")
+            complete = self.response.read_chunks(on_chunk, self._is_stopped)
+        except (OSError, HTTPError):
+            if not self.cancelled:
+                raise
+        finally:
+            self._release_connection()
+
+        if not complete:
+            return None
 
-        return unchunked_body
+        message = {"role": "assistant", "content": ''.join(content) if content else None}
+        if function_call is not None:
+            message['function_call'] = function_call
+        return message
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            # Only while this request owns it, once back in the pool it may serve the next request
+            if self.connection is not None:
+                # Wakes up a read blocked in get_streamed_response
+                self.connection.shutdown()
+
+    def _release_connection(self):
+        with self.lock:
+            connection, self.connection = self.connection, None
+        connection_pool.release(connection)
+
+    def _is_stopped(self):
+        return self.cancelled or self.shutdown_event.is_set()
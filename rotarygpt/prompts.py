@@ -0,0 +1,85 @@
+import logging
+import mmap
+import os
+
+from rotarygpt.audio import linear_to_mu_law
+
+# 20ms of 8 bit PCMU
+FRAME_SIZE = 160
+MU_LAW_SILENCE = b'\xff'
+
+
+class PromptStore:
+    def __init__(self, directory, cache_directory = None):
+        self.directory = directory
+        self.cache_directory = cache_directory if cache_directory is not None else directory
+        self.prompts = {}
+        self.files = []
+        self.mappings = []
+
+    def load(self):
+        for file_name in sorted(os.listdir(self.directory)):
+            if not file_name.endswith('.pcm'):
+                continue
+
+            name = file_name[:-4]
+            source_path = os.path.join(self.directory, file_name)
+            cache_path = os.path.join(self.cache_directory, name + '.ulaw')
+
+            if not self._is_cache_fresh(source_path, cache_path):
+                self._encode(source_path, cache_path)
+
+            file = open(cache_path, 'rb')
+            if os.fstat(file.fileno()).st_size == 0:
+                file.close()
+                self.prompts[name] = []
+                continue
+
+            mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            mapped = memoryview(mapping)
+            self.files.append(file)
+            self.mappings.append((mapping, mapped))
+            self.prompts[name] = [mapped[i:i + FRAME_SIZE] for i in range(0, len(mapped), FRAME_SIZE)]
+
+            logging.debug(f'Loaded prompt {name} with {len(self.prompts[name])} frames')
+
+    def frames(self, name):
+        return self.prompts[name]
+
+    def close(self):
+        # A mapping can only be closed once every view of it is released, the frames included
+        for frames in self.prompts.values():
+            for frame in frames:
+                frame.release()
+        self.prompts = {}
+        for mapping, mapped in self.mappings:
+            mapped.release()
+            mapping.close()
+        self.mappings = []
+        for file in self.files:
+            file.close()
+        self.files = []
+
+    @staticmethod
+    def _is_cache_fresh(source_path, cache_path):
+        try:
+            return os.path.getmtime(cache_path) >= os.path.getmtime(source_path)
+        except OSError:
+            return False
+
+    @staticmethod
+    def _encode(source_path, cache_path):
+        logging.info(f'Encoding prompt {source_path} to {cache_path}')
+
+        with open(source_path, 'rb') as file:
+            pcm = file.read()
+
+        encoded = linear_to_mu_law(pcm[:len(pcm) & ~1])
+        # Padding the last frame so that every frame is exactly 20ms
+        if len(encoded) % FRAME_SIZE:
+            encoded += MU_LAW_SILENCE * (FRAME_SIZE - len(encoded) % FRAME_SIZE)
+
+        temporary_path = cache_path + '.tmp'
+        with open(temporary_path, 'wb') as file:
+            file.write(encoded)
+        os.replace(temporary_path, cache_path)
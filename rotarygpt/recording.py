@@ -0,0 +1,199 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from rotarygpt.audio import wave_header
+
+INBOUND = 0
+OUTBOUND = 1
+
+SAMPLE_RATE = 8000
+MU_LAW_SILENCE = b'\xff'
+
+
+class CallRecording:
+    # Flushing in large writes from the executor, the RTP side on the event loop only appends to memory
+    flush_size = 64 * 1024
+    flush_interval = 1.0
+    # A direction lagging behind the wall clock by more than this is considered a gap and filled with silence.
+    # Smaller lags are normal network jitter.
+    gap_tolerance = SAMPLE_RATE // 10
+
+    def __init__(self, path, loop, on_close = None):
+        self.path = path
+        self.loop = loop
+        self.on_close = on_close
+
+        self.lock = threading.Lock()
+        # Held from taking the data out of the buffers until it's written, so flushes land in the file in order
+        self.write_lock = threading.Lock()
+        self.buffers = {INBOUND: bytearray(), OUTBOUND: bytearray()}
+        self.positions = {INBOUND: 0, OUTBOUND: 0}
+        self.start_time = None
+        self.closed = False
+        self.data_size = 0
+
+        self.file = open(path, 'wb')
+        self.file.write(wave_header(channels=2))
+
+        # A timer on the loop rather than a writer thread for every call
+        self.loop.call_later(self.flush_interval, self._on_flush_timer)
+
+    def add_inbound(self, chunk):
+        self._add(INBOUND, chunk)
+
+    def add_outbound(self, chunk):
+        self._add(OUTBOUND, chunk)
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+
+        with self.write_lock:
+            # Both channels need the same length, padding the shorter one
+            with self.lock:
+                length = max(len(self.buffers[INBOUND]), len(self.buffers[OUTBOUND]))
+                for buffer in self.buffers.values():
+                    buffer += MU_LAW_SILENCE * (length - len(buffer))
+                data = self._interleave(length)
+            self._write(data)
+
+        self.file.seek(0)
+        self.file.write(wave_header(channels=2, data_size=self.data_size))
+        self.file.close()
+
+        logging.info(f'Recording saved to {self.path} ({self.data_size} bytes)')
+
+        if self.on_close is not None:
+            self.on_close(self)
+
+    def _add(self, direction, chunk):
+        with self.lock:
+            if self.closed:
+                return
+
+            if self.start_time is None:
+                self.start_time = time.monotonic()
+
+            self._fill_gap(direction, self._elapsed_samples())
+            self.buffers[direction] += chunk
+            self.positions[direction] += len(chunk)
+
+            if len(self.buffers[direction]) >= self.flush_size:
+                self.loop.call_soon_threadsafe(self.loop.run_in_executor, None, self._flush)
+
+    def _elapsed_samples(self):
+        return int((time.monotonic() - self.start_time) * SAMPLE_RATE)
+
+    def _fill_gap(self, direction, elapsed_samples):
+        gap = elapsed_samples - self.gap_tolerance - self.positions[direction]
+        if gap <= 0:
+            return
+
+        self.buffers[direction] += MU_LAW_SILENCE * gap
+        self.positions[direction] += gap
+
+    def _on_flush_timer(self):
+        if self.closed:
+            return
+        self.loop.run_in_executor(None, self._flush)
+        self.loop.call_later(self.flush_interval, self._on_flush_timer)
+
+    def _flush(self):
+        with self.write_lock:
+            with self.lock:
+                # After close the rest is written there, padded
+                if self.closed or self.start_time is None:
+                    return
+
+                # Keeping a silent direction in step with the other one, otherwise nothing could be interleaved
+                elapsed_samples = self._elapsed_samples()
+                for direction in self.buffers:
+                    self._fill_gap(direction, elapsed_samples)
+
+                length = min(len(self.buffers[INBOUND]), len(self.buffers[OUTBOUND]))
+                data = self._interleave(length)
+
+            # Writing outside the lock so a slow disk doesn't block the RTP side
+            self._write(data)
+
+    def _interleave(self, length):
+        data = bytearray(length * 2)
+        data[0::2] = self.buffers[INBOUND][:length]
+        data[1::2] = self.buffers[OUTBOUND][:length]
+
+        del self.buffers[INBOUND][:length]
+        del self.buffers[OUTBOUND][:length]
+
+        return data
+
+    def _write(self, data):
+        if not data:
+            return
+
+        self.file.write(data)
+        self.data_size += len(data)
+
+
+class RecordingManager:
+    def __init__(self, directory, max_total_size = 200 * 1024 * 1024, max_age = 7 * 24 * 3600):
+        self.directory = directory
+        self.max_total_size = max_total_size
+        self.max_age = max_age
+
+        self.lock = threading.Lock()
+        self.active_recordings = []
+
+    def start_recording(self, loop):
+        os.makedirs(self.directory, exist_ok=True)
+
+        file_name = 'call-' + datetime.now().strftime('%Y%m%d-%H%M%S-%f') + '.wav'
+        recording = CallRecording(os.path.join(self.directory, file_name), loop, self._on_recording_closed)
+
+        with self.lock:
+            self.active_recordings.append(recording)
+
+        logging.info(f'Recording call to {recording.path}')
+
+        return recording
+
+    def _on_recording_closed(self, recording):
+        with self.lock:
+            if recording in self.active_recordings:
+                self.active_recordings.remove(recording)
+            active_paths = [active.path for active in self.active_recordings]
+
+        self._apply_retention(active_paths)
+
+    def _apply_retention(self, active_paths):
+        recordings = []
+        for file_name in os.listdir(self.directory):
+            path = os.path.join(self.directory, file_name)
+            if not file_name.endswith('.wav') or path in active_paths:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            recordings.append((stat.st_mtime, stat.st_size, path))
+
+        # Oldest first
+        recordings.sort()
+        now = time.time()
+        total_size = sum(size for _, size, _ in recordings)
+
+        for modified_time, size, path in recordings:
+            if now - modified_time <= self.max_age and total_size <= self.max_total_size:
+                break
+
+            logging.info(f'Removing old recording {path}')
+            try:
+                os.remove(path)
+            except OSError:
+                logging.exception(f'Could not remove recording {path}')
+                continue
+            total_size -= size
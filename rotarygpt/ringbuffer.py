@@ -0,0 +1,162 @@
+import asyncio
+import threading
+
+# 20ms of 8 bit PCMU
+FRAME_SIZE = 160
+MU_LAW_SILENCE = b'\xff'
+
+# What a write does when the buffer is full
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_DROP_NEWEST = 'drop_newest'
+
+
+# Fixed size audio buffer between two pipeline stages, usually on different threads. Writes can have any length,
+# reads hand out whole frames as views into the buffer, so a frame is valid until the next read and has to be
+# copied to be kept longer. When dropping the oldest frames, a write can make room anywhere in the buffer, including
+# the frame the reader still holds, so those buffers hand out copies instead. A reader on an event loop waits with
+# wait_for_frame(), readers on threads block in read_frame().
+class AudioRingBuffer:
+    def __init__(self, capacity, overflow = OVERFLOW_DROP_OLDEST, frame_size = FRAME_SIZE, loop = None):
+        if capacity < 2:
+            raise ValueError('The buffer needs room for at least two frames')
+
+        self.frame_size = frame_size
+        self.size = capacity * frame_size
+        self.overflow = overflow
+        self.loop = loop
+
+        self.buffer = bytearray(self.size)
+        self.view = memoryview(self.buffer)
+        self.condition = threading.Condition()
+        self.frame_event = asyncio.Event() if loop is not None else None
+
+        # Offset of the oldest unread byte, always at a frame boundary
+        self.start = 0
+        self.length = 0
+        # The frame handed out last, not to be overwritten until the next read
+        self.reserved = 0
+        self.closed = False
+        self.dropped = 0
+        # Positions in the stream of every byte ever written rather than in the buffer: the end of it, and the oldest
+        # byte not read yet. Flushed and dropped bytes are passed over unread.
+        self.write_position = 0
+        self.read_position = 0
+
+    def __len__(self):
+        return self.length
+
+    def write(self, data):
+        view = memoryview(data).cast('B')
+
+        with self.condition:
+            while view and not self.closed:
+                free = self.size - self.length - self.reserved
+                if free == 0:
+                    if self.overflow == OVERFLOW_BLOCK:
+                        self.condition.wait()
+                        continue
+
+                    if self.overflow == OVERFLOW_DROP_NEWEST:
+                        self.dropped += len(view)
+                        break
+
+                    # Making room by whole frames, so reads stay aligned
+                    frame_count = min(self.length // self.frame_size, -(-len(view) // self.frame_size))
+                    self._discard(frame_count * self.frame_size)
+                    self.dropped += frame_count * self.frame_size
+                    continue
+
+                count = min(free, len(view))
+                end = (self.start + self.length) % self.size
+                first_part = min(count, self.size - end)
+                self.buffer[end:end + first_part] = view[:first_part]
+                self.buffer[:count - first_part] = view[first_part:count]
+
+                self.length += count
+                self.write_position += count
+                view = view[count:]
+
+            if self.length >= self.frame_size:
+                self.condition.notify_all()
+                self._notify_loop()
+
+    def pad_frame(self, fill = MU_LAW_SILENCE):
+        # Completes a trailing partial frame, e.g. at the end of a reply, so it can be read
+        with self.condition:
+            partial = self.length % self.frame_size
+            if partial:
+                self.write(fill * (self.frame_size - partial))
+
+    def read_frame(self, timeout = None):
+        with self.condition:
+            self.reserved = 0
+            self.condition.wait_for(lambda: self.length >= self.frame_size or self.closed, timeout)
+            return self._take_frame()
+
+    def read_frame_nowait(self):
+        with self.condition:
+            self.reserved = 0
+            return self._take_frame()
+
+    async def wait_for_frame(self):
+        while True:
+            with self.condition:
+                if self.length >= self.frame_size or self.closed:
+                    return
+                # Set from the writer's thread once a frame is available
+                self.frame_event.clear()
+
+            await self.frame_event.wait()
+
+    def drained(self):
+        return self.wait_drained(0)
+
+    def wait_drained(self, timeout = None):
+        # Returns whether everything readable has been read
+        with self.condition:
+            return self.condition.wait_for(lambda: self.length < self.frame_size or self.closed, timeout)
+
+    def flush(self):
+        # Returns the number of bytes thrown away
+        with self.condition:
+            flushed = self.length
+            self._discard(flushed)
+            return flushed
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self._discard(self.length)
+            self._notify_loop()
+
+    def _take_frame(self):
+        if self.length < self.frame_size:
+            return None
+
+        frame = self.view[self.start:self.start + self.frame_size]
+        if self.overflow == OVERFLOW_DROP_OLDEST:
+            # Discarding moves the start past a reserved frame, writes could then wrap onto it
+            frame = bytes(frame)
+        else:
+            self.reserved = self.frame_size
+        self.start = (self.start + self.frame_size) % self.size
+        self.length -= self.frame_size
+        self.read_position += self.frame_size
+        # Waking up blocked writers and drain waiters
+        self.condition.notify_all()
+
+        return frame
+
+    def _discard(self, count):
+        self.length -= count
+        self.read_position += count
+        # Emptied, the start stays right after the frame the reader may still hold, so writes wrap around to it and
+        # no further. A partial frame is thrown away with the rest, the start is still at a frame boundary.
+        if self.length > 0:
+            self.start = (self.start + count) % self.size
+        self.condition.notify_all()
+
+    def _notify_loop(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.frame_event.set)
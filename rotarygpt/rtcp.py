@@ -0,0 +1,263 @@
+import asyncio
+import logging
+import random
+import socket
+import struct
+import time
+
+SAMPLE_RATE = 8000
+
+PAYLOAD_TYPE_SR = 200
+PAYLOAD_TYPE_RR = 201
+PAYLOAD_TYPE_SDES = 202
+PAYLOAD_TYPE_BYE = 203
+
+# Seconds between 1900 (NTP epoch) and 1970 (Unix epoch)
+NTP_OFFSET = 2208988800
+
+report_block_struct = struct.Struct('!IIIIII')
+sender_info_struct = struct.Struct('!IIIII')
+
+
+def ntp_timestamp(unix_time):
+    seconds = int(unix_time)
+    return (seconds + NTP_OFFSET) & 0xFFFFFFFF, int((unix_time - seconds) * 2 ** 32) & 0xFFFFFFFF
+
+
+def ntp_middle_bits(unix_time):
+    most_significant, least_significant = ntp_timestamp(unix_time)
+    return ((most_significant & 0xFFFF) << 16) | (least_significant >> 16)
+
+
+# https://datatracker.ietf.org/doc/html/rfc3550#appendix-A.1
+class ReceptionStatistics:
+    max_dropout = 3000
+    max_misorder = 100
+
+    def __init__(self):
+        self.source = None
+        self.base_sequence_number = None
+        self.max_sequence_number = None
+        self.cycles = 0
+        self.received = 0
+        self.expected_prior = 0
+        self.received_prior = 0
+        # In timestamp units, as reported in RTCP
+        self.jitter = 0.0
+        self.last_transit = None
+
+    def update(self, source, sequence_number, timestamp, arrival_time, timing = True):
+        if self.source != source:
+            self.source = source
+            self._restart(sequence_number)
+        else:
+            delta = (sequence_number - self.max_sequence_number) & 0xFFFF
+            if delta < self.max_dropout:
+                if sequence_number < self.max_sequence_number:
+                    self.cycles += 0x10000
+                self.max_sequence_number = sequence_number
+            elif delta <= 0xFFFF - self.max_misorder:
+                # A jump this large means the sender restarted its sequence
+                self._restart(sequence_number)
+
+        self.received += 1
+        if not timing:
+            # Telephone events keep the timestamp of their start in every packet, they say nothing about jitter
+            return
+
+        # https://datatracker.ietf.org/doc/html/rfc3550#appendix-A.8
+        transit = arrival_time * SAMPLE_RATE - timestamp
+        if self.last_transit is not None:
+            difference = abs(transit - self.last_transit)
+            # Ignoring timestamp wraps
+            if difference < SAMPLE_RATE:
+                self.jitter += (difference - self.jitter) / 16
+        self.last_transit = transit
+
+    def extended_max_sequence_number(self):
+        return self.cycles + self.max_sequence_number
+
+    def expected(self):
+        if self.base_sequence_number is None:
+            return 0
+        return self.extended_max_sequence_number() - self.base_sequence_number + 1
+
+    def lost(self):
+        return max(0, self.expected() - self.received)
+
+    def report_block(self, last_sender_report, last_sender_report_time, now):
+        # https://datatracker.ietf.org/doc/html/rfc3550#appendix-A.3
+        expected = self.expected()
+        expected_interval = expected - self.expected_prior
+        received_interval = self.received - self.received_prior
+        self.expected_prior = expected
+        self.received_prior = self.received
+
+        lost_interval = expected_interval - received_interval
+        fraction_lost = 0 if expected_interval == 0 or lost_interval <= 0 else (lost_interval << 8) // expected_interval
+
+        cumulative_lost = min(self.lost(), 0x7FFFFF)
+        delay = 0 if last_sender_report_time is None else int((now - last_sender_report_time) * 65536)
+
+        return report_block_struct.pack(
+            self.source,
+            (min(fraction_lost, 255) << 24) | cumulative_lost,
+            self.extended_max_sequence_number() & 0xFFFFFFFF,
+            int(self.jitter) & 0xFFFFFFFF,
+            last_sender_report,
+            delay & 0xFFFFFFFF,
+        )
+
+    def _restart(self, sequence_number):
+        self.base_sequence_number = sequence_number
+        self.max_sequence_number = sequence_number
+        self.cycles = 0
+        self.received = 0
+        self.expected_prior = 0
+        self.received_prior = 0
+
+
+class RTCPSession(asyncio.DatagramProtocol):
+    report_interval = 5.0
+
+    def __init__(self, reception_statistics):
+        self.reception_statistics = reception_statistics
+        self.rtp_sender = None
+        self.remote_address = None
+        self.transport = None
+        self.loop = None
+        self.report_handle = None
+        self.canonical_name = ('rotarygpt@' + socket.gethostname()).encode('utf-8')[:255]
+
+        # From the peer's sender reports, echoed back so it can measure the round trip too
+        self.last_sender_report = 0
+        self.last_sender_report_time = None
+
+        self.round_trip_time = None
+        self.remote_fraction_lost = None
+        self.remote_cumulative_lost = None
+        self.remote_jitter = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.loop = asyncio.get_running_loop()
+
+    def connection_lost(self, exc):
+        self._cancel_report()
+
+    def start(self, rtp_sender, remote_address, remote_port):
+        self.rtp_sender = rtp_sender
+        # No rtcp-mux negotiated, the peer listens one above its RTP port
+        self.remote_address = (remote_address, remote_port + 1)
+        self._schedule_report()
+
+    def stop(self):
+        self._cancel_report()
+        if self.rtp_sender is not None and self.transport is not None and not self.transport.is_closing():
+            bye = struct.pack('!BBHI', 0x81, PAYLOAD_TYPE_BYE, 1, self.rtp_sender.synchronization_source)
+            self._send(self._build_report() + bye)
+
+    def datagram_received(self, data, address):
+        self.handle_packet(data)
+
+    def handle_packet(self, data):
+        now = time.time()
+        offset = 0
+        # A compound packet is a sequence of RTCP packets, each with its own length
+        while offset + 8 <= len(data):
+            first_byte, payload_type, length = struct.unpack_from('!BBH', data, offset)
+            end = offset + (length + 1) * 4
+            if first_byte >> 6 != 2 or end > len(data):
+                return
+
+            count = first_byte & 0x1F
+            blocks_offset = offset + 8
+            if payload_type == PAYLOAD_TYPE_SR and end >= offset + 28:
+                ntp_most, ntp_least, _, _, _ = sender_info_struct.unpack_from(data, offset + 8)
+                self.last_sender_report = ((ntp_most & 0xFFFF) << 16) | (ntp_least >> 16)
+                self.last_sender_report_time = now
+                blocks_offset = offset + 28
+            elif payload_type != PAYLOAD_TYPE_RR:
+                offset = end
+                continue
+
+            for index in range(count):
+                block_offset = blocks_offset + index * report_block_struct.size
+                if block_offset + report_block_struct.size > end:
+                    break
+                self._handle_report_block(data, block_offset, now)
+
+            offset = end
+
+    def stats(self):
+        return {
+            'round_trip_time_ms': None if self.round_trip_time is None else round(self.round_trip_time * 1000, 1),
+            'remote_fraction_lost': self.remote_fraction_lost,
+            'remote_cumulative_lost': self.remote_cumulative_lost,
+            'remote_jitter_ms': None if self.remote_jitter is None else round(self.remote_jitter * 1000, 2),
+        }
+
+    def _handle_report_block(self, data, offset, now):
+        source, lost, _, jitter, last_sender_report, delay = report_block_struct.unpack_from(data, offset)
+        if self.rtp_sender is None or source != self.rtp_sender.synchronization_source:
+            return
+
+        self.remote_fraction_lost = (lost >> 24) / 256
+        cumulative_lost = lost & 0xFFFFFF
+        self.remote_cumulative_lost = cumulative_lost - 0x1000000 if cumulative_lost & 0x800000 else cumulative_lost
+        self.remote_jitter = jitter / SAMPLE_RATE
+
+        # https://datatracker.ietf.org/doc/html/rfc3550#section-6.4.1
+        if last_sender_report != 0:
+            round_trip = (ntp_middle_bits(now) - last_sender_report - delay) & 0xFFFFFFFF
+            if round_trip < 0x80000000:
+                self.round_trip_time = round_trip / 65536
+
+    def _schedule_report(self):
+        # Randomized to avoid synchronized reports, as RFC 3550 asks
+        self.report_handle = self.loop.call_later(self.report_interval * random.uniform(0.5, 1.5), self._send_report)
+
+    def _cancel_report(self):
+        if self.report_handle is not None:
+            self.report_handle.cancel()
+            self.report_handle = None
+
+    def _send_report(self):
+        self._send(self._build_report())
+        self._schedule_report()
+
+    def _build_report(self):
+        now = time.time()
+        blocks = b''
+        if self.reception_statistics.source is not None:
+            blocks = self.reception_statistics.report_block(self.last_sender_report, self.last_sender_report_time, now)
+        block_count = len(blocks) // report_block_struct.size
+
+        sender = self.rtp_sender
+        if sender.packets_sent > 0:
+            ntp_most, ntp_least = ntp_timestamp(now)
+            rtp_timestamp = (sender.last_timestamp + int((now - sender.last_send_time) * SAMPLE_RATE)) & 0xFFFFFFFF
+            body = sender_info_struct.pack(ntp_most, ntp_least, rtp_timestamp, sender.packets_sent & 0xFFFFFFFF,
+                                           sender.octets_sent & 0xFFFFFFFF) + blocks
+            report = struct.pack('!BBHI', 0x80 | block_count, PAYLOAD_TYPE_SR, (len(body) + 8) // 4 - 1,
+                                 sender.synchronization_source) + body
+        else:
+            report = struct.pack('!BBHI', 0x80 | block_count, PAYLOAD_TYPE_RR, (len(blocks) + 8) // 4 - 1,
+                                 sender.synchronization_source) + blocks
+
+        # SDES with CNAME, padded to a 32-bit boundary with at least one terminating zero
+        item = bytes([1, len(self.canonical_name)]) + self.canonical_name
+        item += b'\x00' * (4 - len(item) % 4)
+        chunk = struct.pack('!I', sender.synchronization_source) + item
+        description = struct.pack('!BBH', 0x81, PAYLOAD_TYPE_SDES, (len(chunk) + 4) // 4 - 1) + chunk
+
+        return report + description
+
+    def _send(self, data):
+        if self.transport is None or self.transport.is_closing():
+            return
+
+        try:
+            self.transport.sendto(data, self.remote_address)
+        except OSError:
+            logging.exception('Could not send RTCP report')
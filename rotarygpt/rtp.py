@@ -1,107 +1,341 @@
-import binascii
+import asyncio
 import logging
-import queue
-import socket
+import math
 import random
+import socket
+import struct
 import time
 
-from rotarygpt.audio import wave_header
+from rotarygpt.audio import mu_law_squared_table
+from rotarygpt.dtmf import event_digits
+from rotarygpt.jitter import JitterBuffer
+from rotarygpt.rtcp import ReceptionStatistics
+
+PAYLOAD_TYPE_PCMU = 0
+PAYLOAD_TYPE_CN = 13
+
+
+# Played out in place of a comfort noise packet from the phone, Whisper has no use for the noise itself
+comfort_noise_silence = memoryview(b'\xff' * 160)
+
+# RTP header fields up to and including the SSRC
+# https://datatracker.ietf.org/doc/html/rfc3550#section-5.1
+header_struct = struct.Struct('!BBHII')
+
+
+class RTPFrame:
+    __slots__ = ('buffer', 'view', 'payload', 'sequence_number', 'timestamp', 'source', 'arrival_time')
+
+    def __init__(self, size):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.payload = None
+        self.sequence_number = None
+        self.timestamp = None
+        self.source = None
+        self.arrival_time = None
+
+
+# Preallocated receive buffers, a frame goes back to the pool once its payload has been played out
+class FramePool:
+    def __init__(self, count, size):
+        self.size = size
+        self.free_frames = [RTPFrame(size) for _ in range(count)]
+
+    def acquire(self):
+        if self.free_frames:
+            return self.free_frames.pop()
+        return RTPFrame(self.size)
+
+    def release(self, frame):
+        frame.payload = None
+        self.free_frames.append(frame)
 
 
 class RTPReceiver:
 
-    def __init__(self, shared_socket, audio_chunk_queue):
-        self.audio_chunk_queue = audio_chunk_queue
+    def __init__(self, audio_buffer, recording = None, jitter_target_delay = 0.06):
+        self.audio_buffer = audio_buffer
+        self.recording = recording
+        self.frame_pool = FramePool(64, 1500)
+        self.jitter_buffer = JitterBuffer(jitter_target_delay, release_frame=self.frame_pool.release)
+        self.reception_statistics = ReceptionStatistics()
+        # Receives RTCP arriving on the RTP port, for peers multiplexing the two
+        self.rtcp_session = None
+        self.shared_socket = None
+        self.loop = None
+        self.playout_handle = None
+        # Dialed digits as RFC 4733 telephone events, with the payload type the phone offered for them
+        # https://datatracker.ietf.org/doc/html/rfc4733
+        self.telephone_event_payload_type = None
+        self.on_digit = None
+        self.last_event_timestamp = None
+
+    def start(self, shared_socket):
         self.shared_socket = shared_socket
-        self.shutdown_event = None
+        self.loop = asyncio.get_running_loop()
+        self.loop.add_reader(shared_socket.fileno(), self._read_ready)
 
-    def start(self, shutdown_event = None):
-        self.shutdown_event = shutdown_event
-
-        bind_address, bind_port = self.shared_socket.getsockname()
+        bind_address, bind_port = shared_socket.getsockname()
         logging.info(f'RTP receiver started on {bind_address}:{bind_port}')
 
-        self._receive_audio()
-
-        self.shared_socket.close()
+    def stop(self):
+        self._cancel_playout()
+        if self.shared_socket is not None and self.shared_socket.fileno() is not None:
+            self.loop.remove_reader(self.shared_socket.fileno())
 
-        logging.info(f'RTP receiver stopped')
+        logging.info(f'RTP receiver stopped, jitter buffer stats: {self.jitter_buffer.stats()}')
 
-    def _receive_audio(self):
-        self.shared_socket.settimeout(0.2)
-        while not self.shutdown_event.is_set():
+    def _read_ready(self):
+        # Draining everything the socket has, each packet straight into a pooled buffer
+        while True:
+            frame = self.frame_pool.acquire()
             try:
-                chunk, address = self.shared_socket.recvfrom(160 + 12)  # 20ms is 160 8bit samples plus header
-            except socket.timeout:
-                continue
-
-            self.audio_chunk_queue.put(chunk[12:])
+                size, _ = self.shared_socket.recvfrom_into(frame.buffer)
+            except (BlockingIOError, InterruptedError):
+                self.frame_pool.release(frame)
+                break
+            except OSError:
+                logging.exception('RTP receive failed')
+                self.frame_pool.release(frame)
+                break
+
+            frame.arrival_time = self.loop.time()
+            if not self._handle_packet(frame, size):
+                self.frame_pool.release(frame)
+
+        self._play_out()
+
+    def _play_out(self):
+        self._cancel_playout()
+
+        for chunk in self.jitter_buffer.pop_ready(self.loop.time()):
+            self.audio_buffer.write(chunk)
+
+            if self.recording is not None:
+                self.recording.add_inbound(chunk)
+
+        # Waking up for the next frame due from the jitter buffer
+        timeout = self.jitter_buffer.time_until_next(self.loop.time())
+        if timeout is not None:
+            self.playout_handle = self.loop.call_later(timeout, self._play_out)
+
+    def _cancel_playout(self):
+        if self.playout_handle is not None:
+            self.playout_handle.cancel()
+            self.playout_handle = None
+
+    def _handle_packet(self, frame, size):
+        # Returns whether the jitter buffer took the frame
+        if size < header_struct.size:
+            return False
+
+        first_byte, second_byte, sequence_number, timestamp, source = header_struct.unpack_from(frame.buffer)
+        if first_byte >> 6 != 2:
+            return False
+
+        # https://datatracker.ietf.org/doc/html/rfc5761#section-4
+        if 200 <= second_byte <= 204:
+            if self.rtcp_session is not None:
+                self.rtcp_session.handle_packet(bytes(frame.view[:size]))
+            return False
+
+        payload_type = second_byte & 0x7F
+        if payload_type != PAYLOAD_TYPE_PCMU and payload_type != PAYLOAD_TYPE_CN and \
+                payload_type != self.telephone_event_payload_type:
+            return False
+
+        header_length = 12 + 4 * (first_byte & 0x0F)
+        if first_byte & 0x10 and size >= header_length + 4:
+            header_length += 4 + 4 * int.from_bytes(frame.buffer[header_length + 2:header_length + 4], 'big')
+
+        payload_end = size
+        if first_byte & 0x20:
+            payload_end -= frame.buffer[size - 1]
+
+        if payload_end <= header_length:
+            return False
+
+        is_telephone_event = payload_type == self.telephone_event_payload_type
+        # Events share the sequence numbers of the audio, leaving them out would count every digit as lost
+        self.reception_statistics.update(source, sequence_number, timestamp, frame.arrival_time,
+                                         timing=not is_telephone_event)
+
+        if is_telephone_event:
+            self.jitter_buffer.skip(sequence_number)
+            self._handle_telephone_event(frame.buffer[header_length], timestamp)
+            return False
+
+        frame.payload = frame.view[header_length:payload_end] if payload_type == PAYLOAD_TYPE_PCMU else comfort_noise_silence
+        frame.sequence_number = sequence_number
+        frame.timestamp = timestamp
+        frame.source = source
+
+        return self.jitter_buffer.put(frame)
+
+    def _handle_telephone_event(self, event, timestamp):
+        # https://datatracker.ietf.org/doc/html/rfc4733#section-2.5.1
+        # Every packet of an event carries the timestamp of its start, and the last one is sent three times.
+        # Reporting the digit on the first packet that arrives, not waiting for the end of the tone.
+        if event >= len(event_digits) or timestamp == self.last_event_timestamp:
+            return
+        self.last_event_timestamp = timestamp
+
+        if self.on_digit is not None:
+            self.on_digit(event_digits[event])
 
 
 class RTPSender:
 
-    def __init__(self, shared_socket, connect_address, connect_port, audio_chunk_queue):
+    def __init__(self, shared_socket, connect_address, connect_port, audio_buffer, recording = None,
+                 comfort_noise = False):
         self.connect_address = connect_address
         self.connect_port = connect_port
-        self.audio_chunk_queue = audio_chunk_queue
+        self.audio_buffer = audio_buffer
         self.shared_socket = shared_socket
-        self.shutdown_event = None
         self.sequence_number = random.randint(0, 255)
         self.timer = random.randint(0, 255)
         self.synchronization_source = random.randint(0, 4294967295)
-
-        self.file = open('/tmp/conversation.wav', 'wb')
-        self.file.write(wave_header())
+        self.recording = recording
         self.marker_bit = True
 
-    def start(self, shutdown_event = None):
-        self.shutdown_event = shutdown_event
-
+        # Silence longer than this starts a new talkspurt
+        self.talkspurt_gap = 1.0
+        # Falling behind more than this re-anchors the schedule instead of sending a burst
+        self.max_catch_up = 0.06
+        self.late_threshold = 0.005
+        self.packets_sent = 0
+        self.octets_sent = 0
+        # For mapping wall clock to RTP time in sender reports
+        self.last_timestamp = self.timer
+        self.last_send_time = None
+        self.late_packets = 0
+        self.max_lateness = 0.0
+
+        # Silence suppression, only when the peer accepted comfort noise in the SDP
+        # https://datatracker.ietf.org/doc/html/rfc3389
+        self.comfort_noise = comfort_noise
+        # Frames quieter than this RMS level are silence, our own audio has no background noise to speak of
+        self.silence_level = 64
+        # Silent frames still sent as audio before suppressing, keeps short pauses between words intact
+        self.silence_hangover = 5
+        # Suppressed frames between comfort noise updates
+        self.comfort_noise_interval = 25
+        # Quietest noise level signalled, in -dBov. Even digital silence gets a faint hiss so the line doesn't sound dead.
+        self.comfort_noise_level = 70
+        self.silent_frames = 0
+        self.suppressed_packets = 0
+
+    async def start(self):
         logging.info(f'RTP sender started with peer {self.connect_address}:{self.connect_port}')
 
-        self._send_audio()
-
-        self.shared_socket.close()
-
-        self.file.close()
-        self.file = None
-
-        logging.info(f'RTP sender stopped')
-
-    def _send_audio(self):
-        chunk = b''
-        start_time = None
-        while not self.shutdown_event.is_set():
-            try:
-                chunk += self.audio_chunk_queue.get(block=False)
-            except queue.Empty:
+        try:
+            await self._send_audio()
+        finally:
+            logging.info(f'RTP sender stopped, {self.packets_sent} packets sent, {self.suppressed_packets} suppressed, ' +
+                         f'{self.late_packets} late (max {self.max_lateness * 1000:.1f}ms)')
+
+    async def _send_audio(self):
+        loop = asyncio.get_running_loop()
+        # Absolute time the next packet is due, packets are paced against it rather than against the previous send
+        deadline = None
+        while True:
+            # A view into the buffer, it stays valid until the next read
+            payload = self.audio_buffer.read_frame_nowait()
+            if payload is None:
+                if self.audio_buffer.closed:
+                    return
+                await self.audio_buffer.wait_for_frame()
                 continue
 
-            # New talkspurt
-            if start_time is None or time.perf_counter() - start_time > 1.0:
-                logging.debug(f'New talkspurt, marker bit set')
-                start_time = time.perf_counter()
+            now = loop.time()
+            if deadline is None or now - deadline > self.talkspurt_gap:
+                logging.debug('New talkspurt, marker bit set')
                 self.marker_bit = True
+                self.silent_frames = 0
+                deadline = self._skip_to(deadline, now)
+            elif now - deadline > self.max_catch_up:
+                # Ran out of audio mid-speech or stalled, not bursting the missed packets
+                deadline = self._skip_to(deadline, now)
+
+            noise_level = self._suppressed_noise_level(payload) if self.comfort_noise else None
+            # The first suppressed frame, and every interval after it, carries a comfort noise update
+            send_update = noise_level is not None and \
+                (self.silent_frames - self.silence_hangover - 1) % self.comfort_noise_interval == 0
+
+            # Suppressed frames wait for their slot too, the out buffer only drains as fast as the audio is played
+            if deadline > now:
+                await asyncio.sleep(deadline - now)
+                lateness = loop.time() - deadline
+                if lateness > self.late_threshold and (noise_level is None or send_update):
+                    self.late_packets += 1
+                    self.max_lateness = max(self.max_lateness, lateness)
+
+            if noise_level is None:
+                self._send_packet(payload)
+            elif send_update:
+                self._send_packet(bytes([noise_level]), PAYLOAD_TYPE_CN, payload)
+            else:
+                self._suppress_packet(payload)
+            deadline += 0.02
+
+    def _suppressed_noise_level(self, payload):
+        # Returns the noise level for a comfort noise packet when the frame is to be suppressed, None to send it
+        energy = sum(map(mu_law_squared_table.__getitem__, payload))
+        level = math.sqrt(energy / len(payload))
+
+        if level >= self.silence_level:
+            if self.silent_frames > self.silence_hangover:
+                # Speech resumes after suppressed packets, a new talkspurt
+                self.marker_bit = True
+            self.silent_frames = 0
+            return None
+
+        self.silent_frames += 1
+        if self.silent_frames <= self.silence_hangover:
+            return None
+
+        # https://datatracker.ietf.org/doc/html/rfc3389#section-3.1
+        if level == 0:
+            return self.comfort_noise_level
+        return min(self.comfort_noise_level, max(0, round(-20 * math.log10(level / 32768))))
+
+    def _skip_to(self, deadline, now):
+        # The timestamp reflects the sampling instant, so it keeps advancing over the gap
+        if deadline is not None:
+            skipped_packets = round((now - deadline) / 0.02)
+            self.timer = (self.timer + skipped_packets * 160) & 0xFFFFFFFF
+
+        return now
+
+    def _send_packet(self, payload, payload_type = PAYLOAD_TYPE_PCMU, audio = None):
+        # https://datatracker.ietf.org/doc/html/rfc3550#section-5.1
+        header = bytes([0x80, payload_type | 0x80 if self.marker_bit else payload_type])
+        header += self.sequence_number.to_bytes(2, 'big', signed=False)
+        header += self.timer.to_bytes(4, 'big', signed=False)
+        header += self.synchronization_source.to_bytes(4, 'big', signed=False)
+
+        self.shared_socket.sendto(header + payload, (self.connect_address, self.connect_port))
+        if self.recording is not None:
+            self.recording.add_outbound(payload if audio is None else audio)
+
+        self.last_timestamp = self.timer
+        self.last_send_time = time.time()
+        self.sequence_number = (self.sequence_number + 1) & 0xFFFF
+        # timer is incremented by the sample number, on out case 160 samples per packet (8 bit pcmu)
+        self.timer = (self.timer + 160) & 0xFFFFFFFF
+        self.marker_bit = False
+        self.packets_sent += 1
+        self.octets_sent += len(payload)
+
+    def _suppress_packet(self, audio):
+        # Nothing goes out, but the slot is used up so the timestamp still advances
+        if self.recording is not None:
+            self.recording.add_outbound(audio)
+
+        self.timer = (self.timer + 160) & 0xFFFFFFFF
+        self.suppressed_packets += 1
 
-            while len(chunk) >= 160:
-                # https://datatracker.ietf.org/doc/html/rfc3550#section-5.1
-                header = b'\x80\x80' if self.marker_bit else b'\x80\x00'
-                header += self.sequence_number.to_bytes(2, 'big', signed=False)
-                header += self.timer.to_bytes(4, 'big', signed=False)
-                header += self.synchronization_source.to_bytes(4, 'big', signed=False)
-
-                self.shared_socket.sendto(header + chunk[0:160], (self.connect_address, self.connect_port))
-                self.file.write(chunk[0:160])
-
-                chunk = chunk[160:]
-                self.sequence_number += 1
-                self.timer += 160 # timer is incremented by the sample number, on out case 160 samples per packet (8 bit pcmu)
-                self.marker_bit = False
-
-                sleep_time = 0.02 - (time.perf_counter() - start_time)
-                accurate_sleep(max(0.0, sleep_time))
-                # Correcting in case the sleep time was negative
-                start_time = time.perf_counter() + min(sleep_time, 0.0)
 
 class SharedSocket:
     def __init__(self):
@@ -112,21 +346,34 @@ class SharedSocket:
             return self.socket
 
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.socket.bind((bind_address, bind_port))
+        try:
+            self.socket.setblocking(False)
+            self.socket.bind((bind_address, bind_port))
+        except OSError:
+            # The port is taken, the next one is tried with a new socket
+            self.socket.close()
+            self.socket = None
+            raise
 
         return self.socket
 
-    def settimeout(self, timeout):
+    def fileno(self):
         if self.socket is not None:
-            self.socket.settimeout(timeout)
+            return self.socket.fileno()
 
-    def recvfrom(self, size):
-        if self.socket is not None:
-            return self.socket.recvfrom(size)
+    def recvfrom_into(self, buffer):
+        if self.socket is None:
+            raise BlockingIOError()
+        return self.socket.recvfrom_into(buffer)
 
     def sendto(self, data, address):
-        if self.socket is not None:
+        if self.socket is None:
+            return
+        try:
             self.socket.sendto(data, address)
+        except (BlockingIOError, InterruptedError):
+            # The send buffer is full, dropping the packet like the network would
+            pass
 
     def getsockname(self):
         if self.socket is not None:
@@ -136,9 +383,3 @@ class SharedSocket:
         if self.socket is not None:
             self.socket.close()
             self.socket = None
-
-def accurate_sleep(duration):
-    now = time.perf_counter()
-    end = now + duration
-    while now < end:
-        now = time.perf_counter()
\ No newline at end of file
@@ -0,0 +1,64 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from rotarygpt.media import MediaSession
+from rotarygpt.sip import SIPServer
+
+
+async def allocate_session(sessions, port_pool, function_manager, prompt_store, recording_manager, shortcut_store,
+                           call_id):
+    while True:
+        port = port_pool.allocate()
+        if port is None:
+            logging.warning(f'No free RTP port for call {call_id}')
+            return None
+
+        session = MediaSession(call_id, '0.0.0.0', port, function_manager, prompt_store, recording_manager,
+                               shortcut_store)
+        try:
+            await session.bind()
+        except OSError:
+            # Taken by something else, leaving it out of the pool
+            logging.exception(f'Could not bind RTP port {port}')
+            continue
+
+        sessions[call_id] = session
+        return port
+
+
+def start_session(sessions, call_id, ip, port, comfort_noise, telephone_event):
+    sessions[call_id].start(ip, port, comfort_noise, telephone_event)
+
+
+async def finish_session(sessions, port_pool, call_id):
+    session = sessions.pop(call_id, None)
+    if session is None:
+        return
+
+    await session.stop()
+    port_pool.release(session.port)
+
+
+async def serve(function_manager, prompt_store, recording_manager, port_pool, sip_address = '0.0.0.0', sip_port = 5060,
+                shutdown_event = None, shortcut_store = None):
+    sessions = {}
+    # Every conversation holds an executor thread for the whole call, and two more while it streams a reply from GPT
+    # through Polly. The default pool of a few threads per core would leave calls beyond it waiting silently for one.
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=3 * len(port_pool.free_ports) + 4))
+
+    sip_server = SIPServer(sip_address, sip_port)
+
+    sip_server.register_media_allocator(partial(allocate_session, sessions, port_pool, function_manager,
+                                                prompt_store, recording_manager, shortcut_store))
+    sip_server.register_incoming_call_callback(partial(start_session, sessions))
+    sip_server.register_call_ended_callback(partial(finish_session, sessions, port_pool))
+
+    if shutdown_event is None:
+        shutdown_event = asyncio.Event()
+    try:
+        await sip_server.start(shutdown_event)
+    finally:
+        for call_id in list(sessions.keys()):
+            await finish_session(sessions, port_pool, call_id)
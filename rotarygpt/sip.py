@@ -1,52 +1,161 @@
+import asyncio
+import inspect
 import logging
+import random
 import re
-import socket
 import time
 
-
-class SIPServer:
+from rotarygpt.rtp import PAYLOAD_TYPE_CN, PAYLOAD_TYPE_PCMU
+
+
+# RFC 3261 timer values for UDP
+# https://datatracker.ietf.org/doc/html/rfc3261#appendix-A
+T1 = 0.5
+T2 = 4.0
+T4 = 5.0
+
+ALLOWED_METHODS = b'INVITE, ACK, CANCEL, BYE, OPTIONS'
+
+branch_regex = re.compile(rb';\s*branch=([^;,\s]+)', re.IGNORECASE)
+line_break_regex = re.compile(rb'\r?\n')
+request_line_regex = re.compile(rb'([A-Za-z]+) (\S+) SIP/2\.0$')
+sip_host_regex = re.compile(rb"sip:(?:[^@>;\s]+@)?(?P<host>[a-zA-Z0-9.-]+)")
+sdp_media_regex = re.compile(r'(\w+) (\d+)(?:/\d+)? (\S+)\s*(.*)$')
+sdp_connection_regex = re.compile(r'IN IP4 ([0-9.]+)')
+
+# https://datatracker.ietf.org/doc/html/rfc3261#section-7.3.3
+compact_header_names = {
+    b'i': b'Call-ID', b'm': b'Contact', b'e': b'Content-Encoding', b'l': b'Content-Length', b'c': b'Content-Type',
+    b'f': b'From', b's': b'Subject', b'k': b'Supported', b't': b'To', b'v': b'Via',
+}
+# Lower case and compact names to the canonical ones
+header_names = {name.lower(): name for name in (
+    b'Via', b'To', b'From', b'Call-ID', b'CSeq', b'Contact', b'Content-Length', b'Content-Type', b'Content-Encoding',
+    b'Max-Forwards', b'Allow', b'Accept', b'Supported', b'Subject', b'User-Agent', b'Route', b'Record-Route', b'Expires',
+)}
+header_names.update(compact_header_names)
+# One value of a comma separated header, a stray quote or bracket is skipped
+header_value_regex = re.compile(rb'(?:"(?:\\.|[^"\\])*"|<[^>]*>|[^,"<])+')
+multi_value_headers = {b'Via', b'Contact', b'Route', b'Record-Route', b'Allow', b'Accept', b'Supported'}
+required_headers = (b'Via', b'To', b'From', b'Call-ID', b'CSeq')
+folding_characters = (b' ', b'\t')
+
+
+# https://datatracker.ietf.org/doc/html/rfc3261#section-17.2
+class ServerTransaction:
+    def __init__(self, key, request):
+        self.key = key
+        self.request = request
+        self.last_response = None
+        self.is_final = False
+        self.timers = []
+
+    def cancel_timers(self):
+        for timer in self.timers:
+            timer.cancel()
+        self.timers = []
+
+
+class Call:
+    def __init__(self, call_id, local_tag):
+        self.call_id = call_id
+        self.local_tag = local_tag
+        self.invite_transaction = None
+        self.response = None
+        self.address = None
+        self.acknowledged = False
+        self.retransmit_handle = None
+
+
+class SIPServer(asyncio.DatagramProtocol):
     def __init__(self, bind_address, bind_port):
         self.bind_address = bind_address
         self.bind_port = bind_port
-        self.socket = None
-        self.shutdown_event = None
+        self.transport = None
+        self.loop = None
 
+        self.media_allocator = None
         self.incoming_call_callbacks = []
         self.call_ended_callbacks = []
-        self.in_call = False
+        # Keyed by the top Via branch, the Call-ID and the method, ACK belonging to its INVITE
+        self.transactions = {}
+        # Call-ID to the dialog established by our 200 OK
+        self.calls = {}
         self.socket_start_time = None
 
+    def register_media_allocator(self, callback):
+        self.media_allocator = callback
+
     def register_incoming_call_callback(self, callback):
         self.incoming_call_callbacks.append(callback)
 
     def register_call_ended_callback(self, callback):
         self.call_ended_callbacks.append(callback)
 
-    def start(self, shutdown_event = None):
-        self.shutdown_event = shutdown_event
-        self._bind_socket()
+    async def start(self, shutdown_event):
+        self.loop = asyncio.get_running_loop()
+        await self._bind_socket()
+
+        while not shutdown_event.is_set():
+            try:
+                await asyncio.wait_for(shutdown_event.wait(), 1.0)
+            except asyncio.TimeoutError:
+                pass
 
-        while True:
-            request = self._receive_request()
-            if request is None:
-                break
+            if time.time() - self.socket_start_time > 60 and not self.calls and not self.transactions:
+                logging.info(f'Periodic SIP socket restart')
+                await self._bind_socket()
 
-            logging.info(f'Incoming SIP request {request.method}')
-            logging.debug(request.to_sip_message())
+        for transaction in self.transactions.values():
+            transaction.cancel_timers()
+        for call in self.calls.values():
+            self._stop_retransmitting(call)
 
-            self._handle_request(request)
+        self.transport.close()
+        self.transport = None
 
         logging.info('SIP server stopped')
 
-    def _bind_socket(self):
+    def datagram_received(self, data, address):
+        # Over UDP a datagram carries exactly one message
+        request = SIPRequest(address)
+        try:
+            request.parse(data)
+        except SIPParseError as error:
+            logging.warning(f'Dropping SIP message from {address[0]}:{address[1]}: {error}')
+            return
+
+        logging.info(f'Incoming SIP request {request.method}')
+        logging.debug(request.to_sip_message())
+
+        if request.method == b'ACK':
+            self._handle_ack(request)
+            return
+
+        # Matched before anything is awaited, so a retransmission never starts a second transaction
+        key = self._transaction_key(request)
+        transaction = self.transactions.get(key)
+        if transaction is not None:
+            logging.debug(f'Retransmitted {request.method}, repeating the last response')
+            if transaction.last_response is not None:
+                self._send_response(transaction.last_response, request.from_address)
+            return
+
+        transaction = ServerTransaction(key, request)
+        self.transactions[key] = transaction
+        self.loop.create_task(self._handle_request(transaction))
+
+    async def _bind_socket(self):
         is_restart = None
-        if self.socket is not None:
-            self.socket.close()
+        if self.transport is not None:
+            self.transport.close()
+            # Letting the loop release the socket before binding the port again
+            await asyncio.sleep(0)
             is_restart = True
 
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        server_address_sip = (self.bind_address, self.bind_port)
-        self.socket.bind(server_address_sip)
+        self.transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: self, local_addr=(self.bind_address, self.bind_port)
+        )
         self.socket_start_time = time.time()
 
         if is_restart:
@@ -54,185 +163,476 @@ class SIPServer:
         else:
             logging.info(f'SIP server started on {self.bind_address}:{self.bind_port}')
 
-    def _receive_request(self):
-        data = b''
-        while not self.shutdown_event.is_set():
-            try:
-                self.socket.settimeout(0.2)
-                chunk, address = self.socket.recvfrom(4096)
-                self.socket.settimeout(None)
-            except socket.timeout:
-                if time.time() - self.socket_start_time > 60 and data == b'' and not self.in_call:
-                    logging.info(f'Periodic SIP socket restart')
-                    self._bind_socket()
-                continue
-
-            data += chunk
-
-            if b'\r\n\r\n' in data:
-                header, body_so_far = data.split(b'\r\n\r\n', 1)
-                request = SIPRequest(address)
-                request.parse_request_header(header)
-
-                if b'Content-Length' in request.headers:
-                    content_length = int(request.headers[b'Content-Length']) - len(body_so_far)
-                    while len(body_so_far) < content_length:
-                        chunk = self.socket.recvfrom(content_length - len(body_so_far))
-                        body_so_far += chunk
-
-                    request.body = body_so_far
-
-                return request
-
-        self.socket.close()
-        self.socket = None
-
-        return None
-
-    def _handle_request(self, request):
-        if request.method == b'INVITE':
-            if self.in_call:
-                return
-
-            response = SipResponse(200, b"OK")
-            response.headers[b'Via'] = request.headers[b'Via']
-            response.headers[b'To'] = request.headers[b'To']
-            response.headers[b'From'] = request.headers[b'From']
-            response.headers[b'Contact'] = request.headers[b'To']
-            response.headers[b'Call-ID'] = request.headers[b'Call-ID']
-            response.headers[b'CSeq'] = request.headers[b'CSeq']
-            response.headers[b'Content-type'] = b'application/sdp'
-
-            to_host = self._extract_sip_host(request.headers[b'To'].decode('ascii')).encode('ascii')
-
-            response.body = b"""v=0
+    async def _handle_request(self, transaction):
+        method = transaction.request.method
+        if method == b'INVITE':
+            await self._handle_invite(transaction)
+        elif method == b'BYE':
+            await self._handle_bye(transaction)
+        elif method == b'CANCEL':
+            await self._handle_cancel(transaction)
+        elif method == b'OPTIONS':
+            response = self._create_response(transaction.request, 200, b"OK")
+            response.headers[b'Allow'] = ALLOWED_METHODS
+            response.headers[b'Accept'] = b'application/sdp'
+            self._respond(transaction, response)
+        else:
+            response = self._create_response(transaction.request, 405, b"Method Not Allowed")
+            response.headers[b'Allow'] = ALLOWED_METHODS
+            self._respond(transaction, response)
+
+    async def _handle_invite(self, transaction):
+        request = transaction.request
+        call_id = request.header(b'Call-ID')
+
+        # Stops the phone from retransmitting while the media is set up
+        self._respond(transaction, self._create_response(request, 100, b"Trying"))
+
+        if call_id in self.calls:
+            # A re-INVITE, answering with the session as it is
+            call = self.calls[call_id]
+            response = self._create_response(request, 200, b"OK", call.local_tag)
+            for name in (b'Contact', b'Content-Type'):
+                response.headers[name] = call.response.headers[name]
+            response.body = call.response.body
+            self._answer(call, transaction, response)
+            return
+
+        try:
+            offer = SessionDescription().parse(request.body)
+        except SIPParseError:
+            offer = None
+        audio = offer.audio() if offer is not None else None
+
+        if audio is None or PAYLOAD_TYPE_PCMU not in audio.formats:
+            self._respond(transaction, self._create_response(request, 488, b"Not Acceptable Here"))
+            return
+
+        port = audio.port
+        address = offer.address(audio)
+        if address is None or address == '0.0.0.0':
+            address = request.from_address[0]
+        # Comfort noise is only answered, and used for silence suppression, when the phone offers it
+        comfort_noise = PAYLOAD_TYPE_CN in audio.formats
+        # Dialed digits, answered with whatever dynamic payload type the phone picked for them
+        telephone_event = audio.payload_type('telephone-event/8000')
+
+        # Our address as the phone knows it, for the connection line of the answer
+        to_host = self._extract_sip_host(request.header(b'To')) or self._extract_sip_host(request.uri)
+        if to_host is None:
+            self._respond(transaction, self._create_response(request, 400, b"Bad Request"))
+            return
+
+        local_port = await self._call(self.media_allocator, call_id) if self.media_allocator is not None else None
+
+        if transaction.is_final:
+            # Cancelled while the media was being set up
+            if local_port is not None:
+                await self._end_call(call_id)
+            return
+
+        if local_port is None:
+            self._respond(transaction, self._create_response(request, 486, b"Busy Here"))
+            return
+
+        call = Call(call_id, self._new_tag())
+        call.address = request.from_address
+        self.calls[call_id] = call
+
+        self._respond(transaction, self._create_response(request, 180, b"Ringing", call.local_tag))
+
+        payload_types = b'0 13' if comfort_noise else b'0'
+        rtpmap = b'a=rtpmap:0 PCMU/8000\n' + (b'a=rtpmap:13 CN/8000\n' if comfort_noise else b'')
+        if telephone_event is not None:
+            event_payload_type = str(telephone_event).encode('ascii')
+            payload_types += b' ' + event_payload_type
+            # https://datatracker.ietf.org/doc/html/rfc4733#section-7.1.1
+            rtpmap += b'a=rtpmap:' + event_payload_type + b' telephone-event/8000\n' + \
+                      b'a=fmtp:' + event_payload_type + b' 0-15\n'
+
+        response = self._create_response(request, 200, b"OK", call.local_tag)
+        response.headers[b'Contact'] = request.header(b'To')
+        response.headers[b'Content-Type'] = b'application/sdp'
+        response.body = (b"""v=0
 o=RotaryGPT 1 1 IN IP4 """ + to_host + b"""
 s=SIP Call
 c=IN IP4 """ + to_host + b"""
 t=0 0
-m=audio 5004 RTP/AVP 0
+m=audio """ + str(local_port).encode('ascii') + b" RTP/AVP " + payload_types + b"""
 a=sendrecv
-a=rtpmap:0 PCMU/8000
-a=ptime:20
-""".replace(b"\n", b"\r\n")
-
-            self.socket.sendto(response.to_sip_message(), request.from_address)
-            self.in_call = True
-
-            logging.info(f'SIP response sent {response.status_code}')
-            logging.debug(response.to_sip_message())
-
-            regex = r"audio (\d+) RTP"
-            match = re.search(regex, request.body.decode('ascii'))
-
-            if not match:
-                return
+""" + rtpmap + b"""a=ptime:20
+""").replace(b"\n", b"\r\n")
+
+        self._answer(call, transaction, response)
+
+        logging.debug(f'Calling incoming call callbacks with client RTP address {address}:{port}')
+        for callback in self.incoming_call_callbacks:
+            await self._call(callback, call_id, address, port, comfort_noise, telephone_event)
+
+        logging.debug(f'Finished incoming call callbacks')
+
+    async def _handle_bye(self, transaction):
+        request = transaction.request
+        call_id = request.header(b'Call-ID')
+        if call_id not in self.calls:
+            self._respond(transaction, self._create_response(request, 481, b"Call/Transaction Does Not Exist"))
+            return
+
+        response = self._create_response(request, 200, b"OK")
+        response.headers[b'Contact'] = request.header(b'To')
+        self._respond(transaction, response)
+
+        await self._end_call(call_id)
+
+    async def _handle_cancel(self, transaction):
+        # https://datatracker.ietf.org/doc/html/rfc3261#section-9.2
+        request = transaction.request
+        invite_key = (transaction.key[0], transaction.key[1], b'INVITE')
+        invite_transaction = self.transactions.get(invite_key)
+        if invite_transaction is None:
+            self._respond(transaction, self._create_response(request, 481, b"Call/Transaction Does Not Exist"))
+            return
+
+        self._respond(transaction, self._create_response(request, 200, b"OK"))
+        if invite_transaction.is_final:
+            # Already answered, the phone has to send a BYE instead
+            return
+
+        call_id = request.header(b'Call-ID')
+        local_tag = self.calls[call_id].local_tag if call_id in self.calls else None
+        self._respond(invite_transaction,
+                      self._create_response(invite_transaction.request, 487, b"Request Terminated", local_tag))
+        if call_id in self.calls:
+            await self._end_call(call_id)
+
+    def _handle_ack(self, request):
+        # An ACK for a failure response belongs to the INVITE transaction
+        transaction = self.transactions.get(self._transaction_key(request))
+        if transaction is not None and transaction.is_final and transaction.last_response.status_code >= 300:
+            transaction.cancel_timers()
+            # Absorbing retransmitted ACKs for a while
+            transaction.timers.append(self.loop.call_later(T4, self._terminate_transaction, transaction))
+            return
+
+        # An ACK for a 200 OK is a transaction of its own, matched to the dialog
+        call = self.calls.get(request.header(b'Call-ID'))
+        if call is not None and not call.acknowledged:
+            logging.debug(f'Call {call.call_id} acknowledged')
+            call.acknowledged = True
+            self._stop_retransmitting(call)
+            self._terminate_transaction(call.invite_transaction)
+
+    def _respond(self, transaction, response):
+        self._send_response(response, transaction.request.from_address)
+        transaction.last_response = response
+
+        if response.status_code < 200 or transaction.is_final:
+            return
+        transaction.is_final = True
+
+        if transaction.request.method != b'INVITE':
+            # Timer J, absorbing retransmitted requests
+            transaction.timers.append(self.loop.call_later(64 * T1, self._terminate_transaction, transaction))
+        elif response.status_code >= 300:
+            # Timers G and H, repeating the failure until it is acknowledged
+            transaction.timers.append(self.loop.call_later(T1, self._retransmit_failure, transaction, T1))
+            transaction.timers.append(self.loop.call_later(64 * T1, self._terminate_transaction, transaction))
+        # A 200 OK is retransmitted by the dialog, the transaction lives until the ACK
+
+    def _retransmit_failure(self, transaction, interval):
+        self._send_response(transaction.last_response, transaction.request.from_address)
+        interval = min(2 * interval, T2)
+        transaction.timers.append(self.loop.call_later(interval, self._retransmit_failure, transaction, interval))
+
+    def _answer(self, call, transaction, response):
+        # https://datatracker.ietf.org/doc/html/rfc3261#section-13.3.1.4
+        self._stop_retransmitting(call)
+        call.invite_transaction = transaction
+        call.response = response
+        call.acknowledged = False
+
+        self._respond(transaction, response)
+        call.retransmit_handle = self.loop.call_later(T1, self._retransmit_success, call, T1, T1)
+
+    def _retransmit_success(self, call, interval, elapsed):
+        if call.acknowledged or self.calls.get(call.call_id) is not call:
+            return
+
+        if elapsed >= 64 * T1:
+            logging.warning(f'No ACK for call {call.call_id}, ending it')
+            self._terminate_transaction(call.invite_transaction)
+            self.loop.create_task(self._end_call(call.call_id))
+            return
+
+        logging.debug(f'Retransmitting 200 OK for call {call.call_id}')
+        self._send_response(call.response, call.address)
+        interval = min(2 * interval, T2)
+        call.retransmit_handle = self.loop.call_later(interval, self._retransmit_success, call, interval,
+                                                      elapsed + interval)
+
+    def _stop_retransmitting(self, call):
+        if call.retransmit_handle is not None:
+            call.retransmit_handle.cancel()
+            call.retransmit_handle = None
+
+    def _terminate_transaction(self, transaction):
+        transaction.cancel_timers()
+        if self.transactions.get(transaction.key) is transaction:
+            del self.transactions[transaction.key]
+
+    async def _end_call(self, call_id):
+        call = self.calls.pop(call_id, None)
+        if call is not None:
+            self._stop_retransmitting(call)
+
+        logging.debug(f'Calling call ended callbacks')
+        for callback in self.call_ended_callbacks:
+            await self._call(callback, call_id)
+
+        logging.debug(f'Finished call ended callbacks')
+
+    def _send_response(self, response, address):
+        if self.transport is None:
+            return
+
+        message = response.to_sip_message()
+        self.transport.sendto(message, address)
+
+        logging.info(f'SIP response sent {response.status_code}')
+        logging.debug(message)
 
-            port = int(match.group(1))
-
-            logging.debug(f'Calling incoming call callbacks with client RTP address {request.from_address[0]}:{port}')
-            for callback in self.incoming_call_callbacks:
-                callback(request.from_address[0], port)
-
-            logging.debug(f'Finished incoming call callbacks')
-
-        elif request.method == b'BYE':
-            if not self.in_call:
-                return
+    @staticmethod
+    async def _call(callback, *args):
+        # Callbacks may be plain functions or coroutines
+        result = callback(*args)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
 
-            self.in_call = False
+    @staticmethod
+    def _transaction_key(request):
+        # https://datatracker.ietf.org/doc/html/rfc3261#section-17.2.3
+        # The top Via is the one added by the phone
+        match = branch_regex.search(request.header(b'Via', b''))
+        # Peers predating RFC 3261 have no branch, the CSeq number tells their transactions apart
+        branch = match.group(1) if match else request.header(b'CSeq', b'').split(b' ')[0]
+        method = b'INVITE' if request.method == b'ACK' else request.method
+        return branch, request.header(b'Call-ID'), method
 
-            response = SipResponse(200, b"OK")
-            response.headers[b'Via'] = request.headers[b'Via']
-            response.headers[b'To'] = request.headers[b'To']
-            response.headers[b'From'] = request.headers[b'From']
-            response.headers[b'Contact'] = request.headers[b'To']
-            response.headers[b'Call-ID'] = request.headers[b'Call-ID']
-            response.headers[b'CSeq'] = request.headers[b'CSeq']
+    @staticmethod
+    def _new_tag():
+        return '{:08x}'.format(random.getrandbits(32)).encode('ascii')
 
-            self.socket.sendto(response.to_sip_message(), request.from_address)
+    def _create_response(self, request, status_code, status_message, local_tag = None):
+        response = SipResponse(status_code, status_message)
+        self._copy_dialog_headers(request, response)
 
-            logging.info(f'SIP response sent {response.status_code}')
-            logging.debug(response.to_sip_message())
+        # Every response but 100 Trying identifies our side of the dialog
+        to = request.header(b'To')
+        if status_code != 100 and b';tag=' not in to.lower():
+            response.headers[b'To'] = to + b';tag=' + (local_tag if local_tag is not None else self._new_tag())
 
-            logging.debug(f'Calling call ended callbacks')
-            for callback in self.call_ended_callbacks:
-                callback()
+        return response
 
-            logging.debug(f'Finished call ended callbacks')
+    @staticmethod
+    def _copy_dialog_headers(request, response):
+        # Every Via, in order, the response travels back along them
+        response.headers[b'Via'] = request.headers[b'Via']
+        response.headers[b'To'] = request.header(b'To')
+        response.headers[b'From'] = request.header(b'From')
+        response.headers[b'Call-ID'] = request.header(b'Call-ID')
+        response.headers[b'CSeq'] = request.header(b'CSeq')
 
     @staticmethod
     def _extract_sip_host(sip_address):
-        sip_address = sip_address.strip('<> ')
-        sip_uri_pattern = r"sip:(?P<host>[a-zA-Z0-9.-]+)"
-        sip_uri_regex = re.compile(sip_uri_pattern)
-        match = sip_uri_regex.search(sip_address)
+        match = sip_host_regex.search(sip_address)
 
         if match:
             return match.group("host")
         return None
 
+class SIPParseError(ValueError):
+    pass
+
+
 class SIPRequest:
     def __init__(self, from_address):
         self.from_address = from_address
         self.method = None
         self.uri = None
+        # Canonical header name to the list of its values, in the order they arrived
         self.headers = {}
         self.body = None
 
-    def parse_request_header(self, data):
-        lines = data.split(b'\r\n')
-        request_line = lines[0].split(b' ')
-        self.method = request_line[0]
-        self.uri = request_line[1]
-
+    def header(self, name, default = None):
+        values = self.headers.get(name)
+        return values[0] if values else default
+
+    def parse(self, data):
+        header_end = data.find(b'\r\n\r\n')
+        body_start = header_end + 4
+        if header_end < 0:
+            # Tolerating bare line feeds
+            header_end = data.find(b'\n\n')
+            body_start = header_end + 2
+            if header_end < 0:
+                raise SIPParseError('No end of header')
+
+        lines = line_break_regex.split(data[:header_end])
+        match = request_line_regex.match(lines[0])
+        if not match:
+            raise SIPParseError('Not a SIP request')
+        self.method, self.uri = match.groups()
+
+        headers = self.headers
+        values = None
         for line in lines[1:]:
-            if line == '':
-                break
-
-            key, value = line.split(b':', 1)
-
-            key = key.strip()
-            value = value.strip()
+            if line[:1] in folding_characters:
+                # https://datatracker.ietf.org/doc/html/rfc3261#section-7.3.1
+                if values is None:
+                    raise SIPParseError('Continuation line without a header')
+                values[-1] += b' ' + line.strip()
+                continue
 
-            self.headers[key] = value
+            name, separator, value = line.partition(b':')
+            name = name.rstrip()
+            if not separator or not name:
+                raise SIPParseError('Malformed header line')
+
+            name = header_names.get(name.lower(), name)
+            values = headers.get(name)
+            if values is None:
+                values = headers[name] = []
+            values.append(value.strip())
+
+        # Splitting after the whole header is read, a folded line may hold more values
+        for name in multi_value_headers:
+            values = headers.get(name)
+            if values is not None and any(b',' in value for value in values):
+                headers[name] = [single_value for value in values for single_value in split_header_values(value)]
+
+        for name in required_headers:
+            if name not in self.headers:
+                raise SIPParseError('Missing ' + name.decode('ascii'))
+
+        body = data[body_start:]
+        content_length = self.header(b'Content-Length')
+        if content_length is not None:
+            if not content_length.isdigit():
+                raise SIPParseError('Invalid Content-Length')
+            if len(body) < int(content_length):
+                raise SIPParseError('Truncated body')
+            body = body[:int(content_length)]
+        self.body = body
+
+        return self
 
     def to_sip_message(self):
-        message = self.method + b" " + self.uri + b" SIP/2.0\r\n"
-
-        for header_key, header_value in self.headers.items():
-            message += header_key + b": " + header_value + b"\r\n"
-
-        message += b"\r\n"
-
-        if self.body:
-            message += self.body
-
-        return message
+        return serialize_message(self.method + b" " + self.uri + b" SIP/2.0", self.headers, self.body)
 
 class SipResponse:
     def __init__(self, status_code, status_message):
         self.status_code = status_code
         self.status_message = status_message
+        # Values are bytes, or lists of bytes for repeated headers
         self.headers = {}
         self.body = None
 
     def to_sip_message(self):
-        message = b"SIP/2.0 " + str(self.status_code).encode('ascii') + b" " + self.status_message + b"\r\n"
-
-        headers_to_send = self.headers.copy()
+        start_line = b"SIP/2.0 " + str(self.status_code).encode('ascii') + b" " + self.status_message
+        return serialize_message(start_line, self.headers, self.body)
+
+
+def serialize_message(start_line, headers, body):
+    # Collecting the parts and joining them once
+    parts = [start_line, b"\r\n"]
+    for name, value in headers.items():
+        if name == b'Content-Length':
+            continue
+        for single_value in (value if isinstance(value, list) else (value,)):
+            parts += (name, b": ", single_value, b"\r\n")
+
+    parts += (b"Content-Length: ", str(len(body) if body else 0).encode('ascii'), b"\r\n\r\n")
+    if body:
+        parts.append(body)
+
+    return b"".join(parts)
+
+
+def split_header_values(value):
+    # Commas inside quoted strings and <> enclosed URIs do not separate values
+    values = (single_value.strip() for single_value in header_value_regex.findall(value))
+    return [single_value for single_value in values if single_value]
+
+
+class MediaDescription:
+    def __init__(self, media, port, protocol, formats):
+        self.media = media
+        self.port = port
+        self.protocol = protocol
+        # Payload type numbers, in order of preference
+        self.formats = formats
+        self.connection_address = None
+        # Payload type number to encoding, e.g. 0 to 'PCMU/8000'
+        self.rtpmap = {}
+        self.attributes = []
+
+    def payload_type(self, encoding):
+        # The dynamic payload type offered for an encoding such as 'telephone-event/8000'
+        for payload_type in self.formats:
+            if 96 <= payload_type <= 127 and self.rtpmap.get(payload_type, '').lower() == encoding:
+                return payload_type
+        return None
 
-        if self.body:
-            headers_to_send[b'Content-Length'] = str(len(self.body)).encode('ascii')
-        else:
-            headers_to_send[b'Content-Length'] = "0".encode('ascii')
 
-        for header_key, header_value in headers_to_send.items():
-            message += header_key + b": " + header_value + b"\r\n"
+# https://datatracker.ietf.org/doc/html/rfc4566#section-5
+class SessionDescription:
+    def __init__(self):
+        self.connection_address = None
+        self.media = []
+        self.attributes = []
 
-        message += b"\r\n"
+    def parse(self, body):
+        media = None
+        for line in body.decode('utf-8', 'replace').splitlines():
+            if len(line) < 2 or line[1] != '=':
+                continue
 
-        if self.body:
-            message += self.body
+            kind, value = line[0], line[2:].strip()
+            if kind == 'm':
+                match = sdp_media_regex.match(value)
+                if not match:
+                    raise SIPParseError('Malformed media line')
+                media_type, port, protocol, formats = match.groups()
+                media = MediaDescription(media_type, int(port), protocol,
+                                         [int(payload_type) for payload_type in formats.split() if payload_type.isdecimal()])
+                self.media.append(media)
+            elif kind == 'c':
+                match = sdp_connection_regex.match(value)
+                if match:
+                    if media is None:
+                        self.connection_address = match.group(1)
+                    else:
+                        media.connection_address = match.group(1)
+            elif kind == 'a':
+                name, _, attribute_value = value.partition(':')
+                if media is None:
+                    self.attributes.append((name, attribute_value))
+                    continue
+                media.attributes.append((name, attribute_value))
+                if name == 'rtpmap':
+                    payload_type, _, encoding = attribute_value.partition(' ')
+                    if payload_type.isdecimal():
+                        media.rtpmap[int(payload_type)] = encoding.strip()
+
+        return self
+
+    def audio(self):
+        # The first audio stream that is not disabled
+        for media in self.media:
+            if media.media == 'audio' and media.port != 0 and media.protocol == 'RTP/AVP':
+                return media
+        return None
 
-        return message
\ No newline at end of file
+    def address(self, media):
+        return media.connection_address or self.connection_address
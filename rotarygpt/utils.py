@@ -1,9 +0,0 @@
-import queue
-
-def clear_queue(queue_to_empty):
-    while not queue_to_empty.empty():
-        try:
-            queue_to_empty.get(block=False)
-        except queue.Empty:
-            continue
-        queue_to_empty.task_done()
\ No newline at end of file
@@ -0,0 +1,61 @@
+import unittest
+
+from rotarygpt.ringbuffer import AudioRingBuffer, OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST
+
+
+class AudioRingBufferTest(unittest.TestCase):
+    def test_drop_oldest_keeps_the_frame_being_read(self):
+        buffer = AudioRingBuffer(4, OVERFLOW_DROP_OLDEST, frame_size=2)
+        buffer.write(b'AABBCCDD')
+
+        frame = buffer.read_frame_nowait()
+        self.assertEqual(bytes(frame), b'AA')
+
+        # Full again, the write drops the oldest unread frame
+        buffer.write(b'EE')
+        buffer.write(b'FF')
+        self.assertEqual(bytes(frame), b'AA')
+        self.assertEqual(buffer.dropped, 2)
+        self.assertEqual([bytes(buffer.read_frame_nowait()) for _ in range(4)], [b'CC', b'DD', b'EE', b'FF'])
+
+    def test_block_reserves_the_frame_being_read(self):
+        buffer = AudioRingBuffer(4, OVERFLOW_BLOCK, frame_size=2)
+        buffer.write(b'AABBCC')
+
+        frame = buffer.read_frame_nowait()
+        buffer.write(b'DD')
+        # The only free slot is the reserved one, nothing more fits until the next read
+        self.assertEqual(len(buffer), 6)
+        self.assertEqual(bytes(frame), b'AA')
+
+    def test_flush_keeps_the_frame_being_read(self):
+        buffer = AudioRingBuffer(4, OVERFLOW_BLOCK, frame_size=2)
+        buffer.write(b'AABBCC')
+
+        frame = buffer.read_frame(timeout=0)
+        buffer.flush()
+        # Everything but the reserved frame is free again
+        buffer.write(b'DDEEFF')
+        self.assertEqual(bytes(frame), b'AA')
+        self.assertEqual([bytes(buffer.read_frame_nowait()) for _ in range(3)], [b'DD', b'EE', b'FF'])
+
+    def test_positions_pass_over_flushed_bytes(self):
+        buffer = AudioRingBuffer(4, OVERFLOW_BLOCK, frame_size=2)
+        buffer.write(b'AABB')
+        buffer.read_frame_nowait()
+        start = buffer.write_position
+
+        buffer.write(b'CCD')
+        buffer.pad_frame(b'd')
+        # The frame queued before the start is read first
+        buffer.read_frame_nowait()
+        self.assertEqual(buffer.read_position, start)
+        buffer.read_frame_nowait()
+        self.assertEqual(buffer.read_position - start, 2)
+
+        buffer.flush()
+        self.assertEqual((buffer.read_position - start, buffer.write_position - start), (4, 4))
+
+
+if __name__ == '__main__':
+    unittest.main()
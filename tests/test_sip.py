@@ -0,0 +1,75 @@
+import unittest
+
+from benchmarks.fuzz_sip import check_round_trip, load_corpus
+from rotarygpt.sip import SIPParseError, SIPRequest
+
+
+def parse(data):
+    return SIPRequest(('127.0.0.1', 5060)).parse(data)
+
+
+class SIPRequestTest(unittest.TestCase):
+    def test_corpus_round_trip(self):
+        for name, data in load_corpus():
+            with self.subTest(name):
+                check_round_trip(name, data)
+
+    def test_folded_headers(self):
+        request = parse(b'INVITE sip:rotary@10.0.0.2 SIP/2.0\r\n'
+                        b'Via: SIP/2.0/UDP 10.0.0.3\r\n'
+                        b'  ;branch=z9hG4bK1\r\n'
+                        b'From: <sip:phone@10.0.0.3>;tag=1\r\n'
+                        b'To: <sip:rotary@10.0.0.2>\r\n'
+                        b'Call-ID: folded@10.0.0.3\r\n'
+                        b'CSeq: 1 INVITE\r\n'
+                        b'Subject: pick\r\n'
+                        b'\tup\r\n'
+                        b'\r\n')
+        self.assertEqual(request.headers[b'Via'], [b'SIP/2.0/UDP 10.0.0.3 ;branch=z9hG4bK1'])
+        self.assertEqual(request.header(b'Subject'), b'pick up')
+
+    def test_continuation_without_header(self):
+        with self.assertRaises(SIPParseError):
+            parse(b'INVITE sip:rotary@10.0.0.2 SIP/2.0\r\n'
+                  b' ;branch=z9hG4bK1\r\n'
+                  b'\r\n')
+
+    def test_compact_headers(self):
+        request = parse(b'BYE sip:rotary@10.0.0.2 SIP/2.0\r\n'
+                        b'v: SIP/2.0/UDP 10.0.0.3;branch=z9hG4bK1\r\n'
+                        b'f: <sip:phone@10.0.0.3>;tag=1\r\n'
+                        b't: <sip:rotary@10.0.0.2>;tag=2\r\n'
+                        b'i: compact@10.0.0.3\r\n'
+                        b'CSeq: 2 BYE\r\n'
+                        b'm: <sip:phone@10.0.0.3>\r\n'
+                        b'l: 0\r\n'
+                        b'\r\n')
+        self.assertEqual(request.header(b'Via'), b'SIP/2.0/UDP 10.0.0.3;branch=z9hG4bK1')
+        self.assertEqual(request.header(b'From'), b'<sip:phone@10.0.0.3>;tag=1')
+        self.assertEqual(request.header(b'To'), b'<sip:rotary@10.0.0.2>;tag=2')
+        self.assertEqual(request.header(b'Call-ID'), b'compact@10.0.0.3')
+        self.assertEqual(request.header(b'Contact'), b'<sip:phone@10.0.0.3>')
+        self.assertEqual(request.header(b'Content-Length'), b'0')
+        # Serialized with the full names
+        self.assertIn(b'\r\nCall-ID: compact@10.0.0.3\r\n', request.to_sip_message())
+
+    def test_multi_value_headers(self):
+        request = parse(b'INVITE sip:rotary@10.0.0.2 SIP/2.0\r\n'
+                        b'Via: SIP/2.0/UDP proxy.local;branch=z9hG4bK2, SIP/2.0/UDP 10.0.0.3;branch=z9hG4bK1\r\n'
+                        b'Via: SIP/2.0/UDP 10.0.0.4;branch=z9hG4bK0\r\n'
+                        b'From: "Doe, John" <sip:phone@10.0.0.3>;tag=1\r\n'
+                        b'To: <sip:rotary@10.0.0.2>\r\n'
+                        b'Call-ID: multi@10.0.0.3\r\n'
+                        b'CSeq: 1 INVITE\r\n'
+                        b'Contact: <sip:a@10.0.0.3>, "Other, Name" <sip:b@10.0.0.3;x=1,2>\r\n'
+                        b'\r\n')
+        self.assertEqual(request.headers[b'Via'], [b'SIP/2.0/UDP proxy.local;branch=z9hG4bK2',
+                                                   b'SIP/2.0/UDP 10.0.0.3;branch=z9hG4bK1',
+                                                   b'SIP/2.0/UDP 10.0.0.4;branch=z9hG4bK0'])
+        self.assertEqual(request.headers[b'Contact'], [b'<sip:a@10.0.0.3>', b'"Other, Name" <sip:b@10.0.0.3;x=1,2>'])
+        # Only the headers defined as lists are split
+        self.assertEqual(request.headers[b'From'], [b'"Doe, John" <sip:phone@10.0.0.3>;tag=1'])
+
+
+if __name__ == '__main__':
+    unittest.main()